@@ -1,538 +1,407 @@
 # -- coding: utf-8 --
-from flask import Flask, render_template, request, redirect, url_for, jsonify # تم تحديث هذا السطر
-import swisseph as swe
-from geopy.geocoders import Nominatim
+from flask import Flask, Response, abort, render_template, request, redirect, stream_with_context, url_for, jsonify # تم تحديث هذا السطر
 import os
-import io
-import base64
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
-from timezonefinder import TimezoneFinder
-import pytz
-from datetime import datetime
 import logging
-import json # تمت إضافة استيراد JSON
+import geocoding
+import timezone_service
+from chart_cache import chart_cache, THUMBNAIL_SIZES
+from daily_sky import daily_sky
+from concurrent.futures import TimeoutError as RenderTimeout
+from render_pool import render_pool, job_id, parse_job_id
+from chart_pipeline import (
+    ChartContext, ChartInputError, chart_flight, compute_chart, compute_chart_model, compute_sky, form_context,
+    julian_day, parse_birth_data,
+)
+from ephemeris_cache import ephemeris_cache
+from datetime import datetime, timezone
+from get_interpretation import get_chart_interpretations
+from horoscope_store import HoroscopeStore
+import instrumentation
+import startup
+from instrumentation import span, trace
 
 logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SESSION_SECRET', 'dev-secret-key')
+instrumentation.init_app(app)
 
 # --- HOROSCOPE ADMIN CONFIGURATION ---
 # المسار الذي سيتم حفظ البيانات اليومية فيه
-HOROSCOPE_DATA_PATH = os.path.join(app.root_path, 'Static', 'daily_horoscopes.json')
+HOROSCOPE_DATA_PATH = os.path.join(app.root_path, 'static', 'daily_horoscopes.json')
 # ⚠️ هام جداً: غيّر كلمة المرور الافتراضية هذه إلى كلمة سر قوية!
 ADMIN_PASSWORD = 'YOUR_SECURE_ADMIN_PASSWORD' 
+# الحد الأقصى لعدد السجلات في طلب /api/chart/batch
+MAX_BATCH_RECORDS = int(os.environ.get('FALAKY_MAX_BATCH_RECORDS', 1000))
+# الحد الأقصى لعدد الخرائط في مجموعة المقارنة في /api/synastry/rank
+MAX_SYNASTRY_POOL = int(os.environ.get('FALAKY_MAX_SYNASTRY_POOL', 100000))
+# أقصى عدد من النتائج في /api/chart/similar
+MAX_SIMILAR_CHARTS = int(os.environ.get('FALAKY_MAX_SIMILAR_CHARTS', 100))
+# أقصى مدة (بالأيام) لطلب /api/events
+MAX_EVENT_DAYS = int(os.environ.get('FALAKY_MAX_EVENT_DAYS', 3660))
+# الحد الأقصى لعدد السجلات في طلب /api/export. بمعدل 770 سجلاً في الثانية تقريباً تستغرق 20000 سجل
+# نحو 26 ثانية، أي أقل من مهلة عامل gunicorn المتزامن (FALAKY_WORKER_TIMEOUT، 60 ثانية) الذي يُقتل
+# إن طال طلب واحد أكثر منها. لا ترفعه إلا مع FALAKY_THREADS > 1 (gthread) أو FALAKY_ASYNC=1، أو استعمل
+# report_export.py مباشرة للملفات الكبيرة.
+MAX_EXPORT_RECORDS = int(os.environ.get('FALAKY_MAX_EXPORT_RECORDS', 20000))
 # -------------------------------------
 
-PLANET_SYMBOLS = {
-    "Sun": "☉", "Moon": "☽", "Mercury": "☿", "Venus": "♀",
-    "Mars": "♂", "Jupiter": "♃", "Saturn": "♄", "Uranus": "♅",
-    "Neptune": "♆", "Pluto": "♇", "Rahu": "☊", "Ketu": "☋"
-}
-PLANET_NAMES_ARABIC = {
-    "Sun": "الشمس", "Moon": "القمر", "Mercury": "عطارد", "Venus": "الزهرة",
-    "Mars": "المريخ", "Jupiter": "المشتري", "Saturn": "زحل", "Uranus": "أورانوس",
-    "Neptune": "نبتون", "Pluto": "بلوتو", "Rahu": "الرأس (راهو)", "Ketu": "الذنب (كيتو)"
-}
-SIGN_SYMBOLS = {
-    "Aries": "♈", "Taurus": "♉", "Gemini": "♊", "Cancer": "♋",
-    "Leo": "♌", "Virgo": "♍", "Libra": "♎", "Scorpio": "♏",
-    "Sagittarius": "♐", "Capricorn": "♑", "Aquarius": "♒", "Pisces": "♓"
-}
-SIGN_NAMES_ARABIC = [
-    "الحمل", "الثور", "الجوزاء", "السرطان", "الأسد", "العذراء",
-    "الميزان", "العقرب", "القوس", "الجدي", "الدلو", "الحوت"
-]
-SIGN_NAMES_ENGLISH = list(SIGN_SYMBOLS.keys())
-HOUSE_NAMES_ARABIC = [
-    "الأول (الطالع)", "الثاني", "الثالث", "الرابع (قاع السماء)", "الخامس", "السادس",
-    "السابع (الهابط)", "الثامن", "التاسع", "العاشر (وسط السماء)", "الحادي عشر", "الثاني عشر"
-]
+horoscope_store = HoroscopeStore(HOROSCOPE_DATA_PATH)
 
 # --- NEW HELPER FUNCTION ---
 def read_horoscopes():
-    """قراءة البيانات من ملف JSON مع دعم UTF-8."""
-    try:
-        with open(HOROSCOPE_DATA_PATH, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # في حالة عدم العثور على الملف أو تلفه، يتم إرجاع كائن فارغ
-        return {}
+    """قراءة البيانات (نسخة قابلة للتعديل) من ذاكرة التخزين المؤقت للأبراج."""
+    # في حالة عدم العثور على الملف أو تلفه، يتم إرجاع كائن فارغ
+    return horoscope_store.data()
 # ---------------------------
 
 def get_lat_lon(city, country):
-    """Get latitude and longitude for a city using geocoding."""
-    geolocator = Nominatim(user_agent="falaky_app")
-    location = geolocator.geocode(f"{city}, {country}", language='ar') or \
-               geolocator.geocode(f"{city}, {country}", language='en')
-    return (location.latitude, location.longitude) if location else (None, None)
+    """Get latitude and longitude for a city (gazetteer, then disk cache, then Nominatim)."""
+    return geocoding.geocode(city, country)
 
 def fix_timezone_override(timezone_str, country):
     """
     Fix incorrect timezone detections from TimezoneFinder.
-    Some countries have incorrect timezone mappings, so we override them here.
-    """
-    country_lower = country.lower().strip()
-    
-    # Syria fix: TimezoneFinder incorrectly returns "Europe/Moscow" for Syrian cities
-    # Syria should use "Asia/Damascus" (UTC+3 permanent, no DST since Oct 2022)
-    syria_names = ['syria', 'سوريا', 'syrian', 'syrian arab republic', 'سورية']
-    if any(name in country_lower for name in syria_names):
-        if timezone_str != 'Asia/Damascus':
-            logging.info(f"Overriding timezone from {timezone_str} to Asia/Damascus for Syria")
-            return 'Asia/Damascus'
-    
-    # Jordan fix: Ensure correct timezone for Jordan
-    jordan_names = ['jordan', 'الأردن', 'jordanian']
-    if any(name in country_lower for name in jordan_names):
-        if timezone_str != 'Asia/Amman':
-            logging.info(f"Overriding timezone from {timezone_str} to Asia/Amman for Jordan")
-            return 'Asia/Amman'
-    
-    # Saudi Arabia fix: Ensure correct timezone for Saudi Arabia
-    saudi_names = ['saudi arabia', 'السعودية', 'المملكة العربية السعودية', 'saudi', 'ksa']
-    if any(name in country_lower for name in saudi_names):
-        if timezone_str != 'Asia/Riyadh':
-            logging.info(f"Overriding timezone from {timezone_str} to Asia/Riyadh for Saudi Arabia")
-            return 'Asia/Riyadh'
-    
-    return timezone_str
-
-def get_zodiac_info(deg):
-    """Convert degree to zodiac sign information."""
-    index = int(deg // 30) % 12
-    sign_en = SIGN_NAMES_ENGLISH[index]
-    degree_in_sign = deg % 30
-    return {
-        "sign_ar": SIGN_NAMES_ARABIC[index],
-        "sign_symbol": SIGN_SYMBOLS[sign_en],
-        "sign_index": index,
-        "degree_in_sign": degree_in_sign,
-        "sign_en": sign_en
-    }
-
-def get_house_number(lon_deg, houses_cusps):
+    Some countries have incorrect timezone mappings, so we override them here
+    (see timezone_service.COUNTRY_TIMEZONE_OVERRIDES).
     """
-    Determine which house a celestial body is in based on its degree and house cusps.
-    CORRECTED: Uses houses_cusps[0:12] for proper indexing.
-    """
-    if len(houses_cusps) < 12:
-        return 1
-    
-    # CRITICAL FIX: Use [0:12] not [1:13] to get the correct house cusps
-    cusps = list(houses_cusps[0:12])
-    
-    lon_deg = lon_deg % 360
-    
-    for i in range(12):
-        start = cusps[i] % 360
-        end = cusps[(i + 1) % 12] % 360
-        
-        if start < end:
-            # Normal case: house doesn't cross 0°
-            if start <= lon_deg < end:
-                return i + 1
-        else:
-            # Wraparound case: house crosses 0° Aries
-            if lon_deg >= start or lon_deg < end:
-                return i + 1
-    
-    return 1
-
-def calculate_aspects(planets_deg):
-    """Calculate major aspects between planets."""
-    aspects = []
-    planet_list = list(planets_deg.items())
-    
-    aspect_types = {
-        'opposition': {'angle': 180, 'orb': 8, 'color': 'red', 'linewidth': 2},
-        'trine': {'angle': 120, 'orb': 8, 'color': 'blue', 'linewidth': 1.5},
-        'square': {'angle': 90, 'orb': 8, 'color': 'red', 'linewidth': 1.5},
-        'sextile': {'angle': 60, 'orb': 6, 'color': 'blue', 'linewidth': 1},
-    }
-    
-    for i in range(len(planet_list)):
-        for j in range(i + 1, len(planet_list)):
-            planet1_name, deg1 = planet_list[i]
-            planet2_name, deg2 = planet_list[j]
-            
-            diff = abs(deg1 - deg2)
-            if diff > 180:
-                diff = 360 - diff
-            
-            for aspect_name, aspect_info in aspect_types.items():
-                if abs(diff - aspect_info['angle']) <= aspect_info['orb']:
-                    aspects.append({
-                        'planet1': planet1_name,
-                        'planet2': planet2_name,
-                        'deg1': deg1,
-                        'deg2': deg2,
-                        'type': aspect_name,
-                        'angle': aspect_info['angle'],
-                        'color': aspect_info['color'],
-                        'linewidth': aspect_info['linewidth']
-                    })
-    
-    return aspects
-
-def create_chart_image(planets_deg, houses_deg, ascendant_deg):
-    """Create a visual representation of the astrological chart."""
-    fig, ax = plt.subplots(figsize=(8, 8), subplot_kw={'projection': 'polar'})
-    
-    ax.set_theta_zero_location('W')
-    ax.set_theta_direction(1)
-    
-    rotation_offset = ascendant_deg
-    
-    inner_radius = 0.3
-    outer_radius = 1.0
-    
-    # Draw zodiac signs
-    for i in range(12):
-        start_deg = i * 30
-        
-        rotated_start_deg = (start_deg - rotation_offset) % 360
-        start_rad = np.deg2rad(rotated_start_deg)
-        
-        color = 'lightblue' if i % 2 == 0 else 'lightyellow'
-        ax.bar(start_rad, outer_radius - inner_radius, width=np.deg2rad(30), bottom=inner_radius, 
-               color=color, alpha=0.3, edgecolor='black', linewidth=1.0, align='edge')
-        
-        sign_center_deg = start_deg + 15
-        rotated_center_deg = (sign_center_deg - rotation_offset) % 360
-        sign_center_rad = np.deg2rad(rotated_center_deg)
-        
-        ax.text(sign_center_rad, outer_radius + 0.1, SIGN_SYMBOLS[SIGN_NAMES_ENGLISH[i]], 
-                fontsize=16, ha='center', va='center', weight='bold')
-    
-    # Draw inner circle
-    theta_full = np.linspace(0, 2*np.pi, 100)
-    ax.plot(theta_full, [inner_radius] * 100, color='black', linewidth=1.5)
-    
-    # Draw house cusps
-    for i, deg in enumerate(houses_deg):
-        rotated_deg = (deg - rotation_offset) % 360
-        theta = np.deg2rad(rotated_deg)
-        ax.plot([theta, theta], [inner_radius, outer_radius], color='black', linestyle='-', linewidth=2.0)
-        
-        house_num = i + 1
-        next_deg = houses_deg[(i + 1) % 12]
-        mid_deg = deg + ((next_deg - deg) % 360) / 2
-        
-        rotated_mid_deg = (mid_deg - rotation_offset) % 360
-        mid_rad = np.deg2rad(rotated_mid_deg)
-        
-        house_number_radius = inner_radius + 0.1
-        ax.text(mid_rad, house_number_radius, str(house_num), fontsize=10, ha='center', va='center', 
-                weight='bold', color='black')
-    
-    # Draw aspects
-    aspects = calculate_aspects(planets_deg)
-    aspect_radius = inner_radius - 0.05
-    
-    for aspect in aspects:
-        rotated_deg1 = (aspect['deg1'] - rotation_offset) % 360
-        rotated_deg2 = (aspect['deg2'] - rotation_offset) % 360
-        theta1 = np.deg2rad(rotated_deg1)
-        theta2 = np.deg2rad(rotated_deg2)
-        
-        num_points = 100
-        t_vals = np.linspace(0, 1, num_points)
-        x1 = aspect_radius * np.cos(theta1)
-        y1 = aspect_radius * np.sin(theta1)
-        x2 = aspect_radius * np.cos(theta2)
-        y2 = aspect_radius * np.sin(theta2)
-        
-        xs = x1 + t_vals * (x2 - x1)
-        ys = y1 + t_vals * (y2 - y1)
-        
-        rs = np.sqrt(xs**2 + ys**2)
-        thetas = np.arctan2(ys, xs)
-        
-        ax.plot(thetas, rs, color=aspect['color'], linewidth=aspect['linewidth'], 
-                alpha=0.6, linestyle='-', solid_capstyle='round')
-    
-    # Draw planets
-    planet_positions = {}
-    for name, deg in planets_deg.items():
-        rotated_deg = (deg - rotation_offset) % 360
-        theta = np.deg2rad(rotated_deg)
-        
-        radius = outer_radius - 0.15
-        for other_name, other_pos in planet_positions.items():
-            other_theta, other_radius = other_pos
-            angle_diff = abs(theta - other_theta)
-            if angle_diff > np.pi:
-                angle_diff = 2 * np.pi - angle_diff
-            
-            if angle_diff < np.deg2rad(10):
-                radius = other_radius - 0.08 if other_radius > outer_radius - 0.2 else other_radius + 0.08
-        
-        planet_positions[name] = (theta, radius)
-        
-        ax.text(theta, radius, PLANET_SYMBOLS.get(name, '?'), 
-                fontsize=14, ha='center', va='center', 
-                color='black', weight='bold')
-        
-        info = get_zodiac_info(deg)
-        degree_text = f"{int(info['degree_in_sign'])}°"
-        ax.text(theta, radius - 0.06, degree_text, 
-                fontsize=8, ha='center', va='center', color='darkblue')
-    
-    # Draw ASC line
-    asc_theta = np.deg2rad(0)
-    ax.plot([asc_theta, asc_theta], [0.0, outer_radius], color='black', linestyle='-', linewidth=3)
-    ax.text(asc_theta, outer_radius + 0.05, 'ASC', fontsize=12, ha='center', va='center', 
-            weight='bold', color='black')
-    
-    ax.set_rticks([])
-    ax.set_xticks(np.deg2rad(np.arange(0, 360, 30)))
-    ax.set_xticklabels([])
-    ax.set_ylim(0, outer_radius + 0.2)
-    
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', bbox_inches='tight', dpi=150)
-    buf.seek(0)
-    img_data = base64.b64encode(buf.read()).decode('ascii')
-    plt.close(fig)
-    return img_data
-
-def get_planet_degree(jd_ut, pid):
-    """Get the degree position of a planet."""
-    try:
-        pos_calc = swe.calc_ut(jd_ut, pid, swe.FLG_SWIEPH)
-        if pos_calc and isinstance(pos_calc[0], (list, tuple)):
-            return pos_calc[0][0]
-        elif isinstance(pos_calc[0], (float, int)):
-            return pos_calc[0]
-    except Exception as e:
-        logging.error(f"Error calculating planet {pid}: {e}")
-    return -1.0
+    return timezone_service.apply_country_override(timezone_str, country)
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     chart = None
+    chart_job = None
     result_data = None
     input_data = request.form if request.method == 'POST' else None
     error = None
-    dst_notice = None
 
     if request.method == 'POST':
         try:
-            year = int(request.form['year'])
-            month = int(request.form['month'])
-            day = int(request.form['day'])
-            hour = int(request.form['hour'])
-            minute = int(request.form['minute'])
-            city = request.form['city'].strip()
-            country = request.form['country'].strip()
-
-            lat, lon = get_lat_lon(city, country)
-            if lat is None or lon is None:
-                error = "لم نتمكن من العثور على المدينة/الدولة المدخلة. تحقق من الإملاء."
-                return render_template('index.html', error=error, input_data=input_data)
-
-            tf = TimezoneFinder()
-            timezone_str = tf.timezone_at(lng=lon, lat=lat)
-            if not timezone_str:
-                error = "لم يتم العثور على منطقة زمنية لهذا الموقع."
-                return render_template('index.html', error=error, input_data=input_data)
-            
-            # CRITICAL FIX: Apply timezone override for Syria, Jordan, Saudi Arabia
-            timezone_str = fix_timezone_override(timezone_str, country)
-
-            local_tz = pytz.timezone(timezone_str)
-            naive_dt = datetime(year, month, day, hour, minute)
-            dst_preference_str = request.form.get('dst_preference', 'true')
-            user_prefers_dst = (dst_preference_str == 'true')
-            
+            birth = parse_birth_data(request.form)
+            # The template reads the model's lazy views; no per-body dicts are built.
+            # form_context reuses the stages a resubmitted form did not change.
+            result_data = compute_chart_model(birth, form_context)
+
+            # The image is rendered once per distinct chart and fetched by the page separately.
+            chart_key = chart_cache.store_spec(result_data.planets_deg, result_data.houses_deg,
+                                               result_data.asc, result_data.house_system)
+            chart = url_for('chart_image', key=chart_key, ext=chart_cache.get_spec(chart_key)['fmt'])
+            # يبدأ الرسم في مجمع العمليات الآن، والصفحة (الجداول) تُرسل دون انتظاره
+            chart_job = url_for('api_chart_job', job=job_id(chart_key))
             try:
-                local_dt = local_tz.localize(naive_dt, is_dst=None)
-            except pytz.exceptions.AmbiguousTimeError:
-                local_dt = local_tz.localize(naive_dt, is_dst=user_prefers_dst)
-                dst_type = "التوقيت الصيفي (الحدوث الأول)" if user_prefers_dst else "التوقيت الشتوي (الحدوث الثاني)"
-                dst_notice = f"ملاحظة: الوقت المدخل ({hour:02d}:{minute:02d}) يحدث مرتين في هذا التاريخ بسبب التوقيت الصيفي. تم استخدام {dst_type}."
-                logging.info(f"Ambiguous time detected for {timezone_str}, using DST={user_prefers_dst}")
-            except pytz.exceptions.NonExistentTimeError:
-                error = f"الوقت المدخل ({hour:02d}:{minute:02d}) غير موجود في هذا التاريخ بسبب التوقيت الصيفي. الساعة تقدمت في هذا اليوم. يرجى إدخال وقت مختلف."
-                logging.warning(f"Non-existent time for {timezone_str} at {year}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}")
-                return render_template('index.html', error=error, input_data=input_data)
-            
-            utc_dt = local_dt.astimezone(pytz.utc)
-            
-            utc_offset = local_dt.strftime('%z')
-            utc_offset_formatted = f"UTC{utc_offset[:3]}:{utc_offset[3:]}"
-            
-            dst_offset = local_dt.dst()
-            is_dst_active = bool(dst_offset)
-            dst_hours = dst_offset.total_seconds() / 3600 if dst_offset else 0
-            
-            if not dst_notice:
-                if is_dst_active and dst_hours > 0:
-                    dst_hours_str = f"{dst_hours:.1f}".rstrip('0').rstrip('.')
-                    dst_notice = f"✓ التوقيت الصيفي نشط في هذا التاريخ. التوقيت المستخدم: {utc_offset_formatted} (يتضمن +{dst_hours_str} ساعة توقيت صيفي)"
-                else:
-                    dst_notice = f"التوقيت الشتوي (القياسي) نشط في هذا التاريخ. التوقيت المستخدم: {utc_offset_formatted}"
-            else:
-                dst_notice += f" التوقيت المستخدم: {utc_offset_formatted}"
-
-            jd_ut = swe.julday(utc_dt.year, utc_dt.month, utc_dt.day, 
-                                 utc_dt.hour + utc_dt.minute / 60.0 + utc_dt.second / 3600.0)
-            
-            logging.info(f"Birth data: {year}-{month:02d}-{day:02d} {hour:02d}:{minute:02d} in {city}, {country}")
-            logging.info(f"Timezone: {timezone_str}, UTC Offset: {utc_offset_formatted}, DST Active: {is_dst_active}, DST Hours: {dst_hours}")
-            logging.info(f"Local time: {local_dt}, UTC time: {utc_dt}")
-            logging.info(f"Julian Day: {jd_ut}, Lat: {lat}, Lon: {lon}")
+                with span('render'):
+                    render_pool.submit(chart_key)
+            except Exception as e:
+                logging.warning(f"Could not start chart render: {e}")
 
-            house_system = request.form.get('house_system', 'P')
-            houses_cusps_full, ascmc = swe.houses_ex(jd_ut, lat, lon, house_system.encode(), swe.FLG_SWIEPH)
-
-            # Use ascmc[0] for true Ascendant
-            ascendant_degree = ascmc[0]
-            mc_degree = ascmc[1]
-            
-            logging.info(f"House system: {house_system}")
-            logging.info(f"ASCMC array: {ascmc}")
-            logging.info(f"Ascendant (AC) from ascmc[0]: {ascendant_degree:.2f}°")
-            logging.info(f"MC from ascmc[1]: {mc_degree:.2f}°")
-            
-            # Handle Whole Sign house system
-            if house_system == 'W':
-                asc_deg = ascendant_degree
-                asc_sign_index = int(asc_deg // 30)
-                
-                new_houses_cusps = []
-                for i in range(12):
-                    cusp_start_deg = ((asc_sign_index + i) % 12) * 30
-                    new_houses_cusps.append(cusp_start_deg)
-                    
-                houses_cusps_full = tuple(new_houses_cusps)
-                logging.info(f"Whole Sign houses calculated. ASC sign index: {asc_sign_index}")
-            
-            # Calculate IC and DC
-            ic_degree = (mc_degree + 180) % 360
-            dc_degree = (ascendant_degree + 180) % 360
-            
-            angles = {
-                "AC": {"name_ar": "الطالع", "degree": ascendant_degree, "sign_info": get_zodiac_info(ascendant_degree)},
-                "IC": {"name_ar": "قاع السماء", "degree": ic_degree, "sign_info": get_zodiac_info(ic_degree)},
-                "MC": {"name_ar": "وسط السماء", "degree": mc_degree, "sign_info": get_zodiac_info(mc_degree)},
-                "DC": {"name_ar": "الهابط", "degree": dc_degree, "sign_info": get_zodiac_info(dc_degree)},
-            }
-            
-            planets_list = []
-            planets_deg_for_chart = {}
-            planet_ids = {
-                "Sun": swe.SUN, "Moon": swe.MOON, "Mercury": swe.MERCURY,
-                "Venus": swe.VENUS, "Mars": swe.MARS, "Jupiter": swe.JUPITER,
-                "Saturn": swe.SATURN, "Uranus": swe.URANUS, "Neptune": swe.NEPTUNE,
-                "Pluto": swe.PLUTO
-            }
-
-            for name_en, pid in planet_ids.items():
-                pos_deg = get_planet_degree(jd_ut, pid)
-                if pos_deg == -1.0:
-                    continue
-                
-                # CRITICAL: Use corrected get_house_number function
-                house_num = get_house_number(pos_deg, houses_cusps_full)
-                info = get_zodiac_info(pos_deg)
-                
-                planets_list.append({
-                    "name_en": name_en,
-                    "name_ar": PLANET_NAMES_ARABIC.get(name_en, name_en),
-                    "symbol": PLANET_SYMBOLS.get(name_en),
-                    "degree": pos_deg,
-                    "degree_in_sign": info['degree_in_sign'],
-                    "sign_ar": info['sign_ar'],
-                    "sign_symbol": info['sign_symbol'],
-                    "house": house_num,
-                    "sign_en": info['sign_en'],
-                })
-                planets_deg_for_chart[name_en] = pos_deg
-                
-                logging.info(f"{name_en} at {pos_deg:.2f}° in {info['sign_ar']} ({info['sign_en']}), House {house_num}")
-
-            # Calculate Rahu and Ketu
-            rahu_pos = get_planet_degree(jd_ut, swe.MEAN_NODE)
-            if rahu_pos != -1.0:
-                house_num_rahu = get_house_number(rahu_pos, houses_cusps_full)
-                info_rahu = get_zodiac_info(rahu_pos)
-                
-                planets_list.append({
-                    "name_en": "Rahu",
-                    "name_ar": PLANET_NAMES_ARABIC.get("Rahu"),
-                    "symbol": PLANET_SYMBOLS.get("Rahu"),
-                    "degree": rahu_pos,
-                    "degree_in_sign": info_rahu['degree_in_sign'],
-                    "sign_ar": info_rahu['sign_ar'],
-                    "sign_symbol": info_rahu['sign_symbol'],
-                    "house": house_num_rahu,
-                    "sign_en": info_rahu['sign_en'],
-                })
-                planets_deg_for_chart["Rahu"] = rahu_pos
-                logging.info(f"Rahu at {rahu_pos:.2f}° in {info_rahu['sign_ar']}, House {house_num_rahu}")
-                
-                ketu_pos = (rahu_pos + 180) % 360
-                house_num_ketu = get_house_number(ketu_pos, houses_cusps_full)
-                info_ketu = get_zodiac_info(ketu_pos)
-
-                planets_list.append({
-                    "name_en": "Ketu",
-                    "name_ar": PLANET_NAMES_ARABIC.get("Ketu"),
-                    "symbol": PLANET_SYMBOLS.get("Ketu"),
-                    "degree": ketu_pos,
-                    "degree_in_sign": info_ketu['degree_in_sign'],
-                    "sign_ar": info_ketu['sign_ar'],
-                    "sign_symbol": info_ketu['sign_symbol'],
-                    "house": house_num_ketu,
-                    "sign_en": info_ketu['sign_en'],
-                })
-                planets_deg_for_chart["Ketu"] = ketu_pos
-                logging.info(f"Ketu at {ketu_pos:.2f}° in {info_ketu['sign_ar']}, House {house_num_ketu}")
-
-            # Build houses info
-            houses_info = []
-            for i in range(12):
-                info = get_zodiac_info(houses_cusps_full[i])
-                houses_info.append({
-                    "house": i + 1,
-                    "name_ar": HOUSE_NAMES_ARABIC[i],
-                    "degree": houses_cusps_full[i],
-                    "degree_in_sign": info['degree_in_sign'],
-                    "sign_ar": info['sign_ar'],
-                    "sign_symbol": info['sign_symbol'],
-                })
-
-            result_data = {
-                "angles": angles,
-                "planets": planets_list,
-                "location": f"{city}, {country}",
-                "timezone": timezone_str,
-                "local_time": local_dt.strftime("%Y-%m-%d %H:%M"),
-                "utc_time": utc_dt.strftime("%Y-%m-%d %H:%M UTC"),
-                "houses_deg": list(houses_cusps_full[0:12]),
-                "houses_info": houses_info,
-                "dst_notice": dst_notice,
-                "house_system": house_system,
-            }
-
-            chart = create_chart_image(planets_deg_for_chart, result_data["houses_deg"], ascendant_degree)
-            
-            logging.info("Chart calculation completed successfully")
+            trace('chart_complete', chart_key=chart_key)
 
+        except ChartInputError as e:
+            return render_template('index.html', error=str(e), input_data=input_data)
         except Exception as e:
             error = f"حدث خطأ غير متوقع: {e}"
             logging.error(f"Critical Error in POST Request: {e}", exc_info=True)
 
-    return render_template('index.html',
-                           result=result_data,
-                           chart=chart,
-                           error=error,
-                           input_data=input_data)
+    with span('template'):
+        return render_template('index.html',
+                               result=result_data,
+                               chart=chart,
+                               chart_job=chart_job,
+                               error=error,
+                               input_data=input_data)
+
+@app.route('/chart/<key>.<ext>', methods=['GET'])
+def chart_image(key, ext):
+    """Serve a chart image by content hash; ?size=120|240|480 returns a thumbnail."""
+    size = request.args.get('size', type=int)
+    if size is not None and size not in THUMBNAIL_SIZES:
+        abort(400)
+
+    spec = chart_cache.get_spec(key)
+    if spec is None or spec['fmt'] != ext:
+        abort(404)
+
+    # The key is a hash of the chart inputs, so a given URL never changes content.
+    etag = f"{key}-{size or 'full'}"
+    cache_control = 'public, max-age=31536000, immutable'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        try:
+            with span('render'):
+                data, mimetype = render_pool.result(key, size)
+        except RenderTimeout:
+            response = Response(status=503)
+            response.headers['Retry-After'] = '1'
+            return response
+        except Exception as e:
+            # Not the chart at this URL, so it must not be cached like one.
+            logging.error(f"Chart image {etag} failed: {e}")
+            response = Response("تعذّر رسم الخريطة.", status=500, mimetype='text/plain')
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        response = Response(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+# --- JSON CHART API ---
+
+def _job_response(key, size):
+    status = render_pool.status(key, size)
+    if status == 'unknown':
+        return jsonify({"error": "الخريطة غير موجودة."}), 404
+    job = job_id(key, size)
+    body = {"job": job, "status": status, "status_url": url_for('api_chart_job', job=job)}
+    if status == 'done':
+        body["image_url"] = url_for('chart_image', key=key, ext=chart_cache.get_spec(key)['fmt'], size=size)
+        return jsonify(body), 200
+    if status == 'failed':
+        body["error"] = render_pool.error(key, size)
+        return jsonify(body), 500
+    return jsonify(body), 202
+
+@app.route('/api/chart/<key>/render', methods=['POST'])
+def api_chart_render(key):
+    """Start rendering a stored chart (?size= for a thumbnail); poll status_url for the result."""
+    size = request.args.get('size', type=int)
+    if size is not None and size not in THUMBNAIL_SIZES:
+        return jsonify({"error": "حجم غير مدعوم."}), 400
+    try:
+        render_pool.submit(key, size)
+    except KeyError:
+        return jsonify({"error": "الخريطة غير موجودة."}), 404
+    return _job_response(key, size)
+
+@app.route('/api/chart/jobs/<job>', methods=['GET'])
+def api_chart_job(job):
+    """Render job status: 200 with image_url when done, 202 while pending."""
+    parsed = parse_job_id(job)
+    if parsed is None:
+        return jsonify({"error": "معرّف غير صالح."}), 404
+    return _job_response(*parsed)
+
+@app.route('/api/chart', methods=['POST'])
+def api_chart():
+    """
+    Compute one chart from a JSON (or form) birth record; ?interpretations=1 adds the readings.
+    "house_systems": ["P", "K", "W", ...] (or "all") adds cusps and placements for those
+    systems, computed from the same planets in the same request.
+    """
+    data = request.get_json(silent=True) or request.form
+    try:
+        result = compute_chart(parse_birth_data(data), form_context)
+    except ChartInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error in /api/chart: {e}", exc_info=True)
+        return jsonify({"error": "حدث خطأ غير متوقع."}), 500
+
+    key = chart_cache.store_spec(result["planets_deg"], result["houses_deg"],
+                                 result["angles"]["AC"]["degree"], result["house_system"])
+    result["chart_url"] = url_for('chart_image', key=key, ext=chart_cache.get_spec(key)['fmt'])
+    if request.args.get('interpretations') == '1':
+        with span('interpretations'):
+            result["interpretations"] = get_chart_interpretations(
+                result["planets"], result["angles"]["AC"]["sign_info"]["sign_en"])
+    return jsonify({"chart": result})
+
+@app.route('/api/chart/batch', methods=['POST'])
+def api_chart_batch():
+    """
+    Compute many charts in one request: {"records": [{...}, ...]}.
+    Geocoding, timezones and body positions are shared across the records;
+    each result carries its input index and either "chart" or "error".
+    """
+    data = request.get_json(silent=True) or {}
+    records = data.get('records')
+    if not isinstance(records, list):
+        return jsonify({"error": "يجب إرسال قائمة records."}), 400
+    if len(records) > MAX_BATCH_RECORDS:
+        return jsonify({"error": f"الحد الأقصى لعدد السجلات هو {MAX_BATCH_RECORDS}."}), 413
+
+    context = ChartContext()
+    results = []
+    for index, record in enumerate(records):
+        try:
+            if not isinstance(record, dict):
+                raise ChartInputError("كل سجل يجب أن يكون كائن JSON.")
+            results.append({"index": index, "chart": compute_chart(parse_birth_data(record), context)})
+        except ChartInputError as e:
+            results.append({"index": index, "error": str(e)})
+        except Exception as e:
+            logging.error(f"Error in /api/chart/batch record {index}: {e}", exc_info=True)
+            results.append({"index": index, "error": "حدث خطأ غير متوقع."})
+
+    return jsonify({"count": len(results), "results": results})
+
+@app.route('/api/chart/sweep', methods=['POST'])
+def api_chart_sweep():
+    """
+    Unknown birth time: {year, month, day, city, country, start?, end?, house_system?}.
+    Returns the minutes in the local window (default the whole day) where the
+    rising sign, MC sign or a body's house/sign changes, and a timeline of segments.
+    """
+    from birth_time_sweep import parse_sweep_request, sweep_birth_window
+    data = request.get_json(silent=True) or request.form
+    try:
+        result = sweep_birth_window(parse_sweep_request(data))
+    except ChartInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error in /api/chart/sweep: {e}", exc_info=True)
+        return jsonify({"error": "حدث خطأ غير متوقع."}), 500
+    return jsonify({"sweep": result})
+
+@app.route('/api/events', methods=['POST'])
+def api_events():
+    """
+    Stream ingresses, stations, exact transit aspects and returns as NDJSON:
+    {"start": "YYYY-MM-DD", "end"?, "kinds"?, "bodies"?, "chart"?: birth record or {"planets_deg": {...}}}.
+    One JSON object per line, in time order; the range defaults to one year.
+    """
+    import json
+    from event_finder import find_events, parse_event_request
+    data = request.get_json(silent=True) or {}
+    try:
+        options = parse_event_request(data, MAX_EVENT_DAYS)
+    except ChartInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error in /api/events: {e}", exc_info=True)
+        return jsonify({"error": "حدث خطأ غير متوقع."}), 500
+
+    def generate():
+        for event in find_events(**options):
+            yield json.dumps(event, ensure_ascii=False) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+@app.route('/api/export', methods=['POST'])
+def api_export():
+    """
+    Stream chart reports with interpretations for many birth records.
+    Body: NDJSON or CSV (Content-Type application/x-ndjson / text/csv, read
+    line by line) or JSON {"records": [...]}. Output is NDJSON, or CSV with
+    ?format=csv, written chunk by chunk in input order; each row carries its
+    input index and either the report or "error".
+    """
+    import io
+    import itertools
+    import report_export
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in report_export.FORMATS:
+        return jsonify({"error": "الصيغة يجب أن تكون ndjson أو csv."}), 400
+
+    if request.mimetype in ('application/x-ndjson', 'text/csv'):
+        body = io.TextIOWrapper(request.stream, encoding='utf-8-sig', newline='')
+        records = report_export.iter_records(body, 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+    else:
+        data = request.get_json(silent=True) or {}
+        records = data.get('records')
+        if not isinstance(records, list):
+            return jsonify({"error": "يجب إرسال قائمة records أو ملف NDJSON/CSV."}), 400
+        if len(records) > MAX_EXPORT_RECORDS:
+            return jsonify({"error": f"الحد الأقصى لعدد السجلات هو {MAX_EXPORT_RECORDS}."}), 413
+        records = ({'_error': "كل سجل يجب أن يكون كائن JSON."} if not isinstance(record, dict) else record
+                   for record in records)
+
+    def limited():
+        # المدخلات المتدفقة لا يُعرف طولها مسبقاً: نتوقف عند الحد ونُرجع سطر خطأ أخيراً
+        yield from itertools.islice(records, MAX_EXPORT_RECORDS)
+        if next(records, None) is not None:
+            yield {'_error': f"الحد الأقصى لعدد السجلات هو {MAX_EXPORT_RECORDS}."}
+
+    stream = report_export.stream_export(limited(), fmt, report_export.EXPORT_WORKERS,
+                                         pool=report_export.shared_pool())
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(stream), mimetype=mimetype)
+
+@app.route('/api/synastry/rank', methods=['POST'])
+def api_synastry_rank():
+    """
+    Rank a pool of charts by compatibility with one chart:
+    {"chart": {birth record} or {"planets_deg": {...}},
+     "pool": [{"id": ..., "planets_deg": {...}}, ...], "top": 10}.
+    The whole pool is scored in one vectorized pass (aspects.rank_synastry).
+    """
+    data = request.get_json(silent=True) or {}
+    chart, pool = data.get('chart'), data.get('pool')
+    if not isinstance(chart, dict) or not isinstance(pool, list):
+        return jsonify({"error": "يجب إرسال chart وقائمة pool."}), 400
+    import numpy as np
+    from aspects import rank_synastry
+    if len(pool) > MAX_SYNASTRY_POOL:
+        return jsonify({"error": f"الحد الأقصى لحجم المجموعة هو {MAX_SYNASTRY_POOL}."}), 413
+    try:
+        top = int(data.get('top', 10))
+        planets_deg = chart.get('planets_deg') or compute_chart(parse_birth_data(chart))["planets_deg"]
+        bodies = list(planets_deg)
+        lons = np.array([float(planets_deg[name]) for name in bodies])
+        pool_lons = np.array([[float(entry['planets_deg'][name]) for name in bodies] for entry in pool]).reshape(-1, len(bodies))
+    except ChartInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"بيانات المقارنة غير صالحة: {e}"}), 400
+
+    best, scores = rank_synastry(lons, pool_lons, top=top)
+    matches = [{"index": i, "id": pool[i].get('id'), "score": round(float(s), 4)}
+               for i, s in zip(best.tolist(), scores.tolist())]
+    return jsonify({"bodies": bodies, "matches": matches})
+
+@app.route('/api/chart/similar', methods=['POST'])
+def api_chart_similar():
+    """
+    The stored charts closest to one chart (chart_index):
+    {"chart": {birth record} or {"planets_deg": {...}, "ascendant"?, "mc"?},
+     "k": 10, "weights"?: {"Sun": 2, "AC": 0, ...}, "exact"?: false}.
+    Without ascendant/mc (unknown birth time) only the bodies are compared.
+    """
+    import math
+    from chart_index import INDEX_POINTS, chart_longitudes, load_index
+    data = request.get_json(silent=True) or {}
+    chart = data.get('chart')
+    if not isinstance(chart, dict):
+        return jsonify({"error": "يجب إرسال chart."}), 400
+    index = load_index()
+    if index is None or not len(index):
+        return jsonify({"error": "فهرس الخرائط المتشابهة غير متوفر."}), 503
+    try:
+        k = int(data.get('k', 10))
+        if not 1 <= k <= MAX_SIMILAR_CHARTS:
+            raise ValueError(f"k يجب أن يكون بين 1 و {MAX_SIMILAR_CHARTS}")
+        if chart.get('planets_deg'):
+            positions = dict(chart['planets_deg'], AC=chart.get('ascendant', math.nan), MC=chart.get('mc', math.nan))
+            lons = [float(positions.get(name, math.nan)) for name in INDEX_POINTS]
+        else:
+            lons = chart_longitudes(compute_chart_model(parse_birth_data(chart), form_context))
+        with span('similar'):
+            matches = index.search(lons, k, weights=data.get('weights'), exact=bool(data.get('exact')))
+    except ChartInputError as e:
+        return jsonify({"error": str(e)}), 400
+    except (AttributeError, TypeError, ValueError) as e:
+        return jsonify({"error": f"بيانات المقارنة غير صالحة: {e}"}), 400
+    return jsonify({"size": len(index), "matches": [{"id": chart_id, "similarity": similarity}
+                                                    for chart_id, similarity in matches]})
+
+@app.route('/api/planets/now', methods=['GET'])
+def api_planets_now():
+    """
+    The sky at the current UTC second. Every request within the same second
+    shares one computation (ephemeris_cache), and browsers/proxies may reuse
+    the answer for that second.
+    """
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    jd_ut = julian_day(now)
+    etag = f"sky-{now.strftime('%Y%m%d%H%M%S')}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify({"utc_time": now.strftime("%Y-%m-%d %H:%M:%S UTC"), "jd_ut": jd_ut,
+                            "planets": compute_sky(jd_ut)})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age=1'
+    return response
 
 # --- NEW ROUTES FOR HOROSCOPE MANAGEMENT ---
 
@@ -547,19 +416,12 @@ def admin_horoscopes():
     if request.method == 'POST':
         # التعامل مع حفظ البيانات المرسلة من نموذج HTML
         try:
-            horoscopes = read_horoscopes()
-            
             # تحديث محتوى التوقعات بناءً على البيانات المرسلة من النموذج
-            for sign in horoscopes.keys():
-                # نتوقع أن اسم الحقل في النموذج هو 'aries_content', 'taurus_content', إلخ.
-                new_content = request.form.get(f'{sign}_content')
-                if new_content is not None:
-                    horoscopes[sign]['content'] = new_content
+            # نتوقع أن اسم الحقل في النموذج هو 'aries_content', 'taurus_content', إلخ.
+            contents = {sign: request.form.get(f'{sign}_content') for sign in horoscope_store.snapshot().data}
             
-            # كتابة البيانات المحدثة إلى ملف JSON
-            with open(HOROSCOPE_DATA_PATH, 'w', encoding='utf-8') as f:
-                # ensure_ascii=False يضمن حفظ الأحرف العربية بشكل صحيح
-                json.dump(horoscopes, f, ensure_ascii=False, indent=4)
+            # كتابة البيانات المحدثة إلى ملف JSON (كتابة ذرية ثم إعادة تسمية)
+            horoscope_store.save(contents)
                 
             # إعادة التوجيه لمنع إعادة إرسال النموذج عند تحديث الصفحة
             return redirect(url_for('admin_horoscopes', password=ADMIN_PASSWORD))
@@ -575,12 +437,137 @@ def admin_horoscopes():
 
 
 # 2. مسار API لجلب البيانات (للاستخدام في الواجهة الأمامية index.html)
+def _horoscope_response(body, etag, last_modified):
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    # يمكن للمتصفح تخزين الاستجابة لكن يجب التحقق منها (304) عند كل طلب
+    response.headers['Cache-Control'] = 'public, no-cache'
+    return response.make_conditional(request)
+
 @app.route('/api/horoscopes', methods=['GET'])
 def api_horoscopes():
     """جلب بيانات الأبراج بصيغة JSON ليستخدمها JavaScript في الواجهة الأمامية."""
-    horoscopes = read_horoscopes()
-    # يتم استخدام jsonify لضمان إرسال رأس محتوى JSON الصحيح
-    return jsonify(horoscopes)
+    snapshot = horoscope_store.snapshot()
+    return _horoscope_response(snapshot.body, snapshot.etag, snapshot.last_modified)
+
+@app.route('/api/horoscopes/<sign>', methods=['GET'])
+def api_horoscope_sign(sign):
+    """جلب توقعات برج واحد (مثل /api/horoscopes/aries)."""
+    snapshot = horoscope_store.snapshot()
+    entry = snapshot.signs.get(sign.lower())
+    if entry is None:
+        return jsonify({"error": "برج غير معروف."}), 404
+    body, etag = entry
+    return _horoscope_response(body, etag, snapshot.last_modified)
+
+
+@app.route('/api/sky/<day>', methods=['GET'])
+def api_sky(day):
+    """
+    The sky of a date (YYYY-MM-DD or "today") for one timezone band:
+    ?band=+3, or ?tz=Africa/Cairo for that zone's band on that date (default
+    UTC). Planets at local noon, moon phase, retrogrades, the day's
+    ingresses and stations, and per horoscope sign the transits aspecting it.
+    """
+    import pytz
+    from datetime import date as date_cls, timedelta
+    from daily_sky import MAX_DAYS, band_for_offset
+    now = datetime.now(timezone.utc)
+    tz_name = request.args.get('tz')
+    try:
+        band = int(request.args.get('band', 0))
+    except ValueError:
+        return jsonify({"error": "band يجب أن يكون فرق توقيت بالساعات مثل +3."}), 400
+    if tz_name:
+        try:
+            zone = pytz.timezone(tz_name)
+        except pytz.exceptions.UnknownTimeZoneError:
+            return jsonify({"error": f"منطقة زمنية غير معروفة: {tz_name}"}), 400
+    try:
+        if day == 'today':
+            local_day = now.astimezone(zone).date() if tz_name else (now + timedelta(hours=band)).date()
+        else:
+            local_day = date_cls.fromisoformat(day)
+    except ValueError:
+        return jsonify({"error": "التاريخ يجب أن يكون بصيغة YYYY-MM-DD أو today."}), 400
+    if tz_name:
+        noon = zone.localize(datetime(local_day.year, local_day.month, local_day.day, 12))
+        band = band_for_offset(noon.utcoffset().total_seconds() / 3600)
+    elif band != band_for_offset(band):
+        return jsonify({"error": "band يجب أن يكون بين -12 و +14."}), 400
+    if abs((local_day - now.date()).days) > MAX_DAYS:
+        return jsonify({"error": f"التاريخ يجب أن يكون في حدود {MAX_DAYS} يوماً من اليوم."}), 404
+
+    with span('daily_sky'):
+        body, etag = daily_sky.get(local_day, band)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # محتوى تاريخ معيّن لا يتغير، لكن "today" يتغير بتغير اليوم
+    response.headers['Cache-Control'] = 'public, max-age=300' if day == 'today' else 'public, max-age=86400'
+    return response.make_conditional(request)
+
+
+# --- METRICS ---
+
+def _stats_samples(stats, label='result'):
+    return [({label: name}, value) for name, value in stats.items()]
+
+def _timezone_samples():
+    stats = timezone_service.cache_stats()
+    return [({'cache': cache, 'result': result}, stats[cache][result])
+            for cache in ('zone', 'override', 'localize') for result in ('hits', 'misses')]
+
+instrumentation.register_collector('falaky_geocode_lookups_total', 'Geocoding lookups by outcome.', 'counter',
+                                   lambda: _stats_samples(geocoding.stats))
+instrumentation.register_collector('falaky_timezone_cache_total', 'Timezone cache hits and misses.', 'counter',
+                                   _timezone_samples)
+instrumentation.register_collector('falaky_chart_cache_total', 'Chart image cache hits, misses and renders.',
+                                   'counter', lambda: _stats_samples(chart_cache.stats))
+def _ephemeris_samples():
+    return [({'kind': kind, 'result': result}, value)
+            for kind, stats in ephemeris_cache.stats.items() for result, value in stats.items()]
+
+def _ephemeris_hit_rate():
+    rates = ((kind, ephemeris_cache.hit_rate(kind)) for kind in ephemeris_cache.stats)
+    return [({'kind': kind}, round(rate, 6)) for kind, rate in rates if rate is not None]
+
+instrumentation.register_collector('falaky_ephemeris_cache_total', 'Ephemeris/house cache lookups by tier.',
+                                   'counter', _ephemeris_samples)
+instrumentation.register_collector('falaky_ephemeris_cache_hit_ratio', 'Ephemeris/house cache hit rate.',
+                                   'gauge', _ephemeris_hit_rate)
+def _form_memo_samples():
+    return [({'stage': stage, 'result': result}, stats[result])
+            for stage, stats in form_context.stats().items() for result in ('hits', 'misses')]
+
+instrumentation.register_collector('falaky_form_memo_total', 'Form chart stage memo hits and misses.', 'counter',
+                                   _form_memo_samples)
+instrumentation.register_collector('falaky_form_memo_entries', 'Form chart stage memo entries.', 'gauge',
+                                   lambda: [({'stage': stage}, stats['entries'])
+                                            for stage, stats in form_context.stats().items()])
+instrumentation.register_collector('falaky_render_jobs_total', 'Render pool jobs by state.', 'counter',
+                                   lambda: _stats_samples(render_pool.stats, 'state'))
+instrumentation.register_collector('falaky_daily_sky_total', 'Daily sky lookups: memory, file or built.',
+                                   'counter', lambda: _stats_samples(daily_sky.stats, 'source'))
+def _single_flight_samples():
+    return [({'flight': flight.name, 'result': result}, value)
+            for flight in (chart_flight, chart_cache.render_flight, daily_sky.flight)
+            for result, value in flight.stats.items()]
+
+instrumentation.register_collector('falaky_single_flight_total',
+                                   'Charts, renders and daily skies: led, or joined by duplicate requests.',
+                                   'counter', _single_flight_samples)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics of this worker process."""
+    return Response(instrumentation.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# --- STARTUP ---
+# تحت gunicorn (preload_app) تُحمَّل البيانات المشتركة مرة واحدة في العملية الرئيسية قبل التفرع
+if startup.STARTUP_MODE == 'preload':
+    startup.warm(horoscope_store)
 
 
 if __name__ == '__main__':
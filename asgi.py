@@ -0,0 +1,326 @@
+# -- coding: utf-8 --
+"""
+ASGI entry point: the same Flask app, served from an event loop.
+
+    FALAKY_ASYNC=1 gunicorn -c gunicorn.conf.py asgi:app
+
+Under sync workers a chart for a city that only Nominatim knows holds
+the worker thread for the whole round trip, so a few slow lookups starve
+the pool. Here the places a request refers to (top level, "chart" and
+each of "records") are resolved first, on the event loop: the gazetteer
+and the disk cache in an executor, then Nominatim through a pooled
+keep-alive client (async_http) with a deadline. Only then does the Flask
+view run, on a thread of a fixed pool (FALAKY_ASYNC_THREADS) and under
+geocoding.local_only(), so it finds every place in the cache and never
+waits on the network. Ephemeris and house work stays in those threads,
+and rendering in render_pool's processes, as under gunicorn.
+
+Bodies larger than MAX_BUFFERED_BODY (e.g. an NDJSON upload to
+/api/export) are not buffered: they are streamed into the view as it
+reads them, and that view geocodes the way it does under sync workers.
+Responses are streamed back chunk by chunk, each chunk waiting until the
+server has taken the previous one.
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from urllib.parse import parse_qsl
+
+import geocoding
+import instrumentation
+from app import app as flask_app
+from async_http import AsyncHTTPPool
+
+# عدد الخيوط التي تُنفَّذ فيها طلبات Flask في الوضع غير المتزامن
+ASYNC_THREADS = int(os.environ.get('FALAKY_ASYNC_THREADS', 8))
+# أقصى عدد من الاتصالات المفتوحة في الوقت نفسه إلى خادم Nominatim
+NOMINATIM_CONNECTIONS = int(os.environ.get('FALAKY_GEOCODE_CONNECTIONS', 8))
+MAX_BUFFERED_BODY = 1 << 20
+# The most distinct places resolved ahead of one request (a full batch).
+MAX_PREFETCH_PLACES = 1000
+
+stats = {'prefetched': 0, 'network_lookups': 0, 'joined': 0, 'timeouts': 0, 'errors': 0}
+
+
+def request_places(data):
+    """Distinct (city, country) pairs a form/JSON body refers to."""
+    if not isinstance(data, dict):
+        return []
+    candidates = [data, data.get('chart')]
+    records = data.get('records')
+    if isinstance(records, list):
+        candidates += records
+    places = {}
+    for candidate in candidates:
+        if isinstance(candidate, dict) and candidate.get('city') not in (None, ''):
+            place = (str(candidate['city']).strip(), str(candidate.get('country') or '').strip())
+            places[place] = None
+            if len(places) >= MAX_PREFETCH_PLACES:
+                break
+    return list(places)
+
+
+def _parse_body(content_type, body):
+    mimetype = content_type.split(';', 1)[0].strip().lower()
+    try:
+        if mimetype == 'application/json' or mimetype.endswith('+json'):
+            return json.loads(body)
+        if mimetype == 'application/x-www-form-urlencoded':
+            return dict(parse_qsl(body.decode('utf-8')))
+    except ValueError:
+        pass
+    return None
+
+
+class AsyncGeocoder:
+    """geocoding.geocode() for the event loop: cache tiers in an executor, Nominatim over a pool."""
+
+    def __init__(self, connections=NOMINATIM_CONNECTIONS, timeout=geocoding.NOMINATIM_TIMEOUT):
+        self.connections = connections
+        self.timeout = timeout
+        self.url = f"{geocoding.NOMINATIM_SCHEME}://{geocoding.NOMINATIM_DOMAIN}/search"
+        self._pool = None
+        self._loop = None
+        self._in_flight = {}   # normalized place -> Future of the lookup under way
+
+    @property
+    def pool(self):
+        # Connections belong to the loop that opened them.
+        loop = asyncio.get_running_loop()
+        if self._pool is None or self._loop is not loop:
+            self._pool = AsyncHTTPPool(max_per_host=self.connections, timeout=self.timeout)
+            self._loop = loop
+        return self._pool
+
+    async def resolve(self, city, country):
+        """
+        (lat, lon), or None when unknown or when Nominatim failed (failures
+        are not cached). Concurrent requests for one place share a lookup.
+        """
+        key = (geocoding.normalize_name(city), geocoding.normalize_name(country))
+        future = self._in_flight.get(key)
+        if future is not None:
+            stats['joined'] += 1
+            return await asyncio.shield(future)
+        future = self._in_flight[key] = asyncio.ensure_future(self._resolve(city, country))
+        future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _resolve(self, city, country):
+        loop = asyncio.get_running_loop()
+        found, coords = await loop.run_in_executor(None, geocoding.lookup_local, city, country)
+        if found or not geocoding.network_allowed():
+            return coords
+
+        query = f"{city}, {country}" if country else city
+        stats['network_lookups'] += 1
+        geocoding.stats['network_lookups'] += 1
+        try:
+            coords = None
+            for language in ('ar', 'en'):
+                results = await self.pool.get_json(self.url, params=geocoding.nominatim_params(query, language))
+                if results:
+                    coords = (float(results[0]['lat']), float(results[0]['lon']))
+                    break
+        except asyncio.TimeoutError:
+            stats['timeouts'] += 1
+            logging.error("Nominatim lookup timed out for %r", query)
+            return None
+        except Exception as e:
+            stats['errors'] += 1
+            logging.error("Nominatim lookup failed for %r: %s", query, e)
+            return None
+
+        await loop.run_in_executor(None, geocoding.remember, city, country, coords)
+        return coords
+
+    def pool_stats(self):
+        return dict(self._pool.stats) if self._pool is not None else {}
+
+    async def prefetch(self, places):
+        stats['prefetched'] += len(places)
+        await asyncio.gather(*(self.resolve(city, country) for city, country in places))
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+
+
+class _BodyStream(io.RawIOBase):
+    """wsgi.input for a streamed body: pulls ASGI messages from the loop as the view reads."""
+
+    def __init__(self, prefix, receive, loop):
+        self._buffer = bytearray(prefix)
+        self._receive = receive
+        self._loop = loop
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and self._more:
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            if message['type'] == 'http.disconnect':
+                self._more = False
+                break
+            self._buffer += message.get('body', b'')
+            self._more = message.get('more_body', False)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        del self._buffer[:n]
+        return n
+
+
+class _Disconnected(Exception):
+    pass
+
+
+def build_environ(scope, body, content_length=None):
+    """A WSGI environ for an ASGI http scope; body is the wsgi.input file object."""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': str(client[0]),
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', ()):
+        name, value = name.decode('latin-1').lower(), value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    if content_length is not None:
+        environ['CONTENT_LENGTH'] = str(content_length)
+    elif 'CONTENT_LENGTH' not in environ:
+        # A chunked upload: let the view read until the stream ends.
+        environ['wsgi.input_terminated'] = True
+    return environ
+
+
+class ASGIApp:
+    """Serves a WSGI app over ASGI, resolving places on the loop before each view runs."""
+
+    def __init__(self, wsgi_app, threads=ASYNC_THREADS, geocoder=None):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='falaky-asgi')
+        self.geocoder = geocoder or AsyncGeocoder()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise RuntimeError(f"unsupported ASGI scope: {scope['type']}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self):
+        await self.geocoder.close()
+        self.executor.shutdown(wait=False)
+
+    async def _http(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        body, more = bytearray(), True
+        while more and len(body) <= MAX_BUFFERED_BODY:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more = message.get('more_body', False)
+
+        if more:
+            environ = build_environ(scope, _BodyStream(body, receive, loop))
+            watcher = None
+        else:
+            environ = build_environ(scope, io.BytesIO(body), content_length=len(body))
+            data = _parse_body(environ.get('CONTENT_TYPE', ''), bytes(body)) if body else None
+            places = request_places(data)
+            if places:
+                await self.geocoder.prefetch(places)
+            # The body is all read: the next message can only be a disconnect.
+            watcher = loop.create_task(receive())
+
+        def send_sync(message):
+            if watcher is not None and watcher.done():
+                raise _Disconnected()
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        try:
+            await loop.run_in_executor(self.executor, self._run, environ, send_sync, not more)
+        except _Disconnected:
+            pass
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+
+    def _run(self, environ, send_sync, prefetched):
+        """Run the WSGI app on an executor thread, sending the response as it is produced."""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                   for name, value in headers]
+            return write
+
+        def write(data, more_body=True):
+            if not response.get('sent'):
+                send_sync({'type': 'http.response.start', 'status': response['status'],
+                           'headers': response['headers']})
+                response['sent'] = True
+            if data or not more_body:
+                send_sync({'type': 'http.response.body', 'body': bytes(data), 'more_body': more_body})
+
+        with geocoding.local_only() if prefetched else nullcontext():
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    write(chunk)
+                write(b'', more_body=False)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+
+
+app = ASGIApp(flask_app)
+
+
+instrumentation.register_collector('falaky_async_geocode_total', 'Places resolved on the event loop, by outcome.',
+                                   'counter', lambda: [({'result': name}, value) for name, value in stats.items()])
+instrumentation.register_collector('falaky_async_http_total', 'Pooled Nominatim client requests and connections.',
+                                   'counter', lambda: [({'event': name}, value)
+                                                       for name, value in app.geocoder.pool_stats().items()])
@@ -0,0 +1,183 @@
+# -- coding: utf-8 --
+"""
+Vectorized aspect engine.
+
+aspect_matrix() checks every pair of bodies against every aspect type in
+one set of NumPy operations. For each pair it returns the matched aspect,
+the orb, the exactness and, when speeds are known, whether the aspect is
+applying or separating. find_aspects() turns the matrix into the list of
+dicts the renderers and chart data use.
+
+synastry_scores() compares one chart with a pool of charts in one call:
+(B,) longitudes against (M, B) longitudes. It scores each pool chart from
+the weighted exactness of the cross aspects, and rank_synastry() returns
+the best matches. The pool is processed in chunks so memory stays bounded
+for large M.
+"""
+import numpy as np
+
+# Order matters: it is the order hits are reported in for a pair.
+ASPECT_TYPES = {
+    'opposition': {'angle': 180, 'orb': 8, 'color': 'red', 'linewidth': 2},
+    'trine': {'angle': 120, 'orb': 8, 'color': 'blue', 'linewidth': 1.5},
+    'square': {'angle': 90, 'orb': 8, 'color': 'red', 'linewidth': 1.5},
+    'sextile': {'angle': 60, 'orb': 6, 'color': 'blue', 'linewidth': 1},
+}
+
+# Synastry also counts conjunctions; harmonious contacts add, tense ones subtract.
+SYNASTRY_ASPECTS = dict(ASPECT_TYPES, conjunction={'angle': 0, 'orb': 8, 'color': 'green', 'linewidth': 1})
+SYNASTRY_WEIGHTS = {'conjunction': 1.0, 'trine': 1.0, 'sextile': 0.7, 'square': -0.6, 'opposition': -0.4}
+SYNASTRY_CHUNK = 4096
+
+
+def _table(aspect_types):
+    names = list(aspect_types)
+    angles = np.array([aspect_types[n]['angle'] for n in names], dtype=np.float64)
+    orbs = np.array([aspect_types[n]['orb'] for n in names], dtype=np.float64)
+    return names, angles, orbs
+
+
+def _signed_diff(a, b):
+    """a - b wrapped into [-180, 180)."""
+    return (a - b + 180.0) % 360.0 - 180.0
+
+
+def _match(diff, angles, orbs):
+    """
+    For signed separations `diff` (any shape S) return (index[S], deviation[S]):
+    the tightest aspect within orb (-1 if none) and separation - aspect angle.
+    """
+    sep = np.abs(diff)[..., None]
+    deviation = sep - angles
+    off = np.abs(deviation)
+    within = off <= orbs
+    score = np.where(within, off / orbs, np.inf)
+    index = np.argmin(score, axis=-1)
+    hit = np.take_along_axis(within, index[..., None], axis=-1)[..., 0]
+    deviation = np.take_along_axis(deviation, index[..., None], axis=-1)[..., 0]
+    return np.where(hit, index, -1), deviation
+
+
+def aspect_matrix(lons, speeds=None, aspect_types=ASPECT_TYPES):
+    """
+    Full pairwise aspect matrix for N bodies.
+
+    Returns a dict of (N, N) arrays: 'index' (into list(aspect_types), -1
+    for none; the diagonal is always -1), 'orb' (degrees from exact),
+    'exactness' (1 at exact, 0 at the orb limit) and 'applying' (True when
+    the orb is shrinking; only present when speeds are given).
+    """
+    names, angles, orbs = _table(aspect_types)
+    lons = np.asarray(lons, dtype=np.float64)
+    diff = _signed_diff(lons[:, None], lons[None, :])
+    index, deviation = _match(diff, angles, orbs)
+    np.fill_diagonal(index, -1)
+    orb = np.abs(deviation)
+    limit = orbs[np.maximum(index, 0)]
+    result = {
+        'names': names,
+        'index': index,
+        'orb': orb,
+        'exactness': np.where(index >= 0, 1.0 - orb / limit, 0.0),
+    }
+    if speeds is not None:
+        speeds = np.asarray(speeds, dtype=np.float64)
+        # d|sep - angle|/dt = sign(deviation) * sign(diff) * (v1 - v2)
+        rate = np.sign(deviation) * np.sign(diff) * (speeds[:, None] - speeds[None, :])
+        result['applying'] = rate < 0
+    return result
+
+
+def find_aspects(positions, speeds=None, aspect_types=ASPECT_TYPES):
+    """
+    Aspects between bodies as a list of dicts, pairs in input order.
+    positions/speeds are {name: degrees} / {name: degrees per day}.
+    """
+    bodies = list(positions)
+    if len(bodies) < 2:
+        return []
+    lons = np.array([positions[name] for name in bodies])
+    speed_arr = np.array([speeds[name] for name in bodies]) if speeds is not None else None
+    matrix = aspect_matrix(lons, speed_arr, aspect_types)
+    names = matrix['names']
+
+    aspects = []
+    rows, cols = np.nonzero(np.triu(matrix['index'] >= 0, k=1))
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        aspect_name = names[matrix['index'][i, j]]
+        aspect_info = aspect_types[aspect_name]
+        aspects.append({
+            'planet1': bodies[i],
+            'planet2': bodies[j],
+            'deg1': positions[bodies[i]],
+            'deg2': positions[bodies[j]],
+            'type': aspect_name,
+            'angle': aspect_info['angle'],
+            'color': aspect_info['color'],
+            'linewidth': aspect_info['linewidth'],
+            'orb': round(float(matrix['orb'][i, j]), 4),
+            'exactness': round(float(matrix['exactness'][i, j]), 4),
+            'applying': bool(matrix['applying'][i, j]) if speeds is not None else None,
+        })
+    return aspects
+
+
+def synastry_matrix(lons, pool_lons, aspect_types=SYNASTRY_ASPECTS):
+    """
+    Cross aspects between one chart (B,) and a pool (M, B2).
+    Returns (index[M, B, B2], exactness[M, B, B2]); index -1 means no aspect.
+    """
+    names, angles, orbs = _table(aspect_types)
+    lons = np.asarray(lons, dtype=np.float64)
+    pool_lons = np.asarray(pool_lons, dtype=np.float64)
+    diff = _signed_diff(lons[None, :, None], pool_lons[:, None, :])
+    index, deviation = _match(diff, angles, orbs)
+    exactness = np.where(index >= 0, 1.0 - np.abs(deviation) / orbs[np.maximum(index, 0)], 0.0)
+    return index, exactness
+
+
+def _non_overlapping(angles, orbs):
+    order = np.argsort(angles)
+    a, o = angles[order], orbs[order]
+    return bool(np.all(a[1:] - a[:-1] > o[1:] + o[:-1]))
+
+
+def synastry_scores(lons, pool_lons, weights=SYNASTRY_WEIGHTS, aspect_types=SYNASTRY_ASPECTS,
+                    chunk=SYNASTRY_CHUNK):
+    """Compatibility score for each of the M pool charts: sum of weight x exactness."""
+    names, angles, orbs = _table(aspect_types)
+    weight_arr = np.array([weights.get(name, 0.0) for name in names])
+    lons = np.asarray(lons, dtype=np.float32)
+    pool_lons = np.asarray(pool_lons, dtype=np.float32)
+    scores = np.empty(len(pool_lons))
+    if not _non_overlapping(angles, orbs):
+        # Orbs overlap: each pair must pick its tightest aspect first.
+        weight_arr = np.append(weight_arr, 0.0)   # index -1 -> "no aspect" -> zero weight
+        for start in range(0, len(pool_lons), chunk):
+            index, exactness = synastry_matrix(lons, pool_lons[start:start + chunk], aspect_types)
+            scores[start:start + chunk] = (weight_arr[index] * exactness).sum(axis=(1, 2))
+        return scores
+
+    # Disjoint orbs: a pair can fall in at most one aspect, so each type
+    # contributes independently and no argmin over types is needed.
+    for start in range(0, len(pool_lons), chunk):
+        block = pool_lons[start:start + chunk]
+        sep = np.abs(_signed_diff(lons[None, :, None], block[:, None, :])).reshape(len(block), -1)
+        total = np.zeros(len(block))
+        for angle, orb, weight in zip(angles, orbs, weight_arr):
+            if weight:
+                exactness = np.maximum(np.float32(1) - np.abs(sep - np.float32(angle)) / np.float32(orb), 0)
+                total += weight * exactness.sum(axis=1, dtype=np.float64)
+        scores[start:start + chunk] = total
+    return scores
+
+
+def rank_synastry(lons, pool_lons, top=10, **kwargs):
+    """Indices and scores of the `top` best pool matches, best first."""
+    scores = synastry_scores(lons, pool_lons, **kwargs)
+    top = min(top, len(scores))
+    if top <= 0:
+        return np.array([], dtype=np.int64), np.array([])
+    best = np.argpartition(-scores, top - 1)[:top]
+    best = best[np.argsort(-scores[best], kind='stable')]
+    return best, scores[best]
@@ -0,0 +1,124 @@
+# -- coding: utf-8 --
+"""
+Shared astrological constants and chart math used by the web app, the
+chart renderers and the command-line tools.
+"""
+import logging
+from bisect import bisect_right
+
+import swisseph as swe
+
+PLANET_SYMBOLS = {
+    "Sun": "☉", "Moon": "☽", "Mercury": "☿", "Venus": "♀",
+    "Mars": "♂", "Jupiter": "♃", "Saturn": "♄", "Uranus": "♅",
+    "Neptune": "♆", "Pluto": "♇", "Rahu": "☊", "Ketu": "☋"
+}
+PLANET_NAMES_ARABIC = {
+    "Sun": "الشمس", "Moon": "القمر", "Mercury": "عطارد", "Venus": "الزهرة",
+    "Mars": "المريخ", "Jupiter": "المشتري", "Saturn": "زحل", "Uranus": "أورانوس",
+    "Neptune": "نبتون", "Pluto": "بلوتو", "Rahu": "الرأس (راهو)", "Ketu": "الذنب (كيتو)"
+}
+SIGN_SYMBOLS = {
+    "Aries": "♈", "Taurus": "♉", "Gemini": "♊", "Cancer": "♋",
+    "Leo": "♌", "Virgo": "♍", "Libra": "♎", "Scorpio": "♏",
+    "Sagittarius": "♐", "Capricorn": "♑", "Aquarius": "♒", "Pisces": "♓"
+}
+SIGN_NAMES_ARABIC = [
+    "الحمل", "الثور", "الجوزاء", "السرطان", "الأسد", "العذراء",
+    "الميزان", "العقرب", "القوس", "الجدي", "الدلو", "الحوت"
+]
+SIGN_NAMES_ENGLISH = list(SIGN_SYMBOLS.keys())
+PLANET_IDS = {
+    "Sun": swe.SUN, "Moon": swe.MOON, "Mercury": swe.MERCURY,
+    "Venus": swe.VENUS, "Mars": swe.MARS, "Jupiter": swe.JUPITER,
+    "Saturn": swe.SATURN, "Uranus": swe.URANUS, "Neptune": swe.NEPTUNE,
+    "Pluto": swe.PLUTO
+}
+HOUSE_NAMES_ARABIC = [
+    "الأول (الطالع)", "الثاني", "الثالث", "الرابع (قاع السماء)", "الخامس", "السادس",
+    "السابع (الهابط)", "الثامن", "التاسع", "العاشر (وسط السماء)", "الحادي عشر", "الثاني عشر"
+]
+
+def get_zodiac_info(deg):
+    """Convert degree to zodiac sign information."""
+    index = int(deg // 30) % 12
+    sign_en = SIGN_NAMES_ENGLISH[index]
+    degree_in_sign = deg % 30
+    return {
+        "sign_ar": SIGN_NAMES_ARABIC[index],
+        "sign_symbol": SIGN_SYMBOLS[sign_en],
+        "sign_index": index,
+        "degree_in_sign": degree_in_sign,
+        "sign_en": sign_en
+    }
+
+def house_offsets(houses_cusps):
+    """
+    The 12 cusps measured from the first one, in [0, 360), or None when
+    they do not increase from house 1 to house 12 (some quadrant systems
+    inside the polar circles). Increasing offsets let get_house_number
+    binary-search them; compute them once to place many bodies against
+    the same cusps.
+    """
+    first = houses_cusps[0] % 360
+    offsets = [(cusp - first) % 360 for cusp in houses_cusps[0:12]]
+    if any(offsets[i] >= offsets[i + 1] for i in range(11)):
+        return None
+    return offsets
+
+def _scan_house(lon_deg, cusps):
+    """Linear scan over the 12 houses; handles cusps in any order."""
+    lon_deg = lon_deg % 360
+    for i in range(12):
+        start = cusps[i] % 360
+        end = cusps[(i + 1) % 12] % 360
+
+        if start < end:
+            # Normal case: house doesn't cross 0°
+            if start <= lon_deg < end:
+                return i + 1
+        else:
+            # Wraparound case: house crosses 0° Aries
+            if lon_deg >= start or lon_deg < end:
+                return i + 1
+
+    return 1
+
+def get_house_number(lon_deg, houses_cusps, offsets=None):
+    """
+    Determine which house a celestial body is in based on its degree and house cusps.
+    CORRECTED: Uses houses_cusps[0:12] for proper indexing.
+    A body exactly on a cusp belongs to the house starting there. `offsets`
+    (from house_offsets) skips recomputing them for each body.
+    """
+    if len(houses_cusps) < 12:
+        return 1
+    if offsets is None:
+        offsets = house_offsets(houses_cusps)
+        if offsets is None:
+            return _scan_house(lon_deg, houses_cusps[0:12])
+    return bisect_right(offsets, (lon_deg - houses_cusps[0]) % 360)
+
+def assign_houses(positions, houses_cusps):
+    """{body: house} for {body: degree}, with the cusp offsets computed once."""
+    offsets = house_offsets(houses_cusps)
+    if offsets is None:
+        return {name: _scan_house(deg, houses_cusps[0:12]) for name, deg in positions.items()}
+    return {name: get_house_number(deg, houses_cusps, offsets) for name, deg in positions.items()}
+
+def calculate_aspects(planets_deg, speeds=None):
+    """Calculate major aspects between planets (see aspects.find_aspects)."""
+    from aspects import find_aspects   # numpy is imported on first use
+    return find_aspects(planets_deg, speeds)
+
+def get_planet_degree(jd_ut, pid):
+    """Get the degree position of a planet."""
+    try:
+        pos_calc = swe.calc_ut(jd_ut, pid, swe.FLG_SWIEPH)
+        if pos_calc and isinstance(pos_calc[0], (list, tuple)):
+            return pos_calc[0][0]
+        elif isinstance(pos_calc[0], (float, int)):
+            return pos_calc[0]
+    except Exception as e:
+        logging.error(f"Error calculating planet {pid}: {e}")
+    return -1.0
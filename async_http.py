@@ -0,0 +1,176 @@
+# -- coding: utf-8 --
+"""
+A small pooled HTTP/1.1 client for asyncio code (asgi.py).
+
+Connections are kept alive and reused per origin (scheme, host, port),
+with at most `max_per_host` open to one origin at a time. Every request
+has a deadline covering connect, send and the whole response. A reused
+connection that the server closed while it sat idle is retried once on a
+fresh connection. Only what the geocoder needs is supported: GET/POST
+with Content-Length or chunked responses, no redirects and no
+compression.
+
+The standard library has no asyncio HTTP client, and geopy's default
+urllib adapter opens a new connection (and TLS handshake) per request.
+"""
+import asyncio
+import json
+import ssl
+from collections import deque
+from urllib.parse import urlencode, urlsplit
+
+DEFAULT_TIMEOUT = 5.0
+
+
+class HTTPError(Exception):
+    """A non-2xx answer; .status holds the code."""
+
+    def __init__(self, status, reason):
+        super().__init__(f"HTTP {status} {reason}")
+        self.status = status
+
+
+class _Connection:
+    __slots__ = ('reader', 'writer')
+
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+
+    def usable(self):
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncHTTPPool:
+    def __init__(self, max_per_host=8, timeout=DEFAULT_TIMEOUT, user_agent='falaky_app'):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.user_agent = user_agent
+        self._idle = {}        # origin -> deque of idle _Connection
+        self._limits = {}      # origin -> asyncio.Semaphore
+        self._ssl = None
+        self.stats = {'requests': 0, 'connections_opened': 0, 'connections_reused': 0, 'timeouts': 0, 'errors': 0}
+
+    def _ssl_context(self):
+        if self._ssl is None:
+            self._ssl = ssl.create_default_context()
+        return self._ssl
+
+    async def _connect(self, origin):
+        scheme, host, port = origin
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self._ssl_context() if scheme == 'https' else None)
+        self.stats['connections_opened'] += 1
+        return _Connection(reader, writer)
+
+    def _checkout(self, origin):
+        idle = self._idle.get(origin)
+        while idle:
+            conn = idle.pop()
+            if conn.usable():
+                self.stats['connections_reused'] += 1
+                return conn
+            conn.close()
+        return None
+
+    async def request(self, method, url, params=None, headers=None, body=None, timeout=None):
+        """(status, {header: value}, body bytes) of one request; raises asyncio.TimeoutError past the deadline."""
+        parts = urlsplit(url)
+        origin = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = parts.path or '/'
+        query = '&'.join(filter(None, (parts.query, urlencode(params) if params else '')))
+        if query:
+            target += '?' + query
+        host = parts.netloc
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}", f"User-Agent: {self.user_agent}",
+                 "Accept-Encoding: identity", "Connection: keep-alive"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        if body is not None:
+            lines.append(f"Content-Length: {len(body)}")
+        payload = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b'')
+
+        limit = self._limits.setdefault(origin, asyncio.Semaphore(self.max_per_host))
+        self.stats['requests'] += 1
+        try:
+            async with limit:
+                return await asyncio.wait_for(self._exchange(origin, payload), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            raise
+        except Exception:
+            self.stats['errors'] += 1
+            raise
+
+    async def _exchange(self, origin, payload):
+        conn = self._checkout(origin)
+        reused = conn is not None
+        while True:
+            if conn is None:
+                conn = await self._connect(origin)
+            try:
+                conn.writer.write(payload)
+                await conn.writer.drain()
+                status, reason, headers, body, keep_alive = await self._read_response(conn.reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                if not reused:
+                    raise
+                # The server dropped the idle connection; once more on a new one.
+                conn, reused = None, False
+                continue
+            except BaseException:
+                conn.close()
+                raise
+            if keep_alive:
+                self._idle.setdefault(origin, deque()).append(conn)
+            else:
+                conn.close()
+            return status, headers, body
+
+    async def _read_response(self, reader):
+        status_line = (await reader.readuntil(b'\r\n')).decode('latin-1').rstrip('\r\n')
+        version, _, rest = status_line.partition(' ')
+        code, _, reason = rest.partition(' ')
+        headers = {}
+        while True:
+            line = (await reader.readuntil(b'\r\n')).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if code in ('204', '304'):
+            body = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readuntil(b'\r\n')) != b'\r\n':   # trailers
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            headers['connection'] = 'close'
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+        return int(code), reason, headers, body, keep_alive
+
+    async def get_json(self, url, params=None, headers=None, timeout=None):
+        status, _, body = await self.request('GET', url, params=params, headers=headers, timeout=timeout)
+        if not 200 <= status < 300:
+            raise HTTPError(status, body[:200].decode('utf-8', 'replace'))
+        return json.loads(body.decode('utf-8'))
+
+    async def close(self):
+        for idle in self._idle.values():
+            while idle:
+                idle.pop().close()
+        self._idle.clear()
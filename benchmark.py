@@ -0,0 +1,628 @@
+# -- coding: utf-8 --
+"""
+Reproducible benchmarks for the chart pipeline.
+
+Stage mode times each step of a chart separately over a fixed corpus of
+birth records: geocoding, ephemeris, houses, get_zodiac_info,
+get_house_number, calculate_aspects, the SVG and PNG renderers
+(create_chart_image), compute_chart and the full / POST. The corpus
+covers every house system, polar latitudes and DST-ambiguous or
+non-existent local times. compute_chart and the POST run on a cold
+ephemeris_cache (no shared tier, in-process tier cleared before every
+call); compute_chart_warm is the same chart with every position cached. Geocoding goes to a local stand-in server
+(geocode_stub) with a fresh cache file, so no run depends on Nominatim.
+
+    python benchmark.py stages --output bench.json
+    python benchmark.py stages --baseline bench.json --fail-on-regression
+
+Load mode starts gunicorn with each workers x threads configuration,
+drives it with concurrent keep-alive clients for a fixed time and
+reports requests/sec and latency percentiles.
+
+    python benchmark.py load --configs 1x1,2x1,2x4 --duration 10 --concurrency 8
+
+Startup mode measures, for FALAKY_STARTUP=lazy and =preload, the time
+from launching gunicorn to the first answered request, the first chart
+POST, and the RSS/PSS of the master and every worker once each has
+served charts.
+
+    python benchmark.py startup --workers 4
+
+Serving mode compares, in one process and at several stub geocoder
+latencies, the Flask app on a fixed pool of threads (as sync/gthread
+workers run it) with asgi.app on as many threads, under a mix of cached
+charts and charts for places only the geocoder knows. It reports
+throughput and the latency of the cached requests.
+
+    python benchmark.py serving --latencies-ms 0,100,300 --threads 4 --concurrency 32
+
+Results are JSON (medians in microseconds). Runs can be compared
+against a saved baseline, with a tolerance band for noise.
+"""
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+HOUSE_SYSTEMS = ('P', 'K', 'E', 'W', 'O', 'R', 'C', 'B', 'M', 'A')   # = chart_pipeline.HOUSE_SYSTEMS
+PLACES = (
+    ('القاهرة', 'مصر'), ('الرياض', 'السعودية'), ('Dubai', 'UAE'), ('London', 'United Kingdom'),
+    ('New York', 'United States'), ('Sydney', 'Australia'), ('Reykjavik', 'Iceland'),
+    # polar and high latitudes (the last ones resolve through the stub geocoder)
+    ('Tromso', 'Norway'), ('Murmansk', 'Russia'), ('Longyearbyen', 'Norway'),
+    ('Alert', 'Canada'), ('Utqiagvik', 'United States'), ('Ushuaia', 'Argentina'),
+)
+# (label, record) for local times around DST transitions.
+DST_CASES = (
+    ('ambiguous-new-york-dst', dict(year=2021, month=11, day=7, hour=1, minute=30, city='New York',
+                                    country='United States', dst_preference='true')),
+    ('ambiguous-new-york-std', dict(year=2021, month=11, day=7, hour=1, minute=30, city='New York',
+                                    country='United States', dst_preference='false')),
+    ('ambiguous-london', dict(year=2020, month=10, day=25, hour=1, minute=15, city='London',
+                              country='United Kingdom', dst_preference='true')),
+    ('ambiguous-sydney', dict(year=2021, month=4, day=4, hour=2, minute=45, city='Sydney',
+                              country='Australia', dst_preference='false')),
+    ('nonexistent-new-york', dict(year=2021, month=3, day=14, hour=2, minute=30, city='New York',
+                                  country='United States')),
+    ('nonexistent-cairo', dict(year=2023, month=4, day=28, hour=0, minute=30, city='القاهرة', country='مصر')),
+)
+
+
+def build_corpus():
+    """The fixed benchmark corpus: [(label, record)], identical on every run."""
+    corpus = []
+    for i, house_system in enumerate(HOUSE_SYSTEMS):
+        for j, (city, country) in enumerate(PLACES):
+            record = dict(year=1940 + (i * 7 + j * 3) % 80, month=1 + (i + j) % 12, day=1 + (i * 5 + j) % 28,
+                          hour=(i * 3 + j * 5) % 24, minute=(i * 11 + j * 7) % 60,
+                          city=city, country=country, house_system=house_system)
+            corpus.append((f"{house_system}-{j}", record))
+    corpus.extend(DST_CASES)
+    return corpus
+
+
+def _prepare_environment(stub, workdir):
+    """Point every cache and external service at local, throwaway resources."""
+    env = dict(stub.environ())
+    env.update({
+        'FALAKY_GEOCODE_CACHE': os.path.join(workdir, 'geocode.sqlite3'),
+        'FALAKY_EPHEMERIS_CACHE': os.path.join(workdir, 'ephemeris.sqlite3'),
+        'FALAKY_CHART_CACHE_DIR': '',
+        'FALAKY_TRACE_SAMPLE': '0',
+        'FALAKY_SERVER_TIMING': '0',
+        'FALAKY_RENDER_WORKERS': '0',
+        # The corpus is replayed many times: without this, every pass after
+        # the first would time form_context's memo instead of the charts.
+        'FALAKY_FORM_MEMO_ENTRIES': '0',
+    })
+    os.environ.update(env)
+    return env
+
+
+def summarize(samples):
+    """Per-call statistics in microseconds."""
+    if not samples:
+        return {'n': 0}
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    def pct(p):
+        return ordered[min(n - 1, int(round(p / 100.0 * (n - 1))))] * 1e6
+
+    return {'n': n, 'mean_us': round(sum(ordered) / n * 1e6, 2), 'median_us': round(pct(50), 2),
+            'p95_us': round(pct(95), 2), 'p99_us': round(pct(99), 2), 'min_us': round(ordered[0] * 1e6, 2)}
+
+
+def _time_calls(func, args_list, repeat, setup=None):
+    """Seconds per call; setup(), if given, runs untimed before each call."""
+    timings = []
+    perf = time.perf_counter
+    for _ in range(repeat):
+        for args in args_list:
+            if setup is not None:
+                setup()
+            start = perf()
+            func(*args)
+            timings.append(perf() - start)
+    return timings
+
+
+def run_stages(repeat=3, png_samples=5):
+    """Time every stage over the corpus; returns {stage: summary}."""
+    import geocoding
+    import swisseph as swe
+    from app import app
+    from birth_time_sweep import sweep_birth_window
+    from astro import calculate_aspects, get_house_number, get_zodiac_info
+    from chart_pipeline import (CHART_BODIES, EPHEMERIS_FLAGS, ChartContext, ChartInputError, compute_body_motion,
+                                compute_chart, compute_house_cusps, parse_birth_data)
+    from chart_png import create_chart_image
+    from chart_render import render_chart
+    from ephemeris_cache import ephemeris_cache
+
+    corpus = build_corpus()
+    births = [parse_birth_data(record) for _, record in corpus]
+    results, stages = {}, {}
+
+    # Geocoding: the first pass is cold (stub server + sqlite), later passes hit the caches.
+    places = sorted({(b['city'], b['country']) for b in births})
+    stages['geocode_cold'] = summarize(_time_calls(geocoding.geocode, places, 1))
+    stages['geocode_warm'] = summarize(_time_calls(geocoding.geocode, places, repeat))
+
+    charts, errors, failures = [], 0, {}
+    for (label, _), birth in zip(corpus, births):
+        try:
+            charts.append(compute_chart(birth, ChartContext()))
+        except ChartInputError:
+            errors += 1
+        except Exception as e:
+            failures[label] = f"{type(e).__name__}: {e}"
+    jds = [(chart['jd_ut'],) for chart in charts]
+    # Raw Swiss Ephemeris cost, then the same lookups through ephemeris_cache (warm by now).
+    stages['ephemeris'] = summarize(_time_calls(
+        lambda jd: [swe.calc_ut(jd, pid, EPHEMERIS_FLAGS) for pid in CHART_BODIES.values()], jds, repeat))
+    stages['ephemeris_cached'] = summarize(_time_calls(compute_body_motion, jds, repeat))
+    house_args = [(c['jd_ut'], c['latitude'], c['longitude'], c['house_system']) for c in charts]
+    stages['houses'] = summarize(_time_calls(
+        lambda jd, lat, lon, hsys: swe.houses_ex(jd, lat, lon, hsys.encode(), swe.FLG_SWIEPH), house_args, repeat))
+    stages['houses_cached'] = summarize(_time_calls(compute_house_cusps, house_args, repeat))
+    degrees = [(deg,) for chart in charts for deg in chart['planets_deg'].values()]
+    stages['get_zodiac_info'] = summarize(_time_calls(get_zodiac_info, degrees, repeat))
+    stages['get_house_number'] = summarize(_time_calls(
+        get_house_number, [(deg, chart['houses_deg']) for chart in charts for deg in chart['planets_deg'].values()],
+        repeat))
+    stages['calculate_aspects'] = summarize(_time_calls(
+        calculate_aspects, [(chart['planets_deg'], chart['planets_speed']) for chart in charts], repeat))
+    stages['compute_chart_warm'] = summarize(_time_calls(lambda b: _safe_chart(compute_chart, b),
+                                                         [(b,) for b in births], repeat))
+    sweeps = [(dict(b, start=0, end=24 * 60),) for b in births]
+    stages['birth_time_sweep'] = summarize(_time_calls(lambda r: _safe_chart(sweep_birth_window, r), sweeps, 1))
+
+    draw_args = [(c['planets_deg'], c['houses_deg'], c['angles']['AC']['degree']) for c in charts]
+    stages['render_svg'] = summarize(_time_calls(lambda *a: render_chart(*a, fmt='svg'), draw_args, repeat))
+    if png_samples:
+        stages['create_chart_image'] = summarize(_time_calls(create_chart_image, draw_args[:png_samples], 1))
+
+    client = app.test_client()
+    forms = [{k: str(v) for k, v in record.items()} for _, record in corpus]
+    # The loop above cached every position, so time these two cold: as with
+    # FALAKY_EPHEMERIS_CACHE='', and an empty in-process tier for each call.
+    shared_path = ephemeris_cache.path
+    ephemeris_cache.path = None
+    # The failures above would log a traceback on every request.
+    logging.disable(logging.ERROR)
+    try:
+        stages['compute_chart'] = summarize(_time_calls(lambda b: _safe_chart(compute_chart, b),
+                                                        [(b,) for b in births], repeat,
+                                                        setup=ephemeris_cache.clear_memory))
+        stages['post_index'] = summarize(_time_calls(lambda form: client.post('/', data=form),
+                                                     [(f,) for f in forms], repeat,
+                                                     setup=ephemeris_cache.clear_memory))
+    finally:
+        logging.disable(logging.NOTSET)
+        ephemeris_cache.path = shared_path
+
+    results['stages'] = stages
+    results['corpus'] = {'records': len(corpus), 'charts': len(charts), 'expected_errors': errors,
+                         'failures': failures, 'house_systems': len(HOUSE_SYSTEMS), 'places': len(places)}
+    results['geocoder'] = dict(geocoding.stats)
+    results['swisseph'] = swe.version
+    return results
+
+
+def _safe_chart(compute_chart, birth):
+    try:
+        return compute_chart(birth)
+    except Exception:
+        return None
+
+
+# -- load driver -----------------------------------------------------
+
+def _wait_ready(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/')
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def drive_load(port, bodies, duration, concurrency, warmup=20):
+    """POST the corpus to / from `concurrency` keep-alive clients for `duration` seconds."""
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def client(offset, deadline, record):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        local, failed, i = [], 0, offset
+        while time.monotonic() < deadline:
+            body = bodies[i % len(bodies)]
+            i += concurrency
+            start = time.perf_counter()
+            try:
+                conn.request('POST', '/', body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                ok = False
+            if ok:
+                local.append(time.perf_counter() - start)
+            else:
+                failed += 1
+        conn.close()
+        if record:
+            with lock:
+                latencies.extend(local)
+                errors[0] += failed
+
+    # Warm-up pass: first-request imports, geocode cache, TimezoneFinder.
+    client(0, time.monotonic() + max(1.0, warmup / 10.0), record=False)
+
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(k, deadline, True)) for k in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    summary = summarize(latencies)
+    return {'requests': len(latencies), 'errors': errors[0], 'seconds': round(elapsed, 2),
+            'rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(summary.get('median_us', 0) / 1000, 2),
+            'p90_ms': round(_percentile(latencies, 90) * 1000, 2),
+            'p99_ms': round(summary.get('p99_us', 0) / 1000, 2)}
+
+
+def _percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def run_load(configs, duration, concurrency, port, env):
+    bodies = [urlencode(record) for _, record in build_corpus()]
+    results = {}
+    for config in configs:
+        workers, _, threads = config.partition('x')
+        workers, threads = int(workers), int(threads or 1)
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+                   '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app']
+        server = subprocess.Popen(command, cwd=BASE_DIR, env=dict(os.environ, **env))
+        try:
+            if not _wait_ready(port):
+                results[config] = {'error': 'server did not start'}
+                continue
+            results[config] = drive_load(port, bodies, duration, concurrency)
+        finally:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        print(f"{config:>6s}  {json.dumps(results[config])}", file=sys.stderr)
+    return results
+
+
+def _children(pid):
+    """Direct child pids of a process (Linux /proc scan)."""
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The command name may contain spaces; the ppid is the 2nd field after ')'.
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return sorted(children)
+
+
+def _memory(pid):
+    from startup import pss_kb, rss_kb
+    return {'pid': pid, 'rss_kb': rss_kb(pid), 'pss_kb': pss_kb(pid)}
+
+
+def run_startup(modes, workers, port, env):
+    """Time-to-first-request and per-process memory for each startup mode."""
+    chart_body = urlencode(build_corpus()[0][1])
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    results = {}
+    for mode in modes:
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-w', str(workers),
+                   '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app']
+        started = time.monotonic()
+        server = subprocess.Popen(command, cwd=BASE_DIR, env=dict(os.environ, **env, FALAKY_STARTUP=mode))
+        try:
+            if not _wait_ready(port, timeout=120):
+                results[mode] = {'error': 'server did not start'}
+                continue
+            ttfr = time.monotonic() - started
+
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            start = time.perf_counter()
+            conn.request('POST', '/', body=chart_body, headers=headers)
+            conn.getresponse().read()
+            first_chart = time.perf_counter() - start
+            # Enough fresh connections that every worker serves (and lazily loads) charts.
+            for _ in range(workers * 4):
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                conn.request('POST', '/', body=chart_body, headers=headers)
+                conn.getresponse().read()
+                conn.close()
+            time.sleep(0.5)
+
+            worker_memory = [_memory(pid) for pid in _children(server.pid)]
+            pss = [w['pss_kb'] for w in worker_memory if w['pss_kb'] is not None]
+            rss = [w['rss_kb'] for w in worker_memory if w['rss_kb'] is not None]
+            master = _memory(server.pid)
+            results[mode] = {
+                'ttfr_s': round(ttfr, 3),
+                'first_chart_ms': round(first_chart * 1000, 2),
+                'master': master,
+                'workers': worker_memory,
+                'worker_rss_avg_kb': round(sum(rss) / len(rss)) if rss else None,
+                'worker_pss_avg_kb': round(sum(pss) / len(pss)) if pss else None,
+                'total_pss_kb': sum(pss) + (master['pss_kb'] or 0) if pss else None,
+            }
+        finally:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        summary = {k: v for k, v in results[mode].items() if k not in ('master', 'workers')}
+        print(f"{mode:>8s}  {json.dumps(summary)}", file=sys.stderr)
+    return results
+
+
+# -- sync vs async serving -------------------------------------------
+
+class _ServingSamples:
+    """Latencies of ordinary (cached) and geocoder-bound requests."""
+
+    def __init__(self):
+        self.fast, self.slow, self.errors = [], [], 0
+        self.lock = threading.Lock()
+
+    def add(self, is_slow, elapsed, status):
+        with self.lock:
+            (self.slow if is_slow else self.fast).append(elapsed)
+            # An unknown place is a 400 once the geocoder has been asked.
+            self.errors += status not in (200, 400)
+
+    def summary(self, elapsed):
+        n = len(self.fast) + len(self.slow)
+        return {'requests': n, 'errors': self.errors, 'rps': round(n / elapsed, 1),
+                'fast_p50_ms': round(_percentile(self.fast, 50) * 1000, 2),
+                'fast_p99_ms': round(_percentile(self.fast, 99) * 1000, 2),
+                'slow_p50_ms': round(_percentile(self.slow, 50) * 1000, 2)}
+
+
+def _sync_serving(app, bodies, slow_body, duration, concurrency, threads, slow_every):
+    """`concurrency` callers, each waiting for one of `threads` threads to run its whole request."""
+    from concurrent.futures import ThreadPoolExecutor
+    client = app.test_client()
+    samples = _ServingSamples()
+
+    def post(body):
+        return client.post('/api/chart', data=body, content_type='application/json').status_code
+
+    def caller(i, deadline):
+        while time.monotonic() < deadline:
+            is_slow = i % slow_every == 0
+            start = time.perf_counter()
+            status = workers.submit(post, slow_body(i) if is_slow else bodies[i % len(bodies)]).result()
+            samples.add(is_slow, time.perf_counter() - start, status)
+            i += concurrency
+
+    with ThreadPoolExecutor(threads) as workers:
+        deadline = time.monotonic() + duration
+        started = time.monotonic()
+        callers = [threading.Thread(target=caller, args=(k, deadline)) for k in range(concurrency)]
+        for thread in callers:
+            thread.start()
+        for thread in callers:
+            thread.join()
+        return samples.summary(time.monotonic() - started)
+
+
+async def _async_serving(app, bodies, slow_body, duration, concurrency, threads, slow_every):
+    """The same callers as tasks on one event loop, calling asgi.ASGIApp directly."""
+    import asyncio
+    import asgi
+    server = asgi.ASGIApp(app, threads=threads)
+    samples = _ServingSamples()
+
+    async def post(body):
+        messages, status = [{'type': 'http.request', 'body': body, 'more_body': False}], []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await asyncio.Event().wait()   # never disconnects
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status.append(message['status'])
+
+        scope = {'type': 'http', 'method': 'POST', 'path': '/api/chart', 'query_string': b'',
+                 'headers': [(b'content-type', b'application/json')]}
+        await server(scope, receive, send)
+        return status[0]
+
+    async def caller(i, deadline):
+        while time.monotonic() < deadline:
+            is_slow = i % slow_every == 0
+            start = time.perf_counter()
+            status = await post(slow_body(i) if is_slow else bodies[i % len(bodies)])
+            samples.add(is_slow, time.perf_counter() - start, status)
+            i += concurrency
+
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    await asyncio.gather(*(caller(k, deadline) for k in range(concurrency)))
+    elapsed = time.monotonic() - started
+    await server.close()
+    return samples.summary(elapsed)
+
+
+def run_serving(stub, latencies_ms, duration, concurrency, threads, slow_every):
+    """
+    In-process comparison at each geocoder latency: the Flask app on a pool
+    of `threads` threads (as a gunicorn gthread worker runs it) against
+    asgi.app on as many threads, both driven by `concurrency` callers.
+    Every slow_every-th request names a place no cache knows, so it goes
+    to the stub geocoder.
+    """
+    import asyncio
+    from app import app
+
+    corpus = build_corpus()
+    client = app.test_client()
+    results = {}
+    logging.disable(logging.ERROR)
+    try:
+        # Warm the caches both servers share; keep the records that chart (not the polar failures).
+        bodies = [body for body in (json.dumps(record).encode('utf-8') for _, record in corpus)
+                  if client.post('/api/chart', data=body, content_type='application/json').status_code == 200]
+        for latency in latencies_ms:
+            stub.server.latency = latency / 1000.0
+            row = {}
+            for mode in ('sync', 'async'):
+                def slow_body(i, tag=f"{mode}-{latency:g}"):
+                    return json.dumps(dict(corpus[0][1], city=f"Nowhere {tag} {i}")).encode('utf-8')
+                args = (app, bodies, slow_body, duration, concurrency, threads, slow_every)
+                row[mode] = _sync_serving(*args) if mode == 'sync' else asyncio.run(_async_serving(*args))
+                print(f"{latency:>6g} ms {mode:>5s}  {json.dumps(row[mode])}", file=sys.stderr)
+            results[f"{latency:g}ms"] = row
+    finally:
+        logging.disable(logging.NOTSET)
+    return results
+
+
+# -- reporting -------------------------------------------------------
+
+def compare(current, baseline, tolerance):
+    """{stage: (baseline_median, current_median, ratio, verdict)} for stages in both runs."""
+    report = {}
+    for stage, stats in current.get('stages', {}).items():
+        before = baseline.get('stages', {}).get(stage, {}).get('median_us')
+        after = stats.get('median_us')
+        if not before or after is None:
+            continue
+        ratio = after / before
+        verdict = 'slower' if ratio > 1 + tolerance else 'faster' if ratio < 1 - tolerance else 'same'
+        report[stage] = (before, after, round(ratio, 3), verdict)
+    return report
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chart pipeline.")
+    parser.add_argument('mode', choices=('stages', 'load', 'startup', 'serving'))
+    parser.add_argument('--output', help="write the results JSON here")
+    parser.add_argument('--baseline', help="compare with a previous results JSON")
+    parser.add_argument('--tolerance', type=float, default=0.10, help="relative noise band (default 0.10)")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--png-samples', type=int, default=5)
+    parser.add_argument('--geocoder-latency-ms', type=float, default=0.0)
+    parser.add_argument('--configs', default='1x1,2x1,2x4', help="gunicorn WORKERSxTHREADS list")
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers for startup mode")
+    parser.add_argument('--startup-modes', default='lazy,preload')
+    parser.add_argument('--latencies-ms', default='0,100,300', help="geocoder latencies for serving mode")
+    parser.add_argument('--threads', type=int, default=4, help="request threads for serving mode")
+    parser.add_argument('--slow-every', type=int, default=8, help="every Nth serving request is a geocoder miss")
+    args = parser.parse_args(argv)
+
+    from geocode_stub import StubGeocoder
+
+    with tempfile.TemporaryDirectory(prefix='falaky-bench-') as workdir, \
+            StubGeocoder(latency=args.geocoder_latency_ms / 1000.0) as stub:
+        env = _prepare_environment(stub, workdir)
+        results = {'meta': {
+            'mode': args.mode,
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        }}
+        if args.mode == 'stages':
+            results['meta'].update(repeat=args.repeat)
+            results.update(run_stages(args.repeat, args.png_samples))
+        elif args.mode == 'load':
+            results['meta'].update(duration=args.duration, concurrency=args.concurrency)
+            results['load'] = run_load(args.configs.split(','), args.duration, args.concurrency, args.port, env)
+        elif args.mode == 'startup':
+            results['meta'].update(workers=args.workers)
+            results['startup'] = run_startup(args.startup_modes.split(','), args.workers, args.port, env)
+        else:
+            results['meta'].update(duration=args.duration, concurrency=args.concurrency, threads=args.threads,
+                                   slow_every=args.slow_every)
+            results['serving'] = run_serving(stub, [float(ms) for ms in args.latencies_ms.split(',')],
+                                             args.duration, args.concurrency, args.threads, args.slow_every)
+        results['geocoder_stub_requests'] = stub.requests
+
+    for stage, stats in results.get('stages', {}).items():
+        print(f"{stage:20s} n={stats['n']:6d}  median {stats['median_us']:12.2f} us  p95 {stats['p95_us']:12.2f} us")
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        results['comparison'] = {'baseline': args.baseline, 'tolerance': args.tolerance, 'stages': {}}
+        for stage, (before, after, ratio, verdict) in compare(results, baseline, args.tolerance).items():
+            results['comparison']['stages'][stage] = {'baseline_us': before, 'current_us': after,
+                                                      'ratio': ratio, 'verdict': verdict}
+            print(f"{stage:20s} {before:12.2f} -> {after:12.2f} us  x{ratio:<6}  {verdict}")
+            if verdict == 'slower':
+                regressions.append(stage)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if regressions and args.fail_on_regression:
+        print(f"Regressions: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
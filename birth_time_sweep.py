@@ -0,0 +1,307 @@
+# -- coding: utf-8 --
+"""
+Unknown birth time: sweep a window of a day at one-minute resolution.
+
+sweep_birth_window() takes a date, a place and a local time window and
+reports how the chart changes across it: the minutes where the rising
+sign, the MC sign, a body's house or a body's sign changes, plus a
+compact timeline of those segments. Each minute gives the same answer
+compute_chart() would give for that birth time.
+
+The work is split by how fast things move:
+
+* the bodies are read from the ephemeris table (ephemeris_table.py)
+  when it covers the window. Without it, the slow bodies (everything
+  but the Moon) are computed every twelve hours (three times for a full
+  day) and interpolated in between, and the Moon once an hour and
+  interpolated the same way;
+* the angles and house cusps move a degree every four minutes, so they
+  are recomputed for every minute. ARMC and obliquity are vectorized;
+  for Equal, Whole Sign and Porphyry the angles and cusps come from
+  closed formulas, and only the other quadrant systems call
+  swe.houses_armc once per minute;
+* house placement is one vectorized pass (bulk_ephemeris.assign_houses,
+  the array form of astro.get_house_number).
+
+A 24-hour window takes a few tens of milliseconds.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+import swisseph as swe
+
+from astro import PLANET_IDS, PLANET_NAMES_ARABIC, get_zodiac_info
+from bulk_ephemeris import assign_houses, signs, whole_sign_cusps
+from chart_pipeline import (
+    CHART_BODIES, EPHEMERIS_FLAGS, HOUSE_SYSTEMS, ChartContext, ChartInputError, _calc_motion, compute_body_motion,
+)
+from ephemeris_table import covering_table
+from instrumentation import span
+
+SWEEP_BODIES = list(CHART_BODIES) + ['Ketu']
+FAST_BODIES = ('Moon',)
+# Sample spacing; cubic interpolation between samples stays well under an arcsecond.
+SLOW_KNOT_HOURS = 12.0
+FAST_KNOT_HOURS = 1.0
+MINUTES_PER_DAY = 24 * 60
+SIDEREAL_HOURS_PER_DAY = 24.0 * 1.00273790935
+
+
+def _parse_clock(value, default):
+    """'HH:MM' -> minutes after midnight; '24:00' is the end of the day."""
+    if value in (None, ''):
+        return default
+    try:
+        hour, minute = (int(part) for part in str(value).split(':'))
+    except ValueError:
+        raise ChartInputError(f"الوقت يجب أن يكون بصيغة HH:MM: {value}")
+    if not (0 <= hour <= 24 and 0 <= minute < 60) or (hour == 24 and minute):
+        raise ChartInputError(f"الوقت غير صالح: {value}")
+    return hour * 60 + minute
+
+
+def parse_sweep_request(data):
+    """Validate {year, month, day, city, country, start, end, house_system, dst_preference}."""
+    missing = [field for field in ('year', 'month', 'day', 'city', 'country') if data.get(field) in (None, '')]
+    if missing:
+        raise ChartInputError(f"بيانات الميلاد غير مكتملة. الحقول الناقصة: {', '.join(missing)}")
+    try:
+        record = {field: int(data[field]) for field in ('year', 'month', 'day')}
+        datetime(record['year'], record['month'], record['day'])
+    except (TypeError, ValueError):
+        raise ChartInputError("التاريخ المدخل غير صالح.")
+    record['city'] = str(data['city']).strip()
+    record['country'] = str(data['country']).strip()
+    record['start'] = _parse_clock(data.get('start'), 0)
+    record['end'] = _parse_clock(data.get('end'), MINUTES_PER_DAY)
+    if record['end'] <= record['start']:
+        raise ChartInputError("نهاية النافذة الزمنية يجب أن تكون بعد بدايتها.")
+
+    house_system = str(data.get('house_system') or 'P')
+    if house_system not in HOUSE_SYSTEMS:
+        raise ChartInputError(f"نظام البيوت غير معروف: {house_system}")
+    record['house_system'] = house_system
+    dst_preference = data.get('dst_preference', 'true')
+    record['prefers_dst'] = dst_preference is True or str(dst_preference).lower() == 'true'
+    return record
+
+
+def _utc_offsets(timezone_str, midnight, minutes, prefers_dst):
+    """
+    UTC offset in minutes of each local minute, NaN where the wall-clock
+    time does not exist (spring forward). Ambiguous minutes use
+    prefers_dst, like timezone_service.localize.
+    """
+    tz = pytz.timezone(timezone_str)
+
+    def offset(minute):
+        """The offset of an unambiguous, existing local minute; None otherwise."""
+        try:
+            return tz.localize(midnight + timedelta(minutes=minute), is_dst=None).utcoffset()
+        except (pytz.exceptions.NonExistentTimeError, pytz.exceptions.AmbiguousTimeError):
+            return None
+
+    first = offset(int(minutes[0]))
+    if first is not None and first == offset(int(minutes[-1])):
+        # No transition inside the window: one offset for every minute.
+        return np.full(len(minutes), first.total_seconds() / 60.0)
+
+    offsets = np.empty(len(minutes))
+    for i, minute in enumerate(minutes.tolist()):
+        naive = midnight + timedelta(minutes=minute)
+        try:
+            local = tz.localize(naive, is_dst=None)
+        except pytz.exceptions.NonExistentTimeError:
+            offsets[i] = np.nan
+            continue
+        except pytz.exceptions.AmbiguousTimeError:
+            local = tz.localize(naive, is_dst=prefers_dst)
+        offsets[i] = local.utcoffset().total_seconds() / 60.0
+    return offsets
+
+
+def _hermite(jd, knots, lons, speeds):
+    """Cubic Hermite interpolation of longitudes sampled at evenly spaced knots."""
+    step = knots[1] - knots[0]
+    pos = (jd - knots[0]) / step
+    idx = np.minimum(np.floor(pos).astype(np.int64), len(knots) - 2)
+    t = pos - idx
+    p0, v0, v1 = lons[idx], speeds[idx] * step, speeds[idx + 1] * step
+    delta = (lons[idx + 1] - p0 + 180.0) % 360.0 - 180.0
+    t2, t3 = t * t, t * t * t
+    return (p0 + (t3 - 2 * t2 + t) * v0 + (-2 * t3 + 3 * t2) * delta + (t3 - t2) * v1) % 360.0
+
+
+def _knots(jd, hours):
+    """Evenly spaced instants from jd[0] past jd[-1], `hours` apart."""
+    step = hours / 24.0
+    return jd[0] + step * np.arange(int(np.ceil((jd[-1] - jd[0]) / step)) + 2)
+
+
+def body_longitudes(jd):
+    """Longitudes [N, B] of SWEEP_BODIES for a sorted array of Julian days (UT)."""
+    table = covering_table(jd[0], jd[-1])
+    if table is not None:
+        lons = table.lookup(jd, SWEEP_BODIES[:-1])[0]   # SWEEP_BODIES ends with Ketu, opposite Rahu
+        return np.column_stack([lons, (lons[:, SWEEP_BODIES.index('Rahu')] + 180.0) % 360.0])
+
+    lons = np.empty((len(jd), len(SWEEP_BODIES)))
+    slow = [b for b, name in enumerate(SWEEP_BODIES) if name not in FAST_BODIES]
+    knots = _knots(jd, SLOW_KNOT_HOURS)
+    motion = [compute_body_motion(t) for t in knots.tolist()]
+    for b in slow:
+        name = SWEEP_BODIES[b]
+        lons[:, b] = _hermite(jd, knots, np.array([m[0][name] for m in motion]),
+                              np.array([m[1][name] for m in motion]))
+
+    knots = _knots(jd, FAST_KNOT_HOURS)
+    for name in FAST_BODIES:
+        motion = np.array([_calc_motion(t, PLANET_IDS[name], EPHEMERIS_FLAGS) for t in knots.tolist()])
+        lons[:, SWEEP_BODIES.index(name)] = _hermite(jd, knots, motion[:, 0], motion[:, 1])
+    return lons
+
+
+def _angles(armc, lat, eps):
+    """Ascendant and MC for arrays of ARMC (degrees), as swe.houses_armc computes them."""
+    ra, e, phi = np.radians(armc), np.radians(eps), np.radians(lat)
+    mc = np.degrees(np.arctan2(np.sin(ra), np.cos(ra) * np.cos(e))) % 360.0
+    asc = np.degrees(np.arctan2(np.cos(ra), -(np.sin(ra) * np.cos(e) + np.tan(phi) * np.sin(e)))) % 360.0
+    if abs(lat) >= 90.0 - eps:
+        # Inside the polar circles the formula can give the descendant; keep the ascendant east of the MC.
+        west = (asc - mc) % 360.0 > 180.0
+        asc[west] = (asc[west] + 180.0) % 360.0
+    return asc, mc
+
+
+def house_cusps(jd, lat, lon, house_system):
+    """(cusps[N, 12], asc[N], mc[N]) at one place for an array of Julian days (UT)."""
+    # Sidereal time is linear over a day to far below an arcsecond; nutation barely moves.
+    span_days = float(jd[-1] - jd[0])
+    sid0, sid1 = swe.sidtime(float(jd[0])), swe.sidtime(float(jd[-1]))
+    turns = round((SIDEREAL_HOURS_PER_DAY * span_days - (sid1 - sid0)) / 24.0)
+    rate = (sid1 - sid0 + 24.0 * turns) / span_days if span_days else 0.0
+    armc = ((sid0 + rate * (jd - jd[0])) * 15.0 + lon) % 360.0
+    eps = swe.calc_ut(float((jd[0] + jd[-1]) / 2), swe.ECL_NUT)[0][0]
+    asc, mc = _angles(armc, lat, eps)
+
+    if house_system == 'W':
+        cusps = whole_sign_cusps(asc)
+    elif house_system in ('E', 'A'):
+        cusps = (asc[:, None] + 30.0 * np.arange(12)) % 360.0
+    elif house_system == 'O':
+        # Porphyry: each quadrant between the angles split in three.
+        east = (asc - mc) % 360.0 / 3.0
+        west = 60.0 - east
+        cusps = np.empty((len(jd), 12))
+        cusps[:, 9], cusps[:, 10], cusps[:, 11] = mc, mc + east, mc + 2 * east
+        cusps[:, 0], cusps[:, 1], cusps[:, 2] = asc, asc + west, asc + 2 * west
+        cusps[:, 3:9] = cusps[:, [9, 10, 11, 0, 1, 2]] + 180.0
+        cusps %= 360.0
+    else:
+        hsys = house_system.encode()
+        houses_armc = swe.houses_armc
+        cusps = np.empty((len(jd), 12))
+        try:
+            for i, a in enumerate(armc.tolist()):
+                c, ascmc = houses_armc(a, lat, eps, hsys)
+                cusps[i], asc[i], mc[i] = c[:12], ascmc[0], ascmc[1]
+        except swe.Error:
+            raise ChartInputError("نظام البيوت المختار لا يعمل عند خط العرض هذا. جرّب نظاماً آخر (مثل Whole Sign أو Porphyry).")
+    return cusps, asc, mc
+
+
+def _clock(minute):
+    return f"{int(minute) // 60:02d}:{int(minute) % 60:02d}"
+
+
+def _segments(values, minutes, describe):
+    """Collapse a per-minute series into [{start, end, ...}] runs (end exclusive)."""
+    edges = np.flatnonzero(values[1:] != values[:-1]) + 1
+    starts = np.concatenate(([0], edges))
+    ends = np.concatenate((edges, [len(values)]))
+    return [dict(start=_clock(minutes[s]), end=_clock(minutes[e - 1] + 1), **describe(values[s]))
+            for s, e in zip(starts.tolist(), ends.tolist())]
+
+
+def _sign_fields(index):
+    info = get_zodiac_info(int(index) * 30.0)
+    return {"sign_en": info['sign_en'], "sign_ar": info['sign_ar']}
+
+
+def _changes(kind, values, minutes, utc, describe, body=None):
+    events = []
+    for i in (np.flatnonzero(values[1:] != values[:-1]) + 1).tolist():
+        event = {"time": _clock(minutes[i]), "utc_time": utc[i], "kind": kind}
+        if body is not None:
+            event["body"] = body
+        event["from"], event["to"] = describe(values[i - 1]), describe(values[i])
+        events.append(event)
+    return events
+
+
+def sweep_birth_window(request, context=None):
+    """
+    Sweep a parsed request (see parse_sweep_request) minute by minute.
+    Raises ChartInputError for unknown places, windows that fall entirely
+    in a DST gap and house systems that fail at the latitude.
+    """
+    context = context or ChartContext()
+    location = context.resolve_location(request['city'], request['country'])
+    if location is None:
+        raise ChartInputError("لم نتمكن من العثور على المدينة/الدولة المدخلة. تحقق من الإملاء.")
+    lat, lon, timezone_str = location
+    if not timezone_str:
+        raise ChartInputError("لم يتم العثور على منطقة زمنية لهذا الموقع.")
+
+    midnight = datetime(request['year'], request['month'], request['day'])
+    minutes = np.arange(request['start'], request['end'])
+    with span('timezone'):
+        offsets = _utc_offsets(timezone_str, midnight, minutes, request['prefers_dst'])
+    missing = np.isnan(offsets)
+    gaps = _segments(missing, minutes, lambda gap: {"gap": bool(gap)})
+    gaps = [{"start": g["start"], "end": g["end"]} for g in gaps if g["gap"]]
+    if missing.all():
+        raise ChartInputError("كل دقائق النافذة الزمنية غير موجودة في هذا التاريخ بسبب التوقيت الصيفي.")
+    minutes, offsets = minutes[~missing], offsets[~missing]
+
+    utc_minutes = minutes - offsets
+    jd = swe.julday(midnight.year, midnight.month, midnight.day, 0.0) + utc_minutes / MINUTES_PER_DAY
+    utc = [(midnight + timedelta(minutes=m)).strftime("%Y-%m-%d %H:%M") for m in utc_minutes.tolist()]
+
+    with span('planets'):
+        lons = body_longitudes(jd)
+    with span('houses'):
+        cusps, asc, mc = house_cusps(jd, lat, lon, request['house_system'])
+        houses = assign_houses(lons, cusps)
+    asc_sign, mc_sign, body_signs = signs(asc), signs(mc), signs(lons)
+
+    changes = _changes('ascendant', asc_sign, minutes, utc, _sign_fields)
+    changes += _changes('mc', mc_sign, minutes, utc, _sign_fields)
+    timeline = {
+        "ascendant": _segments(asc_sign, minutes, _sign_fields),
+        "mc": _segments(mc_sign, minutes, _sign_fields),
+        "houses": {},
+        "signs": {},
+    }
+    for b, name in enumerate(SWEEP_BODIES):
+        changes += _changes('house', houses[:, b], minutes, utc, int, name)
+        timeline["houses"][name] = _segments(houses[:, b], minutes, lambda h: {"house": int(h)})
+        if (body_signs[:, b] != body_signs[0, b]).any():
+            changes += _changes('sign', body_signs[:, b], minutes, utc, _sign_fields, name)
+        timeline["signs"][name] = _segments(body_signs[:, b], minutes, _sign_fields)
+    changes.sort(key=lambda event: (event["utc_time"], event["kind"] != 'ascendant'))
+
+    return {
+        "date": midnight.strftime("%Y-%m-%d"),
+        "location": f"{request['city']}, {request['country']}",
+        "latitude": lat,
+        "longitude": lon,
+        "timezone": timezone_str,
+        "house_system": request['house_system'],
+        "window": {"start": _clock(request['start']), "end": _clock(request['end']), "minutes": int(len(minutes))},
+        "gaps": gaps,
+        "bodies": {name: PLANET_NAMES_ARABIC.get(name, name) for name in SWEEP_BODIES},
+        "changes": changes,
+        "timeline": timeline,
+    }
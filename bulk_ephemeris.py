@@ -0,0 +1,365 @@
+# -- coding: utf-8 --
+"""
+Bulk ephemeris engine for large sets of birth records.
+
+compute_bulk() takes arrays of Julian days (and optionally latitudes and
+longitudes) and returns NumPy arrays of body longitudes, signs, houses
+and angles. Swiss Ephemeris has no array interface, so positions are
+still one C call per (body, time), but everything around them (sign and
+house assignment, Whole Sign cusps, Ketu) is vectorized.
+
+Run as a script to stream a CSV (or Parquet, with pyarrow installed) file
+of birth records through the engine in chunks, optionally across a pool
+of worker processes:
+
+    python bulk_ephemeris.py births.csv charts.csv --workers 4 --chunk-size 5000
+
+Input columns: optional ``id``, then either ``jd_ut`` or ``year, month,
+day, hour, minute`` (local time, with ``timezone`` or resolved from the
+coordinates), and ``lat``/``lon`` (or ``city``/``country``) for houses.
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import swisseph as swe
+
+from astro import PLANET_IDS
+
+BODY_IDS = dict(PLANET_IDS, Rahu=swe.MEAN_NODE)
+BODY_NAMES = list(BODY_IDS) + ['Ketu']
+
+
+def body_longitudes(jd, flags=swe.FLG_SWIEPH, errors=None):
+    """
+    Return {body: longitudes} for an array of Julian days (UT). With an
+    `errors` dict, a time Swiss Ephemeris rejects (e.g. outside the
+    installed ephemeris files) gets NaN and its message stored under its
+    index instead of raising.
+    """
+    jd = np.asarray(jd, dtype=np.float64)
+    out = {}
+    for name, pid in BODY_IDS.items():
+        lons = np.empty(jd.shape[0], dtype=np.float64)
+        calc = swe.calc_ut
+        for i, t in enumerate(jd.tolist()):
+            try:
+                lons[i] = calc(t, pid, flags)[0][0]
+            except swe.Error as e:
+                if errors is None:
+                    raise
+                errors.setdefault(i, f"{name} failed at jd {t}: {e}")
+                lons[i] = np.nan
+        out[name] = lons
+    out['Ketu'] = (out['Rahu'] + 180.0) % 360.0
+    return out
+
+
+def house_cusps(jd, lat, lon, house_system='P', errors=None):
+    """
+    Return (cusps[N, 12], asc[N], mc[N]) for arrays of times and places.
+    With an `errors` dict, a row Swiss Ephemeris rejects (Placidus or Koch
+    inside the polar circles) is filled with NaN and its message stored
+    under its index instead of raising.
+    """
+    jd = np.asarray(jd, dtype=np.float64)
+    lat = np.broadcast_to(np.asarray(lat, dtype=np.float64), jd.shape)
+    lon = np.broadcast_to(np.asarray(lon, dtype=np.float64), jd.shape)
+    n = jd.shape[0]
+    cusps = np.empty((n, 12), dtype=np.float64)
+    ascmc = np.empty((n, 2), dtype=np.float64)
+    hsys = house_system.encode()
+    houses_ex = swe.houses_ex
+    for i, (t, la, lo) in enumerate(zip(jd.tolist(), lat.tolist(), lon.tolist())):
+        try:
+            c, a = houses_ex(t, la, lo, hsys, swe.FLG_SWIEPH)
+        except swe.Error as e:
+            if errors is None:
+                raise
+            errors[i] = f"house system {house_system} failed at latitude {la}: {e}"
+            cusps[i] = ascmc[i] = np.nan
+            continue
+        cusps[i] = c[:12]
+        ascmc[i] = a[:2]
+    if house_system == 'W':
+        cusps = whole_sign_cusps(ascmc[:, 0])
+    return cusps, ascmc[:, 0], ascmc[:, 1]
+
+
+def whole_sign_cusps(asc):
+    """Whole Sign cusps: house 1 starts at 0 degrees of the ascendant's sign."""
+    first = np.floor(np.asarray(asc) / 30.0) * 30.0
+    return (first[:, None] + 30.0 * np.arange(12)) % 360.0
+
+
+def signs(lons):
+    """Sign index (0 = Aries) for an array of longitudes (NaN rows give an arbitrary index)."""
+    with np.errstate(invalid='ignore'):
+        return (np.floor(np.asarray(lons) / 30.0).astype(np.int64)) % 12
+
+
+def assign_houses(lons, cusps):
+    """
+    House number (1-12) of each longitude, vectorized over rows of cusps.
+    Same convention as astro.get_house_number: a body on a cusp belongs to
+    the house starting there.
+    """
+    lons = np.asarray(lons, dtype=np.float64)
+    cusps = np.asarray(cusps, dtype=np.float64)
+    if cusps.ndim == 1:
+        cusps = np.broadcast_to(cusps, (lons.shape[0], 12))
+    start = cusps[:, :1]
+    # Measure everything from the first cusp so each row is increasing in [0, 360).
+    offsets = (cusps - start) % 360.0
+    body = ((lons[:, None] if lons.ndim == 1 else lons) - start) % 360.0
+    if lons.ndim == 1:
+        houses = np.sum(offsets <= body, axis=1)
+    else:
+        houses = np.sum(offsets[:, None, :] <= body[:, :, None], axis=2)
+    # Inside the polar circles some systems give cusps that run backwards.
+    irregular = np.any(np.diff(offsets, axis=1) <= 0, axis=1)
+    if irregular.any():
+        houses[irregular] = _scan_houses(lons[irregular], cusps[irregular])
+    return houses
+
+
+def _scan_houses(lons, cusps):
+    """astro's linear 12-house scan, vectorized, for rows of cusps in any order."""
+    start = cusps % 360.0
+    end = np.roll(start, -1, axis=1)
+    x = (lons % 360.0)[..., None]
+    if lons.ndim == 2:
+        start, end = start[:, None, :], end[:, None, :]
+    inside = np.where(start < end, (start <= x) & (x < end), (x >= start) | (x < end))
+    return np.where(inside.any(axis=-1), inside.argmax(axis=-1) + 1, 1)
+
+
+def house_columns(jd, lat, lon, house_system, lons, errors=None):
+    """Cusps, angles and per-body houses for given body longitudes {name: array}; see house_cusps for `errors`."""
+    cusps, asc, mc = house_cusps(jd, lat, lon, house_system, errors)
+    result = {'asc': asc, 'mc': mc, 'asc_sign': signs(asc), 'mc_sign': signs(mc)}
+    body_matrix = np.stack([lons[name] for name in BODY_NAMES], axis=1)
+    houses = assign_houses(body_matrix, cusps)
+    for i, name in enumerate(BODY_NAMES):
+        result[f'{name}_house'] = houses[:, i]
+    for i in range(12):
+        result[f'cusp{i + 1}'] = cusps[:, i]
+    return result
+
+
+def compute_bulk(jd, lat=None, lon=None, house_system='P', errors=None):
+    """
+    Positions for every body at every time. With coordinates, also
+    house cusps, angles and house placements. See body_longitudes for
+    `errors`.
+    """
+    jd = np.asarray(jd, dtype=np.float64)
+    result = {'jd_ut': jd}
+    lons = body_longitudes(jd, errors=errors)
+    for name in BODY_NAMES:
+        result[f'{name}_lon'] = lons[name]
+        result[f'{name}_sign'] = signs(lons[name])
+    if lat is not None and lon is not None:
+        result.update(house_columns(jd, lat, lon, house_system, lons))
+    return result
+
+
+# --- record pipeline -------------------------------------------------
+
+def _float(value):
+    return float(value) if value not in (None, '') else None
+
+
+def record_to_jd_and_place(record):
+    """Resolve one input row to (jd_ut, lat, lon); raises ValueError on bad rows."""
+    lat, lon = _float(record.get('lat')), _float(record.get('lon'))
+    if lat is None and record.get('city'):
+        import geocoding
+        lat, lon = geocoding.geocode(record['city'], record.get('country'))
+        if lat is None:
+            raise ValueError(f"unknown place: {record['city']}, {record.get('country')}")
+
+    if record.get('jd_ut') not in (None, ''):
+        return float(record['jd_ut']), lat, lon
+
+    import timezone_service
+    naive_dt = datetime(int(record['year']), int(record['month']), int(record['day']),
+                        int(record['hour']), int(record['minute']))
+    timezone_str = record.get('timezone') or (
+        timezone_service.resolve_timezone(lat, lon, record.get('country') or '') if lat is not None else None)
+    if not timezone_str:
+        raise ValueError("no timezone (give 'timezone' or coordinates)")
+    prefers_dst = str(record.get('prefers_dst', 'true')).lower() == 'true'
+    utc_dt = timezone_service.localize(timezone_str, naive_dt, prefers_dst).utc_dt
+    jd_ut = swe.julday(utc_dt.year, utc_dt.month, utc_dt.day,
+                       utc_dt.hour + utc_dt.minute / 60.0 + utc_dt.second / 3600.0)
+    return jd_ut, lat, lon
+
+
+def process_chunk(records, house_system='P'):
+    """Compute one chunk of records; returns output rows (dicts) in input order."""
+    rows = [None] * len(records)
+    ok_index, jds, lats, lons = [], [], [], []
+    for i, record in enumerate(records):
+        try:
+            jd_ut, lat, lon = record_to_jd_and_place(record)
+        except Exception as e:
+            rows[i] = {'id': record.get('id', ''), 'error': str(e)}
+            continue
+        ok_index.append(i)
+        jds.append(jd_ut)
+        lats.append(np.nan if lat is None else lat)
+        lons.append(np.nan if lon is None else lon)
+
+    if ok_index:
+        jd_arr, lat_arr, lon_arr = np.array(jds), np.array(lats), np.array(lons)
+        body_errors = {}
+        data = compute_bulk(jd_arr, errors=body_errors)
+        # Rows without a place get positions only; the rest also get houses.
+        placed = np.flatnonzero(~np.isnan(lat_arr))
+        slot = np.full(len(ok_index), -1)
+        slot[placed] = np.arange(len(placed))
+        houses, house_errors = {}, {}
+        if len(placed):
+            body_lons = {name: data[f'{name}_lon'][placed] for name in BODY_NAMES}
+            houses = house_columns(jd_arr[placed], lat_arr[placed], lon_arr[placed], house_system, body_lons,
+                                   house_errors)
+
+        for j, i in enumerate(ok_index):
+            if j in body_errors:
+                rows[i] = {'id': records[i].get('id', ''), 'error': body_errors[j]}
+                continue
+            row = {'id': records[i].get('id', ''), 'error': ''}
+            for col, values in data.items():
+                row[col] = values[j].item()
+            if slot[j] in house_errors:
+                # Positions are still valid; only the house columns stay empty.
+                row['error'] = house_errors[slot[j]]
+            elif slot[j] >= 0:
+                for col, values in houses.items():
+                    row[col] = values[slot[j]].item()
+            rows[i] = row
+    return rows
+
+
+def output_columns(house_system='P'):
+    columns = ['id', 'error', 'jd_ut', 'asc', 'asc_sign', 'mc', 'mc_sign']
+    for name in BODY_NAMES:
+        columns += [f'{name}_lon', f'{name}_sign', f'{name}_house']
+    columns += [f'cusp{i + 1}' for i in range(12)]
+    return columns
+
+
+def _read_chunks(path, chunk_size):
+    """Yield lists of record dicts from a CSV or Parquet file without loading it whole."""
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Reading Parquet requires pyarrow (pip install pyarrow).")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield batch.to_pylist()
+        return
+
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        chunk = []
+        for record in csv.DictReader(f):
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+class _Writer:
+    """Incremental CSV or Parquet writer for output rows."""
+
+    def __init__(self, path, columns):
+        self.columns = columns
+        self.parquet = path.endswith('.parquet')
+        if self.parquet:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise SystemExit("Writing Parquet requires pyarrow (pip install pyarrow).")
+            self._pa, self._pq, self._writer, self._path = pa, pq, None, path
+        else:
+            self._file = sys.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+            self._csv = csv.DictWriter(self._file, fieldnames=columns, extrasaction='ignore')
+            self._csv.writeheader()
+
+    def write(self, rows):
+        if not self.parquet:
+            self._csv.writerows(rows)
+            return
+        table = self._pa.Table.from_pylist(
+            [{col: (None if row.get(col, '') == '' else row.get(col)) if col not in ('id', 'error')
+              else str(row.get(col, '')) for col in self.columns} for row in rows])
+        if self._writer is None:
+            self._writer = self._pq.ParquetWriter(self._path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self.parquet:
+            if self._writer is not None:
+                self._writer.close()
+        elif self._file is not sys.stdout:
+            self._file.close()
+
+
+def run(input_path, output_path, house_system='P', chunk_size=5000, workers=0):
+    """Stream input records through the engine into output_path; returns the row count."""
+    writer = _Writer(output_path, output_columns(house_system))
+    total = 0
+    start = time.perf_counter()
+
+    def report(rows):
+        nonlocal total
+        writer.write(rows)
+        total += len(rows)
+        elapsed = time.perf_counter() - start
+        print(f"{total} rows, {total / elapsed:.0f} rows/s", file=sys.stderr)
+
+    try:
+        if workers and workers > 1:
+            # Keep a bounded number of chunks in flight so memory stays flat.
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pending = deque()
+                for chunk in _read_chunks(input_path, chunk_size):
+                    pending.append(pool.submit(process_chunk, chunk, house_system))
+                    if len(pending) >= workers * 2:
+                        report(pending.popleft().result())
+                while pending:
+                    report(pending.popleft().result())
+        else:
+            for chunk in _read_chunks(input_path, chunk_size):
+                report(process_chunk(chunk, house_system))
+    finally:
+        writer.close()
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute charts for a CSV/Parquet file of birth records.")
+    parser.add_argument('input', help="input .csv or .parquet file")
+    parser.add_argument('output', help="output .csv or .parquet file ('-' for stdout)")
+    parser.add_argument('--house-system', default='P')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes (0 or 1 runs in-process)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    run(args.input, args.output, args.house_system, args.chunk_size, args.workers)
+
+
+if __name__ == '__main__':
+    main()
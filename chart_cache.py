@@ -0,0 +1,263 @@
+# -- coding: utf-8 --
+"""
+Content-addressed cache for chart images.
+
+A chart is identified by a hash of everything that affects the drawing
+(planet degrees, house cusps, ascendant, house system and render
+options). The page only records the chart spec under that key; the image
+itself is rendered on the first request to the image route and then kept
+in a bounded in-memory LRU, backed by a directory on disk that all
+workers share (FALAKY_CHART_CACHE_DIR, cache/charts by default). Specs
+are written there too, so any worker can serve a chart URL that another
+worker handed out. Files not rewritten for FALAKY_CHART_CACHE_DAYS days
+are pruned; a spec still in use is touched at least every
+REFRESH_SECONDS (and rewritten if it was pruned), so a chart that pages
+keep linking to never expires. Concurrent requests for an image not rendered yet wait for
+one render (single_flight), across workers too.
+
+FALAKY_CHART_CACHE_DIR='' keeps specs and images in each process's
+memory only, which is enough for a single-process server.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from chart_render import CHART_FORMAT, CHART_MIMETYPES, render_chart
+from single_flight import SingleFlight
+
+# Bump when the drawing changes so old cached images are not served.
+RENDER_VERSION = 1
+THUMBNAIL_SIZES = (120, 240, 480)
+MEMORY_LIMIT_BYTES = int(os.environ.get('FALAKY_CHART_CACHE_BYTES', 64 * 1024 * 1024))
+SPEC_LIMIT = int(os.environ.get('FALAKY_CHART_CACHE_SPECS', 20000))
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DISK_DIR = os.environ.get('FALAKY_CHART_CACHE_DIR', os.path.join(BASE_DIR, 'cache', 'charts')) or None
+DISK_MAX_DAYS = float(os.environ.get('FALAKY_CHART_CACHE_DAYS', 30))
+# How many disk writes between two sweeps for old files.
+PRUNE_EVERY = 500
+# A spec in use has its file's mtime refreshed at most this often.
+REFRESH_SECONDS = 3600
+
+
+def chart_key(planets_deg, houses_deg, ascendant_deg, house_system='P', fmt=None):
+    """Stable hash of the chart inputs and render options."""
+    payload = {
+        'planets': sorted((name, round(deg, 6)) for name, deg in planets_deg.items()),
+        'houses': [round(deg, 6) for deg in houses_deg],
+        'asc': round(ascendant_deg, 6),
+        'house_system': house_system,
+        'fmt': (fmt or CHART_FORMAT).lower(),
+        'v': RENDER_VERSION,
+    }
+    raw = json.dumps(payload, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()[:32]
+
+
+def _atomic_write(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class _DiskImages:
+    """Flight store for renders: the shared image directory, which the leader has just written."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get(self, variant):
+        return self.cache.peek_image(*variant)
+
+    def put(self, variant, data):
+        pass
+
+
+class ChartImageCache:
+    """Specs and rendered variants, LRU-bounded by count (specs) and bytes (images)."""
+
+    def __init__(self, memory_limit=MEMORY_LIMIT_BYTES, spec_limit=SPEC_LIMIT, disk_dir=DISK_DIR):
+        self.memory_limit = memory_limit
+        self.spec_limit = spec_limit
+        self.disk_dir = disk_dir
+        self._specs = OrderedDict()
+        self._refreshed = {}   # key -> when its spec file was last touched by this process
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'renders': 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+        self.render_flight = SingleFlight('render', disk_dir, _DiskImages(self) if disk_dir else None)
+
+    # -- specs ---------------------------------------------------------
+    def store_spec(self, planets_deg, houses_deg, ascendant_deg, house_system='P', fmt=None):
+        """Register a chart for later rendering and return its key."""
+        fmt = (fmt or CHART_FORMAT).lower()
+        key = chart_key(planets_deg, houses_deg, ascendant_deg, house_system, fmt)
+        spec = {'planets_deg': dict(planets_deg), 'houses_deg': list(houses_deg),
+                'ascendant_deg': ascendant_deg, 'house_system': house_system, 'fmt': fmt}
+        with self._lock:
+            known = self._specs.get(key)
+            if known is not None:
+                self._specs.move_to_end(key)
+        if known is None:
+            self._remember_spec(key, spec)
+        self._refresh_spec(key, known or spec)
+        return key
+
+    def _remember_spec(self, key, spec):
+        with self._lock:
+            self._specs[key] = spec
+            self._specs.move_to_end(key)
+            while len(self._specs) > self.spec_limit:
+                old, _ = self._specs.popitem(last=False)
+                self._refreshed.pop(old, None)
+
+    def _refresh_spec(self, key, spec):
+        """Keep a spec in use on disk: touch its file past REFRESH_SECONDS, rewrite it if pruned."""
+        if not self.disk_dir:
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._refreshed.get(key, 0) < REFRESH_SECONDS:
+                return
+            self._refreshed[key] = now
+        path = os.path.join(self.disk_dir, f'{key}.json')
+        try:
+            os.utime(path)
+            return
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning("Could not refresh chart spec %s: %s", key, e)
+            return
+        try:
+            _atomic_write(path, json.dumps(spec).encode('utf-8'))
+        except OSError as e:
+            logging.warning("Could not persist chart spec %s: %s", key, e)
+        self._wrote()
+
+    def get_spec(self, key):
+        with self._lock:
+            spec = self._specs.get(key)
+            if spec is not None:
+                self._specs.move_to_end(key)
+        if spec is not None:
+            self._refresh_spec(key, spec)
+            return spec
+        if self.disk_dir:
+            try:
+                with open(os.path.join(self.disk_dir, f'{key}.json'), 'rb') as f:
+                    spec = json.loads(f.read())
+            except (OSError, ValueError):
+                return None
+            self._remember_spec(key, spec)
+            self._refresh_spec(key, spec)
+            return spec
+        return None
+
+    def _wrote(self):
+        """Count a disk write; every PRUNE_EVERY writes, delete files older than DISK_MAX_DAYS."""
+        with self._lock:
+            self._writes += 1
+            if self._writes % PRUNE_EVERY:
+                return
+        oldest = time.time() - DISK_MAX_DAYS * 86400
+        try:
+            entries = list(os.scandir(self.disk_dir))
+        except OSError as e:
+            logging.warning("Could not list chart cache %s: %s", self.disk_dir, e)
+            return
+        for entry in entries:
+            if entry.name.endswith('.lock'):   # render_flight's locks live here too
+                continue
+            try:
+                if entry.is_file() and entry.stat().st_mtime < oldest:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+    # -- images --------------------------------------------------------
+    def _remember(self, variant, data):
+        with self._lock:
+            if variant in self._images:
+                return
+            self._images[variant] = data
+            self._bytes += len(data)
+            while self._bytes > self.memory_limit and self._images:
+                _, old = self._images.popitem(last=False)
+                self._bytes -= len(old)
+
+    def peek_image(self, key, size=None):
+        """Return cached image bytes without rendering, or None."""
+        variant = (key, size)
+        with self._lock:
+            data = self._images.get(variant)
+            if data is not None:
+                self._images.move_to_end(variant)
+                self.stats['hits'] += 1
+                return data
+        if self.disk_dir:
+            spec = self.get_spec(key)
+            if spec is None:
+                return None
+            path = os.path.join(self.disk_dir, f"{key}-{size or 'full'}.{spec['fmt']}")
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                return None
+            self.stats['disk_hits'] += 1
+            self._remember(variant, data)
+            return data
+        return None
+
+    def put_image(self, key, size, data):
+        self._remember((key, size), data)
+        if self.disk_dir:
+            spec = self.get_spec(key)
+            if spec is not None:
+                path = os.path.join(self.disk_dir, f"{key}-{size or 'full'}.{spec['fmt']}")
+                try:
+                    _atomic_write(path, data)
+                except OSError as e:
+                    logging.warning("Could not persist chart image %s: %s", key, e)
+                self._wrote()
+
+    def get_image(self, key, size=None):
+        """
+        Return (bytes, mimetype) for a chart variant, rendering it on a miss,
+        or None when the key is unknown.
+        """
+        spec = self.get_spec(key)
+        if spec is None:
+            return None
+        mimetype = CHART_MIMETYPES[spec['fmt']]
+        data = self.peek_image(key, size)
+        if data is not None:
+            return data, mimetype
+
+        self.stats['misses'] += 1
+        return self.render_flight.do((key, size), lambda: self._render(key, spec, size)), mimetype
+
+    def _render(self, key, spec, size):
+        data, _ = render_chart(spec['planets_deg'], spec['houses_deg'], spec['ascendant_deg'],
+                               fmt=spec['fmt'], size=size)
+        self.stats['renders'] += 1
+        self.put_image(key, size, data)
+        return data
+
+
+chart_cache = ChartImageCache()
@@ -0,0 +1,501 @@
+# -- coding: utf-8 --
+"""
+Nearest-neighbour index of natal charts ("charts like yours").
+
+Each chart is embedded as (cos, sin) of every body's longitude plus the
+ascendant and MC (Ketu is left out: it always mirrors Rahu). With
+per-point weights w, the squared distance between two embeddings is
+
+    sum_b w_b * |e_b(q) - e_b(x)|^2 = 2 * sum(w) - 2 * (W e(q)) . e(x)
+
+because every (cos, sin) pair has unit length. The weights therefore only
+scale the query, and the nearest charts are the ones with the largest dot
+product with it. The reported similarity is the weighted mean cosine of
+the angular differences: 1 for identical charts, 0 on average for
+unrelated ones.
+
+Large indexes are split into k-means lists (an inverted file). A query
+scores the centroids, then only the vectors of the `probes` closest
+lists. Charts added after the lists were built sit in an in-memory tail
+that every query scans in full, until save() files them into their
+lists. Small indexes, and exact=True queries, scan everything.
+
+On disk the index is one binary file: the header, the centroids, the list
+offsets, the float32 vectors in list order and the ids. The vectors are
+memory-mapped read-only, so gunicorn workers share them.
+
+    python chart_index.py build births.csv --path cache/chart_index.bin
+    python chart_index.py add more.ndjson
+    python chart_index.py bench --size 1000000
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from chart_model import BODY_ORDER
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_INDEX_PATH = os.environ.get(
+    'FALAKY_CHART_INDEX', os.path.join(BASE_DIR, 'cache', 'chart_index.bin'))
+PROBES = int(os.environ.get('FALAKY_CHART_INDEX_PROBES', 24))
+
+INDEX_POINTS = tuple(name for name in BODY_ORDER if name != 'Ketu') + ('AC', 'MC')
+MAGIC = b'FLKKNN01'
+# magic, n_points, n_lists, n_vectors, id bytes
+_HEADER = struct.Struct('<8sIIQQ')
+# Below this size a full scan is already fast, so no lists are built.
+MIN_LISTS_SIZE = 20000
+MAX_LISTS = 4096
+TRAIN_SAMPLE = 65536
+SCAN_CHUNK = 262144
+
+
+def _aligned(offset):
+    return (offset + 63) // 64 * 64
+
+
+def embed(lons):
+    """(..., P) longitudes in degrees -> (..., 2P) float32 embeddings [cos, sin, cos, sin, ...]."""
+    rad = np.radians(np.asarray(lons, dtype=np.float64))
+    out = np.empty(rad.shape[:-1] + (2 * rad.shape[-1],), dtype=np.float32)
+    out[..., 0::2] = np.cos(rad)
+    out[..., 1::2] = np.sin(rad)
+    return out
+
+
+def chart_longitudes(chart):
+    """INDEX_POINTS longitudes of a ChartModel, from the arrays the chart already holds."""
+    positions = dict(zip(chart.bodies, chart.lons))
+    positions['AC'], positions['MC'] = chart.asc, chart.mc
+    return [positions.get(name, float('nan')) for name in INDEX_POINTS]
+
+
+def point_weights(weights=None, missing=()):
+    """
+    Per-point weights as an array over INDEX_POINTS: 1 unless given, 0
+    for points in `missing`. Raises ValueError for unknown names or
+    negative weights.
+    """
+    weights = weights or {}
+    unknown = [name for name in weights if name not in INDEX_POINTS]
+    if unknown:
+        raise ValueError(f"unknown points: {', '.join(map(str, unknown))}")
+    values = np.array([0.0 if name in missing else float(weights.get(name, 1.0)) for name in INDEX_POINTS])
+    if (values < 0).any() or not values.any():
+        raise ValueError("weights must be non-negative and not all zero")
+    return values
+
+
+def _kmeans(vectors, n_lists, iterations=12, seed=0):
+    """Spherical k-means (all embeddings have the same norm) on at most TRAIN_SAMPLE vectors."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > TRAIN_SAMPLE:
+        vectors = vectors[rng.choice(len(vectors), TRAIN_SAMPLE, replace=False)]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts = np.bincount(labels, minlength=n_lists)
+        empty = counts == 0
+        # Empty lists restart on random vectors instead of staying dead.
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms > 0, norms, 1) * np.sqrt(vectors.shape[1] / 2)
+    return centroids.astype(np.float32)
+
+
+def _assign(vectors, centroids):
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), SCAN_CHUNK):
+        labels[start:start + SCAN_CHUNK] = np.argmax(vectors[start:start + SCAN_CHUNK] @ centroids.T, axis=1)
+    return labels
+
+
+def _top(scores, k):
+    if len(scores) <= k:
+        order = np.argsort(-scores, kind='stable')
+    else:
+        part = np.argpartition(-scores, k)[:k]
+        order = part[np.argsort(-scores[part], kind='stable')]
+    return order
+
+
+class ChartIndex:
+    """
+    In-memory or memory-mapped chart vectors with their ids. add() and
+    add_many() append to the tail; save() writes everything (tail filed
+    into lists) to a file that load() maps back.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.dim = 2 * len(INDEX_POINTS)
+        self.centroids = None                               # (L, D) or None for a flat index
+        self.offsets = np.zeros(2, dtype=np.int64)          # list l is vectors[offsets[l]:offsets[l + 1]]
+        self.vectors = np.empty((0, self.dim), dtype=np.float32)
+        self._id_offsets = np.zeros(1, dtype=np.int64)
+        self._id_blob = b''
+        self._tail = np.empty((1024, self.dim), dtype=np.float32)
+        self._tail_size = 0
+        self._tail_ids = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.vectors) + self._tail_size
+
+    # -- inserts ---------------------------------------------------------
+    def add_many(self, ids, lons):
+        """Append charts: ids and (M, len(INDEX_POINTS)) longitudes."""
+        lons = np.asarray(lons, dtype=np.float64).reshape(-1, len(INDEX_POINTS))
+        if np.isnan(lons).any():
+            raise ValueError("stored charts need every point")
+        vectors = embed(lons)
+        ids = [str(chart_id) for chart_id in ids]
+        if len(ids) != len(vectors):
+            raise ValueError("ids and longitudes differ in length")
+        with self._lock:
+            needed = self._tail_size + len(vectors)
+            if needed > len(self._tail):
+                grown = np.empty((max(needed, 2 * len(self._tail)), self.dim), dtype=np.float32)
+                grown[:self._tail_size] = self._tail[:self._tail_size]
+                self._tail = grown
+            self._tail[self._tail_size:needed] = vectors
+            self._tail_ids.extend(ids)
+            self._tail_size = needed
+
+    def add(self, chart_id, lons):
+        self.add_many([chart_id], [lons])
+
+    def add_chart(self, chart_id, chart):
+        """Append a ChartModel under chart_id."""
+        self.add(chart_id, chart_longitudes(chart))
+
+    # -- queries ---------------------------------------------------------
+    def chart_id(self, position):
+        if position >= len(self.vectors):
+            return self._tail_ids[position - len(self.vectors)]
+        start, end = self._id_offsets[position], self._id_offsets[position + 1]
+        return self._id_blob[start:end].decode('utf-8')
+
+    def _candidates(self, query, probes, exact):
+        """(positions, vectors) of the stored charts a query has to score."""
+        if self.centroids is None or exact or probes >= len(self.centroids):
+            return None, self.vectors
+        lists = _top(self.centroids @ query, probes)
+        ranges = [(self.offsets[l], self.offsets[l + 1]) for l in np.sort(lists)]
+        positions = np.concatenate([np.arange(start, end) for start, end in ranges])
+        return positions, np.concatenate([self.vectors[start:end] for start, end in ranges])
+
+    def search(self, lons, k=10, weights=None, probes=PROBES, exact=False):
+        """
+        The k charts closest to INDEX_POINTS longitudes (NaN for an unknown
+        point, e.g. the angles of a chart without a birth time), as
+        [(id, similarity), ...] with the most similar first. probes is the
+        number of lists searched; exact=True scans every chart.
+        """
+        lons = np.asarray(lons, dtype=np.float64)
+        w = point_weights(weights, missing={name for name, lon in zip(INDEX_POINTS, lons) if np.isnan(lon)})
+        query = embed(np.nan_to_num(lons)) * np.repeat(w, 2).astype(np.float32)
+        with self._lock:
+            tail = self._tail[:self._tail_size]
+
+        positions, candidates = self._candidates(query, probes, exact)
+        best_positions, best_scores = [], []
+        # Chunked so a flat scan of millions of charts stays bounded in memory.
+        for start in range(0, len(candidates), SCAN_CHUNK):
+            scores = candidates[start:start + SCAN_CHUNK] @ query
+            order = _top(scores, k)
+            found = order + start
+            best_positions.append(found if positions is None else positions[found])
+            best_scores.append(scores[order])
+        if len(tail):
+            scores = tail @ query
+            order = _top(scores, k)
+            best_positions.append(order + len(self.vectors))
+            best_scores.append(scores[order])
+        if not best_scores:
+            return []
+
+        positions = np.concatenate(best_positions)
+        scores = np.concatenate(best_scores)
+        order = _top(scores, k)
+        total = float(w.sum())
+        return [(self.chart_id(int(positions[i])), round(float(scores[i]) / total, 6)) for i in order]
+
+    def search_chart(self, chart, k=10, **kwargs):
+        """search() for a ChartModel."""
+        return self.search(chart_longitudes(chart), k, **kwargs)
+
+    # -- lists and persistence -------------------------------------------
+    def _ids(self):
+        for position in range(len(self.vectors)):
+            yield self.chart_id(position)
+        yield from self._tail_ids
+
+    def build_lists(self, n_lists=None, seed=0):
+        """
+        File every chart (tail included) into k-means lists; n_lists
+        defaults to about 4 * sqrt(size). Indexes smaller than
+        MIN_LISTS_SIZE stay flat unless n_lists is given.
+        """
+        with self._lock:
+            vectors = np.concatenate([self.vectors, self._tail[:self._tail_size]])
+            ids = list(self._ids())
+            if n_lists is None:
+                n_lists = 0 if len(vectors) < MIN_LISTS_SIZE else min(MAX_LISTS, int(4 * np.sqrt(len(vectors))))
+            n_lists = min(n_lists, len(vectors))
+            if n_lists > 1:
+                self.centroids = _kmeans(vectors, n_lists, seed=seed)
+                labels = _assign(vectors, self.centroids)
+                order = np.argsort(labels, kind='stable')
+                counts = np.bincount(labels, minlength=n_lists)
+                self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+                vectors = vectors[order]
+                ids = [ids[i] for i in order]
+            else:
+                self.centroids = None
+                self.offsets = np.array([0, len(vectors)], dtype=np.int64)
+            self._set_stored(vectors, ids)
+
+    def _file_tail(self):
+        """File the tail into the existing lists without retraining the centroids."""
+        with self._lock:
+            if not self._tail_size:
+                return
+            tail, tail_ids = self._tail[:self._tail_size], self._tail_ids
+            if self.centroids is None:
+                vectors = np.concatenate([self.vectors, tail])
+                ids = list(self._ids())
+                self.offsets = np.array([0, len(vectors)], dtype=np.int64)
+            else:
+                n_lists = len(self.centroids)
+                old_labels = np.repeat(np.arange(n_lists), np.diff(self.offsets))
+                labels = np.concatenate([old_labels, _assign(tail, self.centroids)])
+                order = np.argsort(labels, kind='stable')
+                vectors = np.concatenate([self.vectors, tail])[order]
+                all_ids = [self.chart_id(i) for i in range(len(self.vectors))] + tail_ids
+                ids = [all_ids[i] for i in order]
+                counts = np.bincount(labels, minlength=n_lists)
+                self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            self._set_stored(vectors, ids)
+
+    def _set_stored(self, vectors, ids):
+        encoded = [chart_id.encode('utf-8') for chart_id in ids]
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self._id_offsets = np.concatenate([[0], np.cumsum([len(b) for b in encoded])]).astype(np.int64)
+        self._id_blob = b''.join(encoded)
+        self._tail = np.empty((1024, self.dim), dtype=np.float32)
+        self._tail_size = 0
+        self._tail_ids = []
+
+    def save(self, path=None):
+        """Write the index (tail filed into its lists) atomically to path."""
+        path = path or self.path
+        self._file_tail()
+        n_lists = 0 if self.centroids is None else len(self.centroids)
+        names = ','.join(INDEX_POINTS).encode('ascii')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(MAGIC, len(INDEX_POINTS), n_lists, len(self.vectors), len(self._id_blob)))
+                f.write(struct.pack('<H', len(names)) + names)
+                for array in (self.centroids, self.offsets, self.vectors, self._id_offsets):
+                    f.write(b'\0' * (_aligned(f.tell()) - f.tell()))
+                    if array is not None:
+                        f.write(np.ascontiguousarray(array).tobytes())
+                f.write(self._id_blob)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.path = path
+
+    @classmethod
+    def load(cls, path=DEFAULT_INDEX_PATH):
+        """Map an index file; the vectors stay on disk, shared between processes."""
+        index = cls(path)
+        with open(path, 'rb') as f:
+            magic, n_points, n_lists, n_vectors, id_bytes = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a chart index")
+            names = f.read(struct.unpack('<H', f.read(2))[0]).decode('ascii').split(',')
+            if tuple(names) != INDEX_POINTS:
+                raise ValueError(f"{path} was built for other points: {','.join(names)}")
+            offset = _aligned(f.tell())
+            if n_lists:
+                f.seek(offset)
+                index.centroids = np.frombuffer(f.read(4 * n_lists * index.dim), dtype=np.float32) \
+                    .reshape(n_lists, index.dim)
+                offset = _aligned(offset + 4 * n_lists * index.dim)
+            f.seek(offset)
+            index.offsets = np.frombuffer(f.read(8 * (n_lists or 1) + 8), dtype=np.int64)
+            offset = _aligned(offset + 8 * (n_lists or 1) + 8)
+            vectors_offset = offset
+            offset = _aligned(offset + 4 * n_vectors * index.dim)
+            f.seek(offset)
+            index._id_offsets = np.frombuffer(f.read(8 * (n_vectors + 1)), dtype=np.int64)
+            index._id_blob = f.read(id_bytes)
+        index.vectors = np.memmap(path, dtype=np.float32, mode='r', offset=vectors_offset,
+                                  shape=(n_vectors, index.dim)) if n_vectors else index.vectors
+        return index
+
+
+_index = None
+_index_path = None
+_index_mtime = None
+
+
+def load_index(path=DEFAULT_INDEX_PATH):
+    """The shared index for this process (reloaded when the file changes), or None when none was built."""
+    global _index, _index_path, _index_mtime
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    if _index is None or _index_path != path or _index_mtime != mtime:
+        _index, _index_path, _index_mtime = ChartIndex.load(path), path, mtime
+    return _index
+
+
+# -- building from birth records --------------------------------------------
+
+def _chunk_longitudes(chunk):
+    """[(index, record), ...] -> (ids, longitudes, errors) (runs in workers)."""
+    from chart_pipeline import ChartContext, ChartInputError, compute_chart_model, parse_birth_data
+    context = ChartContext()
+    ids, lons, errors = [], [], []
+    for index, record in chunk:
+        try:
+            chart = compute_chart_model(parse_birth_data(record), context)
+        except ChartInputError as e:
+            errors.append((index, str(e)))
+            continue
+        except Exception as e:   # one bad record must not lose the whole index
+            errors.append((index, f"{type(e).__name__}: {e}"))
+            continue
+        chart_lons = chart_longitudes(chart)
+        if any(np.isnan(chart_lons)):
+            errors.append((index, "missing body positions"))
+            continue
+        ids.append(record.get('id') or str(index))
+        lons.append(chart_lons)
+    return ids, lons, errors
+
+
+def add_records(index, path, workers=0, chunk_size=500, progress=True):
+    """Compute and append the charts of a CSV/NDJSON file of birth records; returns (added, errors)."""
+    from report_export import chunks, format_for_path, iter_records
+    added, errors, started = 0, 0, time.perf_counter()
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        batches = chunks(iter_records(f, format_for_path(path)), chunk_size)
+        if workers > 1:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            results = pool.map(_chunk_longitudes, batches)
+        else:
+            pool, results = None, map(_chunk_longitudes, batches)
+        try:
+            for ids, lons, failed in results:
+                if ids:
+                    index.add_many(ids, lons)
+                added += len(ids)
+                errors += len(failed)
+                for record_index, message in failed:
+                    logging.warning("Record %s skipped: %s", record_index, message)
+                if progress:
+                    rate = added / (time.perf_counter() - started)
+                    print(f"\r{added} charts, {errors} skipped, {rate:.0f} charts/s", end='', file=sys.stderr)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+    if progress:
+        print(file=sys.stderr)
+    return added, errors
+
+
+def _random_longitudes(size, seed=0):
+    """Plausible synthetic charts for benchmarks: real sky positions at random instants and places."""
+    import swisseph as swe
+    from chart_pipeline import CHART_BODIES
+    rng = np.random.default_rng(seed)
+    # Real skies on a grid over a century, each chart moved along every body's
+    # motion to a uniformly random instant within half a grid step.
+    jds, step = np.linspace(swe.julday(1930, 1, 1, 0.0), swe.julday(2030, 1, 1, 0.0), 8192, retstep=True)
+    names = [name for name in INDEX_POINTS if name in CHART_BODIES]
+    sky = np.array([[swe.calc_ut(jd, CHART_BODIES[name], swe.FLG_SWIEPH | swe.FLG_SPEED)[0][:4:3] for name in names]
+                    for jd in jds])
+    pick = rng.integers(0, len(jds), size)
+    days = rng.uniform(-step / 2, step / 2, size)[:, None]
+    lons = np.empty((size, len(INDEX_POINTS)))
+    lons[:, :len(names)] = sky[pick, :, 0] + days * sky[pick, :, 1]
+    lons[:, len(names)] = rng.uniform(0, 360, size)                         # AC: any time of day
+    lons[:, len(names) + 1] = lons[:, len(names)] - 90 + rng.normal(0, 15, size)   # MC about 90 deg behind
+    return lons % 360
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build, extend or benchmark the similar-charts index.")
+    parser.add_argument('command', choices=('build', 'add', 'bench'))
+    parser.add_argument('input', nargs='?', help="CSV/NDJSON birth records (build/add)")
+    parser.add_argument('--path', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--lists', type=int, default=None, help="k-means lists (default about 4*sqrt(size))")
+    parser.add_argument('--rebuild-lists', action='store_true', help="add: retrain the lists after adding")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--size', type=int, default=1000000, help="bench: synthetic charts")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.command in ('build', 'add'):
+        if not args.input:
+            parser.error(f"{args.command} needs an input file")
+        index = ChartIndex.load(args.path) if args.command == 'add' else ChartIndex(args.path)
+        added, errors = add_records(index, args.input, args.workers)
+        if args.command == 'build' or args.rebuild_lists:
+            index.build_lists(args.lists)
+        index.save(args.path)
+        lists = 0 if index.centroids is None else len(index.centroids)
+        print(f"{args.path}: {len(index)} charts in {lists or 'no'} lists ({added} added, {errors} skipped)",
+              file=sys.stderr)
+        return
+
+    start = time.perf_counter()
+    lons = _random_longitudes(args.size + args.queries)
+    index = ChartIndex()
+    index.add_many(range(args.size), lons[:args.size])
+    index.build_lists(args.lists)
+    print(f"Built {args.size} charts in {len(index.centroids)} lists in {time.perf_counter() - start:.1f} s")
+    queries = lons[args.size:]
+    for probes in (8, 24, 64):
+        hits, elapsed = 0, 0.0
+        for q in queries:
+            exact = {chart_id for chart_id, _ in index.search(q, args.k, exact=True)}
+            start = time.perf_counter()
+            found = index.search(q, args.k, probes=probes)
+            elapsed += time.perf_counter() - start
+            hits += len(exact & {chart_id for chart_id, _ in found})
+        print(f"probes={probes:3d}: {elapsed / len(queries) * 1000:.2f} ms/query, "
+              f"recall@{args.k} {hits / (len(queries) * args.k):.3f}")
+    start = time.perf_counter()
+    for q in queries[:20]:
+        index.search(q, args.k, exact=True)
+    print(f"exact: {(time.perf_counter() - start) / 20 * 1000:.2f} ms/query")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+# -- coding: utf-8 --
+"""
+Compact chart model.
+
+ChartModel keeps a computed chart as numbers only: the moment, the place,
+the angles, the twelve cusps and per-body longitude, speed and house.
+They are kept in `array` buffers under __slots__, so a chart object costs
+about 1 KB instead of the nested dicts of compute_chart(). Everything
+textual (sign, Arabic names, symbols, degree in sign) is looked up from
+the shared tables in astro only when a view is read. The page template
+reads model.planets, model.angles and model.houses_info exactly like the
+dicts, and to_dict() produces the JSON result.
+
+to_bytes()/from_bytes() give a binary form of about 230 bytes per chart.
+Degrees are stored as 32-bit fixed point (0.0003 arcsecond steps), and
+houses are stored as computed, so a reloaded chart places every body in
+the same house. write_charts()/read_charts() stream many charts through
+one file, one length-prefixed record per chart.
+"""
+import struct
+from array import array
+from datetime import datetime, timedelta
+
+import swisseph as swe
+
+from astro import (
+    HOUSE_NAMES_ARABIC, PLANET_IDS, PLANET_NAMES_ARABIC, PLANET_SYMBOLS, SIGN_NAMES_ARABIC, SIGN_NAMES_ENGLISH,
+    SIGN_SYMBOLS, calculate_aspects, get_house_number, house_offsets,
+)
+
+BODY_ORDER = tuple(PLANET_IDS) + ('Rahu', 'Ketu')
+ANGLE_KEYS = ('AC', 'IC', 'MC', 'DC')
+ANGLE_NAMES_ARABIC = {"AC": "الطالع", "IC": "قاع السماء", "MC": "وسط السماء", "DC": "الهابط"}
+SIGN_SYMBOL_LIST = [SIGN_SYMBOLS[name] for name in SIGN_NAMES_ENGLISH]
+
+MAGIC = b'FC'
+VERSION = 1
+# magic, version, house system, flags, body mask, jd_ut, lat, lon
+_HEAD = struct.Struct('<2sBcBHddd')
+_FLAG_AMBIGUOUS = 1
+_FLAG_PREFERS_DST = 2
+_TURN = 2 ** 32 / 360.0
+_TEXT_LENGTHS = struct.Struct('<HH')
+_RECORD_LENGTH = struct.Struct('<I')
+# One shared tuple of names per set of bodies present.
+_BODY_SETS = {}
+
+
+def jd_to_utc(jd_ut):
+    """UTC datetime (to the second) of a Julian day."""
+    year, month, day, hours = swe.revjul(jd_ut, swe.GREG_CAL)
+    return datetime(year, month, day) + timedelta(seconds=round(hours * 3600.0))
+
+
+def _to_fixed(degrees):
+    return [int(round((deg % 360.0) * _TURN)) % 2 ** 32 for deg in degrees]
+
+
+def _body_names(mask):
+    names = _BODY_SETS.get(mask)
+    if names is None:
+        names = _BODY_SETS[mask] = tuple(name for i, name in enumerate(BODY_ORDER) if mask >> i & 1)
+    return names
+
+
+class _SignView:
+    """Sign fields of a longitude, computed on access (same keys as astro.get_zodiac_info)."""
+
+    __slots__ = ('degree',)
+
+    def __init__(self, degree):
+        self.degree = degree
+
+    @property
+    def sign_index(self):
+        return int(self.degree // 30) % 12
+
+    @property
+    def sign_en(self):
+        return SIGN_NAMES_ENGLISH[self.sign_index]
+
+    @property
+    def sign_ar(self):
+        return SIGN_NAMES_ARABIC[self.sign_index]
+
+    @property
+    def sign_symbol(self):
+        return SIGN_SYMBOL_LIST[self.sign_index]
+
+    @property
+    def degree_in_sign(self):
+        return self.degree % 30
+
+    def zodiac_info(self):
+        return {"sign_ar": self.sign_ar, "sign_symbol": self.sign_symbol, "sign_index": self.sign_index,
+                "degree_in_sign": self.degree_in_sign, "sign_en": self.sign_en}
+
+
+class BodyView(_SignView):
+    __slots__ = ('name_en', 'house', 'speed')
+
+    def __init__(self, name_en, degree, house, speed):
+        super().__init__(degree)
+        self.name_en, self.house, self.speed = name_en, house, speed
+
+    @property
+    def name_ar(self):
+        return PLANET_NAMES_ARABIC.get(self.name_en, self.name_en)
+
+    @property
+    def symbol(self):
+        return PLANET_SYMBOLS.get(self.name_en)
+
+    def to_dict(self):
+        return {"name_en": self.name_en, "name_ar": self.name_ar, "symbol": self.symbol, "degree": self.degree,
+                "degree_in_sign": self.degree_in_sign, "sign_ar": self.sign_ar, "sign_symbol": self.sign_symbol,
+                "house": self.house, "sign_en": self.sign_en}
+
+
+class AngleView(_SignView):
+    __slots__ = ('key',)
+
+    def __init__(self, key, degree):
+        super().__init__(degree)
+        self.key = key
+
+    @property
+    def name_ar(self):
+        return ANGLE_NAMES_ARABIC[self.key]
+
+    @property
+    def sign_info(self):
+        return self
+
+    def to_dict(self):
+        return {"name_ar": self.name_ar, "degree": self.degree, "sign_info": self.zodiac_info()}
+
+
+class HouseView(_SignView):
+    __slots__ = ('house',)
+
+    def __init__(self, house, degree):
+        super().__init__(degree)
+        self.house = house
+
+    @property
+    def name_ar(self):
+        return HOUSE_NAMES_ARABIC[self.house - 1]
+
+    def to_dict(self):
+        return {"house": self.house, "name_ar": self.name_ar, "degree": self.degree,
+                "degree_in_sign": self.degree_in_sign, "sign_ar": self.sign_ar, "sign_symbol": self.sign_symbol}
+
+
+class ChartModel:
+    """A computed natal chart; see the module docstring."""
+
+    __slots__ = ('jd_ut', 'latitude', 'longitude', 'house_system', 'location', 'timezone', 'ambiguous',
+                 'prefers_dst', 'asc', 'mc', 'cusps', 'bodies', 'lons', 'speeds', 'houses', '_local_time')
+
+    def __init__(self, jd_ut, latitude, longitude, house_system, asc, mc, cusps, positions, speeds,
+                 location='', timezone='', ambiguous=False, prefers_dst=True, houses=None, local_time=None):
+        """
+        positions/speeds: {body: degrees} in any order; houses default to
+        get_house_number. local_time (timezone_service.LocalTime) is derived
+        from the timezone when not given.
+        """
+        self.jd_ut, self.latitude, self.longitude = jd_ut, latitude, longitude
+        self.house_system = house_system
+        self.location, self.timezone = location, timezone
+        self.ambiguous, self.prefers_dst = ambiguous, prefers_dst
+        self.asc, self.mc = asc, mc
+        self.cusps = array('d', cusps[:12])
+        mask = sum(1 << i for i, name in enumerate(BODY_ORDER) if name in positions)
+        self.bodies = _body_names(mask)
+        self.lons = array('d', [positions[name] for name in self.bodies])
+        self.speeds = array('d', [speeds.get(name, 0.0) for name in self.bodies])
+        if houses is None:
+            offsets = house_offsets(self.cusps)
+            houses = [get_house_number(lon, self.cusps, offsets) for lon in self.lons]
+        self.houses = array('B', houses)
+        self._local_time = local_time
+
+    # -- views -----------------------------------------------------------
+    @property
+    def planets(self):
+        return [BodyView(name, lon, house, speed)
+                for name, lon, house, speed in zip(self.bodies, self.lons, self.houses, self.speeds)]
+
+    @property
+    def angles(self):
+        degrees = (self.asc, (self.mc + 180) % 360, self.mc, (self.asc + 180) % 360)
+        return {key: AngleView(key, degree) for key, degree in zip(ANGLE_KEYS, degrees)}
+
+    @property
+    def houses_info(self):
+        return [HouseView(i + 1, degree) for i, degree in enumerate(self.cusps)]
+
+    @property
+    def planets_deg(self):
+        return dict(zip(self.bodies, self.lons))
+
+    @property
+    def planets_speed(self):
+        return dict(zip(self.bodies, self.speeds))
+
+    @property
+    def houses_deg(self):
+        return list(self.cusps)
+
+    @property
+    def aspects(self):
+        return [
+            {key: aspect[key] for key in ('planet1', 'planet2', 'type', 'angle', 'orb', 'exactness', 'applying')}
+            for aspect in calculate_aspects(self.planets_deg, self.planets_speed)
+        ]
+
+    # -- times -----------------------------------------------------------
+    @property
+    def utc_dt(self):
+        return jd_to_utc(self.jd_ut)
+
+    def local(self):
+        """timezone_service.LocalTime of the birth moment (needs self.timezone)."""
+        if self._local_time is None:
+            import timezone_service
+            self._local_time = timezone_service.from_utc(self.timezone, self.utc_dt, self.ambiguous)
+        return self._local_time
+
+    @property
+    def local_time(self):
+        return self.local().local_dt.strftime("%Y-%m-%d %H:%M")
+
+    @property
+    def utc_time(self):
+        return self.utc_dt.strftime("%Y-%m-%d %H:%M UTC")
+
+    @property
+    def dst_notice(self):
+        from chart_pipeline import build_dst_notice
+        local_dt = self.local().local_dt
+        return build_dst_notice(self.local(), local_dt.hour, local_dt.minute, self.prefers_dst)
+
+    def to_dict(self, aspects=None):
+        """The compute_chart() result for this chart."""
+        return {
+            "angles": {key: angle.to_dict() for key, angle in self.angles.items()},
+            "planets": [body.to_dict() for body in self.planets],
+            "location": self.location,
+            "latitude": self.latitude,
+            "longitude": self.longitude,
+            "timezone": self.timezone,
+            "local_time": self.local_time,
+            "utc_time": self.utc_time,
+            "jd_ut": self.jd_ut,
+            "houses_deg": self.houses_deg,
+            "houses_info": [house.to_dict() for house in self.houses_info],
+            "aspects": self.aspects if aspects is None else aspects,
+            "planets_deg": self.planets_deg,
+            "planets_speed": self.planets_speed,
+            "dst_notice": self.dst_notice,
+            "house_system": self.house_system,
+        }
+
+    # -- binary form -----------------------------------------------------
+    def to_bytes(self):
+        mask = sum(1 << BODY_ORDER.index(name) for name in self.bodies)
+        flags = (_FLAG_AMBIGUOUS if self.ambiguous else 0) | (_FLAG_PREFERS_DST if self.prefers_dst else 0)
+        n = len(self.bodies)
+        location, timezone = self.location.encode('utf-8'), self.timezone.encode('utf-8')
+        return b''.join((
+            _HEAD.pack(MAGIC, VERSION, self.house_system.encode('ascii'), flags, mask,
+                       self.jd_ut, self.latitude, self.longitude),
+            struct.pack(f'<{14 + n}I', *_to_fixed([self.asc, self.mc, *self.cusps, *self.lons])),
+            struct.pack(f'<{n}f', *self.speeds),
+            self.houses.tobytes(),
+            _TEXT_LENGTHS.pack(len(location), len(timezone)), location, timezone,
+        ))
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, hsys, flags, mask, jd_ut, lat, lon = _HEAD.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a version {VERSION} chart record")
+        bodies = _body_names(mask)
+        n = len(bodies)
+        offset = _HEAD.size
+        degrees = array('d', [value / _TURN for value in struct.unpack_from(f'<{14 + n}I', data, offset)])
+        offset += 4 * (14 + n)
+        speeds = array('d', struct.unpack_from(f'<{n}f', data, offset))
+        offset += 4 * n
+        houses = array('B', data[offset:offset + n])
+        offset += n
+        location_len, timezone_len = _TEXT_LENGTHS.unpack_from(data, offset)
+        offset += _TEXT_LENGTHS.size
+
+        chart = cls.__new__(cls)
+        chart.jd_ut, chart.latitude, chart.longitude = jd_ut, lat, lon
+        chart.house_system = hsys.decode('ascii')
+        chart.location = bytes(data[offset:offset + location_len]).decode('utf-8')
+        offset += location_len
+        chart.timezone = bytes(data[offset:offset + timezone_len]).decode('utf-8')
+        chart.ambiguous, chart.prefers_dst = bool(flags & _FLAG_AMBIGUOUS), bool(flags & _FLAG_PREFERS_DST)
+        chart.asc, chart.mc = degrees[0], degrees[1]
+        chart.cusps = degrees[2:14]
+        chart.bodies = bodies
+        chart.lons = degrees[14:]
+        chart.speeds = speeds
+        chart.houses = houses
+        chart._local_time = None
+        return chart
+
+
+def write_charts(f, charts):
+    """Append charts to a binary file object; returns the number written."""
+    count = 0
+    for chart in charts:
+        record = chart.to_bytes()
+        f.write(_RECORD_LENGTH.pack(len(record)))
+        f.write(record)
+        count += 1
+    return count
+
+
+def read_charts(f):
+    """Yield the charts of a file written by write_charts()."""
+    while True:
+        head = f.read(_RECORD_LENGTH.size)
+        if len(head) < _RECORD_LENGTH.size:
+            return
+        (length,) = _RECORD_LENGTH.unpack(head)
+        yield ChartModel.from_bytes(f.read(length))
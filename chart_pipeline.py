@@ -0,0 +1,423 @@
+# -- coding: utf-8 --
+"""
+The natal chart pipeline, independent of Flask.
+
+compute_chart_model() takes one birth record and returns a ChartModel,
+which the HTML page renders directly. compute_chart() returns the same
+chart as the result dict (angles, planets, houses, DST notice, ...) plus
+the aspects and raw degrees for the JSON API and the batch endpoint, so
+all of them share one implementation. Problems with the input are raised as
+ChartInputError carrying the Arabic message shown to the user.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+import swisseph as swe
+
+import geocoding
+import timezone_service
+from chart_model import ChartModel
+from ephemeris_cache import ephemeris_cache
+from instrumentation import span, trace
+from single_flight import shared_flight
+from astro import PLANET_IDS, PLANET_NAMES_ARABIC, PLANET_SYMBOLS, assign_houses, get_zodiac_info
+
+HOUSE_SYSTEMS = ('P', 'K', 'E', 'W', 'O', 'R', 'C', 'B', 'M', 'A')
+HOUSE_SYSTEM_NAMES = {
+    'P': 'Placidus', 'K': 'Koch', 'E': 'Equal', 'W': 'Whole Sign', 'O': 'Porphyry',
+    'R': 'Regiomontanus', 'C': 'Campanus', 'B': 'Alcabitius', 'M': 'Morinus', 'A': 'Equal (Ascendant)',
+}
+REQUIRED_FIELDS = ('year', 'month', 'day', 'hour', 'minute', 'city', 'country')
+EPHEMERIS_FLAGS = swe.FLG_SWIEPH | swe.FLG_SPEED
+CHART_BODIES = dict(PLANET_IDS, Rahu=swe.MEAN_NODE)
+# Entries per stage in form_context (the single-chart requests of one worker); 0 turns it off.
+FORM_MEMO_ENTRIES = int(os.environ.get('FALAKY_FORM_MEMO_ENTRIES', 1024))
+
+
+class ChartInputError(ValueError):
+    """Birth data that cannot produce a chart; str(e) is the user-facing message."""
+
+
+_MISSING = object()
+
+
+class StageMemo:
+    """
+    Results of one pipeline stage keyed by that stage's inputs. With
+    max_entries the least recently used entries are evicted past the
+    bound (0 keeps nothing); without it (a batch's context) nothing is
+    evicted.
+    """
+
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            if self.max_entries:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_entries == 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            if self.max_entries:
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ChartContext:
+    """
+    Stage results reused across charts: resolved locations and timezones,
+    local time -> UTC/Julian day, body positions per Julian day and whole
+    charts per birth record. Each stage is keyed only by its own inputs,
+    so a resubmitted form with a new minute reuses the location, one with a
+    new house system also reuses the bodies (the cusps are memoized per
+    moment, place and system by ephemeris_cache), and an unchanged one
+    reuses the chart. The process-wide caches in geocoding/timezone_service
+    sit behind it.
+
+    A batch uses a fresh unbounded context; `form_context` below is the
+    bounded one shared by the single-chart requests of a worker process.
+    With a `flight` (single_flight.SingleFlight), identical charts
+    requested at the same time are computed once, by the first request.
+    """
+
+    STAGES = ('locations', 'times', 'bodies', 'charts')
+
+    def __init__(self, max_entries=None, flight=None):
+        self.locations = StageMemo(max_entries)   # (city, country) -> (lat, lon, timezone_str) or None
+        self.times = StageMemo(max_entries)       # (timezone, naive datetime, prefers_dst) -> (LocalTime, jd_ut)
+        self.bodies = StageMemo(max_entries)      # jd_ut -> ({name: degree}, {name: degrees per day})
+        self.charts = StageMemo(max_entries)      # birth record key -> ChartModel
+        # A shared context does not remember unknown places, so a later
+        # request can still succeed after a geocoder outage.
+        self.remember_unknown = max_entries is None
+        self.flight = flight
+
+    def resolve_location(self, city, country):
+        key = (geocoding.normalize_name(city), geocoding.normalize_name(country))
+        location = self.locations.get(key, _MISSING)
+        if location is _MISSING:
+            with span('geocode'):
+                lat, lon = geocoding.geocode(city, country)
+            if lat is None or lon is None:
+                location = None
+            else:
+                with span('timezone'):
+                    location = (lat, lon, timezone_service.resolve_timezone(lat, lon, country))
+            if location is not None or self.remember_unknown:
+                self.locations.put(key, location)
+        return location
+
+    def local_time(self, timezone_str, naive_dt, prefers_dst):
+        """(LocalTime, jd_ut); raises pytz.exceptions.NonExistentTimeError like timezone_service.localize."""
+        key = (timezone_str, naive_dt, prefers_dst)
+        result = self.times.get(key)
+        if result is None:
+            with span('timezone'):
+                local_time = timezone_service.localize(timezone_str, naive_dt, prefers_dst)
+            result = (local_time, julian_day(local_time.utc_dt))
+            self.times.put(key, result)
+        return result
+
+    def body_motion(self, jd_ut):
+        motion = self.bodies.get(jd_ut)
+        if motion is None:
+            with span('planets'):
+                motion = compute_body_motion(jd_ut)
+            self.bodies.put(jd_ut, motion)
+        return motion
+
+    def body_positions(self, jd_ut):
+        return self.body_motion(jd_ut)[0]
+
+    def stats(self):
+        """{stage: {'hits': n, 'misses': n, 'entries': n}}."""
+        return {stage: {'hits': memo.hits, 'misses': memo.misses, 'entries': len(memo)}
+                for stage, memo in ((stage, getattr(self, stage)) for stage in self.STAGES)}
+
+
+def parse_birth_data(data):
+    """Validate a form/JSON mapping into a normalized birth record."""
+    missing = [field for field in REQUIRED_FIELDS if data.get(field) in (None, '')]
+    if missing:
+        raise ChartInputError(f"بيانات الميلاد غير مكتملة. الحقول الناقصة: {', '.join(missing)}")
+    try:
+        record = {field: int(data[field]) for field in ('year', 'month', 'day', 'hour', 'minute')}
+    except (TypeError, ValueError):
+        raise ChartInputError("التاريخ والوقت يجب أن تكون أرقاماً صحيحة.")
+    record['city'] = str(data['city']).strip()
+    record['country'] = str(data['country']).strip()
+
+    house_system = str(data.get('house_system') or 'P')
+    if house_system not in HOUSE_SYSTEMS:
+        raise ChartInputError(f"نظام البيوت غير معروف: {house_system}")
+    record['house_system'] = house_system
+
+    # Optional extra systems computed in the same pass: a list, "P,K,W" or "all".
+    house_systems = data.get('house_systems')
+    if house_systems:
+        if house_systems == 'all':
+            house_systems = HOUSE_SYSTEMS
+        elif isinstance(house_systems, str):
+            house_systems = house_systems.split(',')
+        elif not isinstance(house_systems, (list, tuple)):
+            raise ChartInputError("house_systems يجب أن تكون قائمة أو نصاً مثل \"P,K,W\".")
+        unknown = [str(hsys) for hsys in house_systems if hsys not in HOUSE_SYSTEMS]
+        if unknown:
+            raise ChartInputError(f"نظام البيوت غير معروف: {', '.join(unknown)}")
+        record['house_systems'] = tuple(dict.fromkeys(house_systems))
+
+    dst_preference = data.get('dst_preference', 'true')
+    record['prefers_dst'] = dst_preference is True or str(dst_preference).lower() == 'true'
+    return record
+
+
+def compute_body_motion(jd_ut, shared=True):
+    """
+    Longitudes and daily speeds of the ten planets plus the mean lunar
+    nodes (Rahu/Ketu), as two {name: degrees} dicts. shared=False keeps
+    the result out of the SQLite tier of ephemeris_cache.
+    """
+    motion = ephemeris_cache.body_motion(jd_ut, tuple(CHART_BODIES.values()), EPHEMERIS_FLAGS, _calc_motion,
+                                         shared=shared)
+    positions, speeds = {}, {}
+    for name_en, pid in CHART_BODIES.items():
+        if pid in motion:
+            positions[name_en], speeds[name_en] = motion[pid]
+    if "Rahu" in positions:
+        positions["Ketu"] = (positions["Rahu"] + 180) % 360
+        speeds["Ketu"] = speeds["Rahu"]
+    return positions, speeds
+
+
+def _calc_motion(jd_ut, pid, flags):
+    pos = swe.calc_ut(jd_ut, pid, flags)[0]
+    return pos[0], pos[3]
+
+
+def julian_day(utc_dt):
+    """Julian day (UT) of a UTC datetime, to the second."""
+    return swe.julday(utc_dt.year, utc_dt.month, utc_dt.day,
+                      utc_dt.hour + utc_dt.minute / 60.0 + utc_dt.second / 3600.0)
+
+
+def compute_sky(jd_ut):
+    """
+    Sign, degree and motion of every body at a moment (no place, so no
+    houses): from the ephemeris table when it covers the moment, else
+    Swiss Ephemeris.
+    """
+    import ephemeris_table   # numpy: loaded on first use, not when the app imports this module
+
+    motion = ephemeris_table.transit_motion(jd_ut)
+    # The current sky is a new instant every second and daily_sky keeps its own files:
+    # neither is worth rows in the shared cache.
+    positions, speeds = motion if motion is not None else compute_body_motion(jd_ut, shared=False)
+    sky = []
+    for name_en, pos_deg in positions.items():
+        info = get_zodiac_info(pos_deg)
+        sky.append({
+            "name_en": name_en,
+            "name_ar": PLANET_NAMES_ARABIC.get(name_en, name_en),
+            "symbol": PLANET_SYMBOLS.get(name_en),
+            "degree": pos_deg,
+            "degree_in_sign": info['degree_in_sign'],
+            "sign_ar": info['sign_ar'],
+            "sign_en": info['sign_en'],
+            "sign_symbol": info['sign_symbol'],
+            "speed": speeds[name_en],
+            "retrograde": speeds[name_en] < 0,
+        })
+    return sky
+
+
+def compute_body_positions(jd_ut):
+    """Longitudes of the ten planets plus the mean lunar nodes (Rahu/Ketu)."""
+    return compute_body_motion(jd_ut)[0]
+
+
+def compute_house_cusps(jd_ut, lat, lon, house_system):
+    """
+    House cusps (12) and ascmc for a moment and place. Swiss Ephemeris
+    builds Whole Sign ('W') itself: house 1 starts at 0 degrees of the
+    ascendant's sign.
+    """
+    with span('houses'):
+        return ephemeris_cache.houses(
+            jd_ut, lat, lon, house_system,
+            lambda: swe.houses_ex(jd_ut, lat, lon, house_system.encode(), swe.FLG_SWIEPH))
+
+
+def compute_house_systems(chart, house_systems):
+    """
+    Cusps, angles and house placements of a ChartModel's bodies under
+    several house systems. The moment, place and body positions are the
+    chart's own, so only the cusps are computed per system. A system that
+    Swiss Ephemeris cannot build at the latitude (Placidus and Koch inside
+    the polar circles) gets an "error" entry instead.
+    """
+    positions = chart.planets_deg
+    systems = {}
+    for house_system in house_systems:
+        try:
+            cusps, ascmc = compute_house_cusps(chart.jd_ut, chart.latitude, chart.longitude, house_system)
+        except swe.Error:
+            systems[house_system] = {"name": HOUSE_SYSTEM_NAMES[house_system],
+                                     "error": "نظام البيوت هذا لا يعمل عند خط العرض هذا."}
+            continue
+        systems[house_system] = {
+            "name": HOUSE_SYSTEM_NAMES[house_system],
+            "ascendant": ascmc[0],
+            "mc": ascmc[1],
+            "houses_deg": list(cusps[0:12]),
+            "houses": assign_houses(positions, cusps),
+        }
+    return systems
+
+
+def build_dst_notice(local_time, hour, minute, prefers_dst):
+    """Arabic notice describing the offset/DST used for the birth time."""
+    utc_offset_formatted = local_time.utc_offset
+    if local_time.ambiguous:
+        dst_type = "التوقيت الصيفي (الحدوث الأول)" if prefers_dst else "التوقيت الشتوي (الحدوث الثاني)"
+        dst_notice = f"ملاحظة: الوقت المدخل ({hour:02d}:{minute:02d}) يحدث مرتين في هذا التاريخ بسبب التوقيت الصيفي. تم استخدام {dst_type}."
+        return dst_notice + f" التوقيت المستخدم: {utc_offset_formatted}"
+
+    dst_hours = local_time.dst_hours
+    if dst_hours > 0:
+        dst_hours_str = f"{dst_hours:.1f}".rstrip('0').rstrip('.')
+        return f"✓ التوقيت الصيفي نشط في هذا التاريخ. التوقيت المستخدم: {utc_offset_formatted} (يتضمن +{dst_hours_str} ساعة توقيت صيفي)"
+    return f"التوقيت الشتوي (القياسي) نشط في هذا التاريخ. التوقيت المستخدم: {utc_offset_formatted}"
+
+
+def place_key(city, country):
+    """
+    The place in a chart key: its gazetteer coordinates, so "Cairo", "cairo "
+    and "القاهرة" are one place, else its name folded like geocoding's keys.
+    Never touches the network or the geocode cache.
+    """
+    coords = geocoding.get_gazetteer().lookup(city, country)
+    if coords:
+        return coords
+    return geocoding.normalize_name(city), geocoding.normalize_name(country)
+
+
+def birth_key(birth):
+    """Everything in a parsed birth record (parse_birth_data) that changes its chart."""
+    return (birth['year'], birth['month'], birth['day'], birth['hour'], birth['minute'],
+            place_key(birth['city'], birth['country']), birth.get('house_system', 'P'),
+            birth.get('prefers_dst', True))
+
+
+def compute_chart_model(birth, context=None):
+    """
+    Compute a natal chart for a birth record (see parse_birth_data) as a
+    ChartModel. Raises ChartInputError for unknown places, missing
+    timezones, non-existent local times and house systems that fail at
+    the latitude.
+    """
+    context = context or ChartContext()
+    chart_key = birth_key(birth)
+    chart = context.charts.get(chart_key)
+    if chart is not None:
+        trace('chart_reused', house_system=birth.get('house_system', 'P'))
+        return chart
+
+    if context.flight is not None:
+        chart = context.flight.do(chart_key, lambda: _compute_chart_model(birth, context))
+    else:
+        chart = _compute_chart_model(birth, context)
+    context.charts.put(chart_key, chart)
+    return chart
+
+
+def _compute_chart_model(birth, context):
+    year, month, day = birth['year'], birth['month'], birth['day']
+    hour, minute = birth['hour'], birth['minute']
+    city, country = birth['city'], birth['country']
+    house_system = birth.get('house_system', 'P')
+    prefers_dst = birth.get('prefers_dst', True)
+
+    location = context.resolve_location(city, country)
+    if location is None:
+        raise ChartInputError("لم نتمكن من العثور على المدينة/الدولة المدخلة. تحقق من الإملاء.")
+    lat, lon, timezone_str = location
+    if not timezone_str:
+        raise ChartInputError("لم يتم العثور على منطقة زمنية لهذا الموقع.")
+
+    try:
+        naive_dt = datetime(year, month, day, hour, minute)
+    except ValueError:
+        raise ChartInputError("التاريخ أو الوقت المدخل غير صالح.")
+
+    try:
+        local_time, jd_ut = context.local_time(timezone_str, naive_dt, prefers_dst)
+    except pytz.exceptions.NonExistentTimeError:
+        logging.warning("Non-existent time for %s at %04d-%02d-%02d %02d:%02d", timezone_str, year, month, day, hour, minute)
+        raise ChartInputError(f"الوقت المدخل ({hour:02d}:{minute:02d}) غير موجود في هذا التاريخ بسبب التوقيت الصيفي. الساعة تقدمت في هذا اليوم. يرجى إدخال وقت مختلف.")
+    if local_time.ambiguous:
+        trace('ambiguous_time', timezone=timezone_str, prefers_dst=prefers_dst)
+
+    local_dt, utc_dt = local_time.local_dt, local_time.utc_dt
+
+    trace('birth_data', year=year, month=month, day=day, hour=hour, minute=minute,
+          city=city, country=country, timezone=timezone_str, utc_offset=local_time.utc_offset,
+          dst_hours=local_time.dst_hours, local_time=local_dt, utc_time=utc_dt,
+          jd_ut=jd_ut, lat=lat, lon=lon)
+
+    try:
+        houses_cusps_full, ascmc = compute_house_cusps(jd_ut, lat, lon, house_system)
+    except swe.Error:
+        # Placidus and Koch cannot be built inside the polar circles.
+        raise ChartInputError("نظام البيوت المختار لا يعمل عند خط العرض هذا. جرّب نظاماً آخر (مثل Whole Sign أو Porphyry).")
+
+    trace('houses', house_system=house_system, ascendant=ascmc[0], mc=ascmc[1])
+
+    planets_deg, planets_speed = context.body_motion(jd_ut)
+    chart = ChartModel(jd_ut, lat, lon, house_system, ascmc[0], ascmc[1], houses_cusps_full,
+                       planets_deg, planets_speed, location=f"{city}, {country}", timezone=timezone_str,
+                       ambiguous=local_time.ambiguous, prefers_dst=prefers_dst, local_time=local_time)
+    for name_en, pos_deg, house in zip(chart.bodies, chart.lons, chart.houses):
+        trace('planet', name=name_en, degree=pos_deg, house=house)
+    return chart
+
+
+def compute_chart(birth, context=None):
+    """
+    The chart of compute_chart_model() as the result dict the JSON API
+    returns (angles, planets, houses, aspects, DST notice, ...), plus
+    "house_systems" (see compute_house_systems) when the record asks for them.
+    """
+    chart = compute_chart_model(birth, context)
+    with span('aspects'):
+        aspects = chart.aspects
+    result = chart.to_dict(aspects)
+    if birth.get('house_systems'):
+        result["house_systems"] = compute_house_systems(chart, birth['house_systems'])
+    return result
+
+
+# Stage results shared by the form and single-chart API requests of this process;
+# identical concurrent requests (here and in the other workers) share one computation.
+chart_flight = shared_flight('chart', ChartModel.to_bytes, ChartModel.from_bytes)
+form_context = ChartContext(max_entries=FORM_MEMO_ENTRIES, flight=chart_flight)
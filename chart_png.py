@@ -0,0 +1,152 @@
+# -- coding: utf-8 --
+"""
+Matplotlib (PNG) backend for the chart wheel.
+
+Matplotlib is imported on first use only, so processes that render SVG
+never pay for it.
+"""
+import io
+import base64
+
+import numpy as np
+
+from astro import PLANET_SYMBOLS, SIGN_SYMBOLS, SIGN_NAMES_ENGLISH, calculate_aspects, get_zodiac_info
+
+_plt = None
+
+
+def _pyplot():
+    global _plt
+    if _plt is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        _plt = plt
+    return _plt
+
+
+def render_chart_png(planets_deg, houses_deg, ascendant_deg, dpi=150):
+    """Create a visual representation of the astrological chart as PNG bytes."""
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(8, 8), subplot_kw={'projection': 'polar'})
+    
+    ax.set_theta_zero_location('W')
+    ax.set_theta_direction(1)
+    
+    rotation_offset = ascendant_deg
+    
+    inner_radius = 0.3
+    outer_radius = 1.0
+    
+    # Draw zodiac signs
+    for i in range(12):
+        start_deg = i * 30
+        
+        rotated_start_deg = (start_deg - rotation_offset) % 360
+        start_rad = np.deg2rad(rotated_start_deg)
+        
+        color = 'lightblue' if i % 2 == 0 else 'lightyellow'
+        ax.bar(start_rad, outer_radius - inner_radius, width=np.deg2rad(30), bottom=inner_radius, 
+               color=color, alpha=0.3, edgecolor='black', linewidth=1.0, align='edge')
+        
+        sign_center_deg = start_deg + 15
+        rotated_center_deg = (sign_center_deg - rotation_offset) % 360
+        sign_center_rad = np.deg2rad(rotated_center_deg)
+        
+        ax.text(sign_center_rad, outer_radius + 0.1, SIGN_SYMBOLS[SIGN_NAMES_ENGLISH[i]], 
+                fontsize=16, ha='center', va='center', weight='bold')
+    
+    # Draw inner circle
+    theta_full = np.linspace(0, 2*np.pi, 100)
+    ax.plot(theta_full, [inner_radius] * 100, color='black', linewidth=1.5)
+    
+    # Draw house cusps
+    for i, deg in enumerate(houses_deg):
+        rotated_deg = (deg - rotation_offset) % 360
+        theta = np.deg2rad(rotated_deg)
+        ax.plot([theta, theta], [inner_radius, outer_radius], color='black', linestyle='-', linewidth=2.0)
+        
+        house_num = i + 1
+        next_deg = houses_deg[(i + 1) % 12]
+        mid_deg = deg + ((next_deg - deg) % 360) / 2
+        
+        rotated_mid_deg = (mid_deg - rotation_offset) % 360
+        mid_rad = np.deg2rad(rotated_mid_deg)
+        
+        house_number_radius = inner_radius + 0.1
+        ax.text(mid_rad, house_number_radius, str(house_num), fontsize=10, ha='center', va='center', 
+                weight='bold', color='black')
+    
+    # Draw aspects
+    aspects = calculate_aspects(planets_deg)
+    aspect_radius = inner_radius - 0.05
+    
+    for aspect in aspects:
+        rotated_deg1 = (aspect['deg1'] - rotation_offset) % 360
+        rotated_deg2 = (aspect['deg2'] - rotation_offset) % 360
+        theta1 = np.deg2rad(rotated_deg1)
+        theta2 = np.deg2rad(rotated_deg2)
+        
+        num_points = 100
+        t_vals = np.linspace(0, 1, num_points)
+        x1 = aspect_radius * np.cos(theta1)
+        y1 = aspect_radius * np.sin(theta1)
+        x2 = aspect_radius * np.cos(theta2)
+        y2 = aspect_radius * np.sin(theta2)
+        
+        xs = x1 + t_vals * (x2 - x1)
+        ys = y1 + t_vals * (y2 - y1)
+        
+        rs = np.sqrt(xs**2 + ys**2)
+        thetas = np.arctan2(ys, xs)
+        
+        ax.plot(thetas, rs, color=aspect['color'], linewidth=aspect['linewidth'], 
+                alpha=0.6, linestyle='-', solid_capstyle='round')
+    
+    # Draw planets
+    planet_positions = {}
+    for name, deg in planets_deg.items():
+        rotated_deg = (deg - rotation_offset) % 360
+        theta = np.deg2rad(rotated_deg)
+        
+        radius = outer_radius - 0.15
+        for other_name, other_pos in planet_positions.items():
+            other_theta, other_radius = other_pos
+            angle_diff = abs(theta - other_theta)
+            if angle_diff > np.pi:
+                angle_diff = 2 * np.pi - angle_diff
+            
+            if angle_diff < np.deg2rad(10):
+                radius = other_radius - 0.08 if other_radius > outer_radius - 0.2 else other_radius + 0.08
+        
+        planet_positions[name] = (theta, radius)
+        
+        ax.text(theta, radius, PLANET_SYMBOLS.get(name, '?'), 
+                fontsize=14, ha='center', va='center', 
+                color='black', weight='bold')
+        
+        info = get_zodiac_info(deg)
+        degree_text = f"{int(info['degree_in_sign'])}°"
+        ax.text(theta, radius - 0.06, degree_text, 
+                fontsize=8, ha='center', va='center', color='darkblue')
+    
+    # Draw ASC line
+    asc_theta = np.deg2rad(0)
+    ax.plot([asc_theta, asc_theta], [0.0, outer_radius], color='black', linestyle='-', linewidth=3)
+    ax.text(asc_theta, outer_radius + 0.05, 'ASC', fontsize=12, ha='center', va='center', 
+            weight='bold', color='black')
+    
+    ax.set_rticks([])
+    ax.set_xticks(np.deg2rad(np.arange(0, 360, 30)))
+    ax.set_xticklabels([])
+    ax.set_ylim(0, outer_radius + 0.2)
+    
+    buf = io.BytesIO()
+    plt.savefig(buf, format='png', bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
+    return buf.getvalue()
+
+
+def create_chart_image(planets_deg, houses_deg, ascendant_deg):
+    """Create the chart PNG and return it base64-encoded (for data: URIs)."""
+    return base64.b64encode(render_chart_png(planets_deg, houses_deg, ascendant_deg)).decode('ascii')
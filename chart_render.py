@@ -0,0 +1,30 @@
+# -- coding: utf-8 --
+"""
+Chart rendering entry point.
+
+SVG (chart_svg) is the default backend; the matplotlib PNG backend
+(chart_png) is kept for clients that need a raster image and is selected
+with fmt='png' or FALAKY_CHART_FORMAT=png.
+"""
+import os
+
+CHART_FORMAT = os.environ.get('FALAKY_CHART_FORMAT', 'svg').lower()
+CHART_MIMETYPES = {'svg': 'image/svg+xml', 'png': 'image/png'}
+
+
+def render_chart(planets_deg, houses_deg, ascendant_deg, fmt=None, size=None):
+    """
+    Render the chart wheel and return (image_bytes, mimetype).
+    `size` is the pixel width for SVG, or the DPI-equivalent width for PNG.
+    """
+    fmt = (fmt or CHART_FORMAT).lower()
+    if fmt == 'svg':
+        from chart_svg import render_chart_svg, VIEWBOX
+        svg = render_chart_svg(planets_deg, houses_deg, ascendant_deg, size=size or VIEWBOX)
+        return svg.encode('utf-8'), CHART_MIMETYPES['svg']
+    if fmt == 'png':
+        from chart_png import render_chart_png
+        # The 8-inch figure comes out ~1200 px wide at the default 150 dpi.
+        dpi = 150 if not size else max(20, round(size / 8))
+        return render_chart_png(planets_deg, houses_deg, ascendant_deg, dpi=dpi), CHART_MIMETYPES['png']
+    raise ValueError(f"Unsupported chart format: {fmt}")
@@ -0,0 +1,165 @@
+# -- coding: utf-8 --
+"""
+Matplotlib-free SVG renderer for the chart wheel.
+
+Draws the same wheel as chart_png (sign ring, house cusps and numbers,
+aspect lines, planet glyphs with collision offsets, ASC line) straight
+into SVG markup. Everything that does not depend on the chart (the sign
+wedges, the polar grid, circles) is built once at import time; the sign
+ring is then turned by the ascendant with a single transform.
+
+Geometry follows the matplotlib figure: radii are in the same units
+(inner 0.3, outer 1.0, labels up to 1.2), theta zero is on the left and
+angles grow counter-clockwise.
+"""
+import math
+
+from astro import PLANET_SYMBOLS, SIGN_SYMBOLS, SIGN_NAMES_ENGLISH, calculate_aspects, get_zodiac_info
+
+VIEWBOX = 600                      # internal drawing units; width/height scale it
+CENTER = VIEWBOX / 2
+SCALE = CENTER / 1.22              # pixels per radius unit (ylim 1.2 plus a margin)
+PT = VIEWBOX / 576                 # one matplotlib point of the 8-inch figure
+
+INNER_RADIUS = 0.3
+OUTER_RADIUS = 1.0
+ASPECT_RADIUS = INNER_RADIUS - 0.05
+HOUSE_NUMBER_RADIUS = INNER_RADIUS + 0.1
+SIGN_LABEL_RADIUS = OUTER_RADIUS + 0.1
+GRID_RADIUS = OUTER_RADIUS + 0.2
+
+FONT = "DejaVu Sans, Segoe UI Symbol, Noto Sans Symbols, sans-serif"
+SIGN_COLORS = ('#add8e6', '#ffffe0')   # lightblue / lightyellow
+
+# Precomputed unit vectors for whole degrees; fractional angles fall back to math.
+_COS = [math.cos(math.radians(d)) for d in range(360)]
+_SIN = [math.sin(math.radians(d)) for d in range(360)]
+
+
+def _xy(theta_deg, radius):
+    """Screen position of a polar (theta, r) point of the wheel."""
+    if theta_deg == int(theta_deg):
+        d = int(theta_deg) % 360
+        c, s = _COS[d], _SIN[d]
+    else:
+        rad = math.radians(theta_deg)
+        c, s = math.cos(rad), math.sin(rad)
+    r = radius * SCALE
+    return CENTER - r * c, CENTER + r * s
+
+
+def _pt(theta_deg, radius):
+    x, y = _xy(theta_deg, radius)
+    return f"{x:.1f},{y:.1f}"
+
+
+def _text(theta_deg, radius, label, size, extra=''):
+    x, y = _xy(theta_deg, radius)
+    return (f'<text x="{x:.1f}" y="{y:.1f}" font-size="{size * PT:.1f}"{extra}>{label}</text>')
+
+
+def _build_static_layers():
+    r_in, r_out = INNER_RADIUS * SCALE, OUTER_RADIUS * SCALE
+
+    wedges = []
+    for i in range(12):
+        start, end = i * 30, i * 30 + 30
+        # Counter-clockwise on screen is sweep-flag 0 in SVG's y-down space.
+        wedges.append(
+            f'<path d="M{_pt(start, INNER_RADIUS)} L{_pt(start, OUTER_RADIUS)} '
+            f'A{r_out:.1f},{r_out:.1f} 0 0 0 {_pt(end, OUTER_RADIUS)} '
+            f'L{_pt(end, INNER_RADIUS)} A{r_in:.1f},{r_in:.1f} 0 0 1 {_pt(start, INNER_RADIUS)}Z" '
+            f'fill="{SIGN_COLORS[i % 2]}"/>')
+    sign_ring = (f'<g fill-opacity="0.3" stroke="#000" stroke-width="{1.0 * PT:.2f}">'
+                 + ''.join(wedges) + '</g>')
+
+    grid = [f'<line x1="{CENTER:.1f}" y1="{CENTER:.1f}" x2="{_xy(d, GRID_RADIUS)[0]:.1f}" '
+            f'y2="{_xy(d, GRID_RADIUS)[1]:.1f}"/>' for d in range(0, 360, 30)]
+    background = (
+        f'<rect width="{VIEWBOX}" height="{VIEWBOX}" fill="#fff"/>'
+        f'<g stroke="#b0b0b0" stroke-width="{0.8 * PT:.2f}">' + ''.join(grid) + '</g>'
+        f'<circle cx="{CENTER:.1f}" cy="{CENTER:.1f}" r="{GRID_RADIUS * SCALE:.1f}" '
+        f'fill="none" stroke="#000" stroke-width="{0.8 * PT:.2f}"/>')
+
+    inner_circle = (f'<circle cx="{CENTER:.1f}" cy="{CENTER:.1f}" r="{r_in:.1f}" fill="none" '
+                    f'stroke="#000" stroke-width="{1.5 * PT:.2f}"/>')
+
+    asc_x, asc_y = _xy(0, OUTER_RADIUS)
+    asc = (f'<line x1="{CENTER:.1f}" y1="{CENTER:.1f}" x2="{asc_x:.1f}" y2="{asc_y:.1f}" '
+           f'stroke="#000" stroke-width="{3 * PT:.2f}"/>'
+           + _text(0, OUTER_RADIUS + 0.05, 'ASC', 12, ' font-weight="bold"'))
+    return background, sign_ring, inner_circle, asc
+
+
+_BACKGROUND, _SIGN_RING, _INNER_CIRCLE, _ASC = _build_static_layers()
+_SIGN_GLYPHS = [SIGN_SYMBOLS[name] for name in SIGN_NAMES_ENGLISH]
+
+
+def render_chart_svg(planets_deg, houses_deg, ascendant_deg, size=VIEWBOX):
+    """Render the chart wheel as an SVG document string, `size` pixels square."""
+    rot = ascendant_deg
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}" height="{size}" '
+        f'viewBox="0 0 {VIEWBOX} {VIEWBOX}" font-family="{FONT}" text-anchor="middle" '
+        f'dominant-baseline="central">',
+        _BACKGROUND,
+        # Ecliptic degree d sits at theta = d - ascendant; SVG rotates clockwise.
+        f'<g transform="rotate({rot:.3f} {CENTER:.1f} {CENTER:.1f})">{_SIGN_RING}</g>',
+    ]
+
+    parts.append('<g font-weight="bold">')
+    for i in range(12):
+        parts.append(_text((i * 30 + 15 - rot) % 360, SIGN_LABEL_RADIUS, _SIGN_GLYPHS[i], 16))
+    parts.append('</g>')
+
+    parts.append(_INNER_CIRCLE)
+
+    # House cusps and numbers
+    cusp_lines = []
+    numbers = []
+    for i, deg in enumerate(houses_deg):
+        theta = (deg - rot) % 360
+        x1, y1 = _xy(theta, INNER_RADIUS)
+        x2, y2 = _xy(theta, OUTER_RADIUS)
+        cusp_lines.append(f'<line x1="{x1:.1f}" y1="{y1:.1f}" x2="{x2:.1f}" y2="{y2:.1f}"/>')
+        next_deg = houses_deg[(i + 1) % len(houses_deg)]
+        mid_deg = deg + ((next_deg - deg) % 360) / 2
+        numbers.append(_text((mid_deg - rot) % 360, HOUSE_NUMBER_RADIUS, str(i + 1), 10))
+    parts.append(f'<g stroke="#000" stroke-width="{2 * PT:.2f}">' + ''.join(cusp_lines) + '</g>')
+    parts.append('<g font-weight="bold">' + ''.join(numbers) + '</g>')
+
+    # Aspects: straight chords at the aspect radius
+    aspect_lines = []
+    for aspect in calculate_aspects(planets_deg):
+        x1, y1 = _xy((aspect['deg1'] - rot) % 360, ASPECT_RADIUS)
+        x2, y2 = _xy((aspect['deg2'] - rot) % 360, ASPECT_RADIUS)
+        aspect_lines.append(
+            f'<line x1="{x1:.1f}" y1="{y1:.1f}" x2="{x2:.1f}" y2="{y2:.1f}" '
+            f'stroke="{aspect["color"]}" stroke-width="{aspect["linewidth"] * PT:.2f}"/>')
+    if aspect_lines:
+        parts.append('<g stroke-opacity="0.6" stroke-linecap="round">' + ''.join(aspect_lines) + '</g>')
+
+    # Planets, pushed in or out when closer than 10 degrees to one already placed
+    placed = []
+    glyphs = []
+    degrees = []
+    for name, deg in planets_deg.items():
+        theta = (deg - rot) % 360
+        radius = OUTER_RADIUS - 0.15
+        for other_theta, other_radius in placed:
+            angle_diff = abs(theta - other_theta)
+            if angle_diff > 180:
+                angle_diff = 360 - angle_diff
+            if angle_diff < 10:
+                radius = other_radius - 0.08 if other_radius > OUTER_RADIUS - 0.2 else other_radius + 0.08
+        placed.append((theta, radius))
+
+        glyphs.append(_text(theta, radius, PLANET_SYMBOLS.get(name, '?'), 14))
+        info = get_zodiac_info(deg)
+        degrees.append(_text(theta, radius - 0.06, f"{int(info['degree_in_sign'])}°", 8))
+    parts.append('<g font-weight="bold">' + ''.join(glyphs) + '</g>')
+    parts.append('<g fill="#00008b">' + ''.join(degrees) + '</g>')
+
+    parts.append(_ASC)
+    parts.append('</svg>')
+    return ''.join(parts)
@@ -0,0 +1,289 @@
+# -- coding: utf-8 --
+"""
+Sky of the day: one precomputed object per date and timezone band.
+
+A band is a whole-hour UTC offset from -12 to +14. For a date and a band
+the object holds:
+- the sky at local noon: every body's longitude, sign, speed and
+  retrograde flag (chart_pipeline.compute_sky);
+- the moon phase and the planets that are retrograde;
+- the ingresses and stations that fall within the local day
+  (event_finder);
+- for each of the twelve signs of daily_horoscopes.json, the transits in
+  aspect to it by whole sign. This is the sun-sign reading of a transit:
+  a planet three signs away squares the sign.
+The sign entries are keyed like daily_horoscopes.json and
+/api/horoscopes/<sign>, so a horoscope page can show its text next to the
+actual transits.
+
+All bands of a date are built together, and the events are found once
+over the union of the local days. The result is written to
+static/daily_sky/<date>.json next to daily_horoscopes.json. DailySky
+serves the bands from memory as ready-to-send bytes with an ETag. A date
+nobody has built yet is built on first hit, once across workers
+(single_flight).
+
+build_ahead() builds today and the next AHEAD_DAYS days. Each gunicorn
+worker runs it hourly from a daemon thread (start_scheduler, started by
+gunicorn.conf.py), and only the first worker to reach a date builds it.
+It can also run from cron:
+
+    python daily_sky.py build --days 7
+
+Under preload the master only loads the files already built
+(load_ahead): building would open the ephemeris cache's SQLite
+connection before the fork.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+from astro import PLANET_IDS, SIGN_NAMES_ARABIC, SIGN_NAMES_ENGLISH
+from chart_model import jd_to_utc
+from chart_pipeline import compute_sky, julian_day
+from single_flight import FLIGHT_DIR, SingleFlight
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SKY_DIR = os.environ.get('FALAKY_DAILY_SKY_DIR', os.path.join(BASE_DIR, 'static', 'daily_sky'))
+# Days pre-built after today (scheduler and the build command).
+AHEAD_DAYS = int(os.environ.get('FALAKY_DAILY_SKY_AHEAD', 3))
+# Dates served, and files kept, this many days either side of today.
+MAX_DAYS = int(os.environ.get('FALAKY_DAILY_SKY_MAX_DAYS', 90))
+MEMORY_DAYS = 8
+# Bump when the object changes so old files are rebuilt.
+SKY_VERSION = 1
+
+BANDS = range(-12, 15)
+EVENT_KINDS = ('ingress', 'station')
+# Whole-sign aspects: signs from the transit to the sign -> aspect.
+SIGN_ASPECTS = {0: 'conjunction', 2: 'sextile', 10: 'sextile', 3: 'square', 9: 'square',
+                4: 'trine', 8: 'trine', 6: 'opposition'}
+MOON_PHASES = (
+    ('new_moon', 'المحاق'), ('waxing_crescent', 'هلال متزايد'), ('first_quarter', 'التربيع الأول'),
+    ('waxing_gibbous', 'أحدب متزايد'), ('full_moon', 'البدر'), ('waning_gibbous', 'أحدب متناقص'),
+    ('last_quarter', 'التربيع الأخير'), ('waning_crescent', 'هلال متناقص'),
+)
+
+
+def band_label(band):
+    return f"{band:+03d}:00"
+
+
+def band_for_offset(hours):
+    """The band of a UTC offset in hours (+5:30 and +5:45 go to +6)."""
+    return min(max(math.floor(hours + 0.5), BANDS[0]), BANDS[-1])
+
+
+def moon_phase(sun_deg, moon_deg):
+    elongation = (moon_deg - sun_deg) % 360.0
+    name_en, name_ar = MOON_PHASES[int(((elongation + 22.5) % 360.0) // 45)]
+    return {"name_en": name_en, "name_ar": name_ar, "elongation": round(elongation, 4),
+            "illumination": round((1 - math.cos(math.radians(elongation))) / 2, 4), "waxing": elongation < 180}
+
+
+def sign_transits(planets):
+    """{horoscope key: sign with the planets in whole-sign aspect to it (their signs are in "planets")}."""
+    signs = {}
+    for index, sign_en in enumerate(SIGN_NAMES_ENGLISH):
+        transits = []
+        for planet in planets:
+            aspect = SIGN_ASPECTS.get((SIGN_NAMES_ENGLISH.index(planet['sign_en']) - index) % 12)
+            if aspect:
+                transits.append({"body": planet['name_en'], "body_ar": planet['name_ar'], "aspect": aspect})
+        signs[sign_en.lower()] = {"sign_en": sign_en, "sign_ar": SIGN_NAMES_ARABIC[index], "transits": transits}
+    return signs
+
+
+def build_day(day):
+    """{band label: sky object} for every band of a date."""
+    from event_finder import find_events
+    midnight = julian_day(datetime(day.year, day.month, day.day))
+    # Union of the local days of all bands, in UTC.
+    events = list(find_events(midnight - BANDS[-1] / 24.0, midnight + 1 - BANDS[0] / 24.0, kinds=EVENT_KINDS))
+
+    bands = {}
+    for band in BANDS:
+        start = midnight - band / 24.0
+        noon = start + 0.5
+        sky = compute_sky(noon)
+        planets = [body for body in sky if body['name_en'] in PLANET_IDS]
+        positions = {body['name_en']: body['degree'] for body in sky}
+        local_events = []
+        for event in events:
+            if start <= event['jd_ut'] < start + 1:
+                local = jd_to_utc(event['jd_ut']) + timedelta(hours=band)
+                local_events.append(dict(event, local_time=local.strftime("%Y-%m-%d %H:%M:%S")))
+        bands[band_label(band)] = {
+            "date": day.isoformat(),
+            "band": band_label(band),
+            "noon_utc": jd_to_utc(noon).strftime("%Y-%m-%d %H:%M UTC"),
+            "jd_ut": noon,
+            "planets": sky,
+            "moon_phase": moon_phase(positions['Sun'], positions['Moon']),
+            "retrogrades": [body['name_en'] for body in planets if body['retrograde']],
+            "events": local_events,
+            "signs": sign_transits(planets),
+        }
+    return bands
+
+
+class _Day:
+    """One date's bands as ready-to-send bytes with their ETags."""
+
+    __slots__ = ('bands',)
+
+    def __init__(self, data):
+        self.bands = {}
+        for band, sky in data['bands'].items():
+            body = json.dumps(sky, ensure_ascii=False).encode('utf-8')
+            self.bands[band] = (body, f"sky-{data['date']}-{band}-v{SKY_VERSION}")
+
+
+class _SkyFiles:
+    """Flight store for builds: the date's file, which the leading worker has just written."""
+
+    def __init__(self, sky):
+        self.sky = sky
+
+    def get(self, day):
+        return self.sky._read_file(day)
+
+    def put(self, day, data):
+        pass
+
+
+class DailySky:
+    def __init__(self, directory=SKY_DIR, memory_days=MEMORY_DAYS):
+        self.directory = directory
+        self.memory_days = memory_days
+        self._days = OrderedDict()   # ISO date -> _Day, least recently used first
+        self._lock = threading.Lock()
+        self.flight = SingleFlight('sky', FLIGHT_DIR or None, _SkyFiles(self))
+        self.stats = {'memory_hits': 0, 'file_loads': 0, 'builds': 0}
+
+    def _path(self, day):
+        return os.path.join(self.directory, f"{day.isoformat()}.json")
+
+    def _read_file(self, day):
+        try:
+            with open(self._path(day), encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data if data.get('version') == SKY_VERSION else None
+
+    def _build(self, day):
+        data = {"version": SKY_VERSION, "date": day.isoformat(), "bands": build_day(day)}
+        self.stats['builds'] += 1
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(day))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return data
+
+    def _load(self, day):
+        data = self._read_file(day)
+        if data is not None:
+            self.stats['file_loads'] += 1
+            return data
+        return self.flight.do(day, lambda: self._read_file(day) or self._build(day))
+
+    def day(self, day):
+        """The _Day of a date: from memory, from its file, or built now."""
+        key = day.isoformat()
+        with self._lock:
+            entry = self._days.get(key)
+            if entry is not None:
+                self._days.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return entry
+        entry = _Day(self._load(day))
+        with self._lock:
+            self._days[key] = entry
+            self._days.move_to_end(key)
+            while len(self._days) > self.memory_days:
+                self._days.popitem(last=False)
+        return entry
+
+    def get(self, day, band):
+        """(JSON bytes, ETag) of one date and band."""
+        return self.day(day).bands[band_label(band)]
+
+    def load_ahead(self, days=AHEAD_DAYS, today=None):
+        """Load the files of the dates build_ahead() covers that are already built; builds nothing."""
+        today = today or date.today()
+        for offset in range(-1, days + 1):
+            day = today + timedelta(days=offset)
+            if os.path.exists(self._path(day)):
+                self.day(day)
+
+    def build_ahead(self, days=AHEAD_DAYS, today=None):
+        """Load (building if needed) today and the next days, and delete files past MAX_DAYS ago."""
+        today = today or date.today()
+        for offset in range(-1, days + 1):   # yesterday too: it is still that day west of UTC
+            self.day(today + timedelta(days=offset))
+        oldest = (today - timedelta(days=MAX_DAYS)).isoformat()
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.json') and name[:-5] < oldest:
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError as e:
+                    logging.warning("Could not remove old sky file %s: %s", name, e)
+
+
+daily_sky = DailySky()
+_scheduler = None
+
+
+def start_scheduler(interval=3600):
+    """Run daily_sky.build_ahead() now and every `interval` seconds on a daemon thread of this process."""
+    global _scheduler
+    if _scheduler is not None and _scheduler.is_alive():
+        return _scheduler
+
+    def run():
+        while True:
+            try:
+                daily_sky.build_ahead()
+            except Exception as e:
+                logging.error("Daily sky pre-build failed: %s", e)
+            time.sleep(interval)
+
+    _scheduler = threading.Thread(target=run, name='daily-sky', daemon=True)
+    _scheduler.start()
+    return _scheduler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-build the daily sky objects.")
+    parser.add_argument('command', choices=('build',))
+    parser.add_argument('--days', type=int, default=AHEAD_DAYS, help="days after today to build")
+    parser.add_argument('--start', help="YYYY-MM-DD instead of today")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    today = date.fromisoformat(args.start) if args.start else date.today()
+    started = time.perf_counter()
+    daily_sky.build_ahead(args.days, today)
+    print(f"{args.days + 2} days ready in {daily_sky.directory} ({daily_sky.stats['builds']} built, "
+          f"{time.perf_counter() - started:.2f} s)")
+
+
+if __name__ == '__main__':
+    main()
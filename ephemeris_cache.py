@@ -0,0 +1,189 @@
+# -- coding: utf-8 --
+"""
+Ephemeris results shared between gunicorn workers, and house cusps per worker.
+
+Body positions are cached per (Julian day, body, flags). The shared tier
+is a SQLite file in WAL mode (FALAKY_EPHEMERIS_CACHE, like the geocode
+cache), so a popular birth date is computed once for all workers. It is
+bounded to about FALAKY_EPHEMERIS_CACHE_ROWS rows (checked every
+EVICT_EVERY inserts), and the least recently used rows are evicted
+first. A small in-process LRU sits in front of it, so a hot
+key does not even need a SQLite read. Callers pass shared=False for
+instants nobody will ask for again (the current sky, a new one every
+second), which would only push useful rows out of the shared tier.
+
+House cusps per (Julian day, lat, lon, house system) are kept in the
+in-process LRU only: one swe.houses_ex call is cheaper than a SQLite
+lookup and write, so a shared tier would slow down every miss.
+
+Hit/miss counters per tier are in `stats` and are exported on /metrics.
+Setting FALAKY_EPHEMERIS_CACHE to an empty string keeps only the
+in-process tier.
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+EPHEMERIS_CACHE_PATH = os.environ.get(
+    'FALAKY_EPHEMERIS_CACHE', os.path.join(BASE_DIR, 'cache', 'ephemeris.sqlite3'))
+MAX_ROWS = int(os.environ.get('FALAKY_EPHEMERIS_CACHE_ROWS', 500000))
+MEMORY_ENTRIES = int(os.environ.get('FALAKY_EPHEMERIS_MEMORY_ENTRIES', 4096))
+# A hit refreshes a row's LRU timestamp at most this often, to keep reads mostly read-only.
+TOUCH_SECONDS = 300
+# How many inserts between two size checks of a table.
+EVICT_EVERY = 256
+
+
+class EphemerisCache:
+    def __init__(self, path=EPHEMERIS_CACHE_PATH, max_rows=MAX_ROWS, memory_entries=MEMORY_ENTRIES):
+        self.path = path or None
+        self.max_rows = max_rows
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._inserts = {'bodies': 0}
+        self.stats = {kind: {'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0}
+                      for kind in ('bodies', 'houses')}
+
+    def _connection(self):
+        # Connections must not cross a fork, so reopen in each gunicorn worker.
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS bodies ('
+                ' jd REAL, flags INTEGER, body INTEGER, lon REAL, speed REAL, used INTEGER NOT NULL,'
+                ' PRIMARY KEY (jd, flags, body))')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS bodies_used ON bodies (used)')
+            self._pid = os.getpid()
+        return self._conn
+
+    # -- in-process tier -------------------------------------------------
+    def _memory_get(self, key):
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+            return value
+
+    def _memory_put(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    # -- shared tier -----------------------------------------------------
+    def _evict(self, conn, table):
+        """Trim a table to max_rows, oldest `used` first. Caller holds the lock."""
+        self._inserts[table] += 1
+        if self._inserts[table] % EVICT_EVERY:
+            return
+        count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        excess = count - self.max_rows
+        if excess > 0:
+            conn.execute(f'DELETE FROM {table} WHERE rowid IN '
+                         f'(SELECT rowid FROM {table} ORDER BY used LIMIT ?)', (excess,))
+            self.stats[table]['evictions'] += excess
+
+    def body_motion(self, jd, body_ids, flags, compute, shared=True):
+        """
+        {body id: (longitude, speed)} for `body_ids` at `jd`.
+        compute(jd, body_id, flags) -> (longitude, speed) fills misses.
+        shared=False uses the in-process tier only.
+        """
+        key = ('bodies', jd, flags, tuple(body_ids))
+        result = self._memory_get(key)
+        if result is not None:
+            self.stats['bodies']['memory_hits'] += 1
+            return result
+
+        result = {}
+        use_shared = self.path and shared
+        if use_shared:
+            try:
+                with self._lock:
+                    rows = self._connection().execute(
+                        'SELECT body, lon, speed, used FROM bodies WHERE jd = ? AND flags = ?', (jd, flags)).fetchall()
+                now = int(time.time())
+                wanted = set(body_ids)
+                stale = []
+                for body, lon, speed, used in rows:
+                    if body in wanted:
+                        result[body] = (lon, speed)
+                        if now - used > TOUCH_SECONDS:
+                            stale.append(body)
+                if stale:
+                    with self._lock:
+                        conn = self._connection()
+                        conn.executemany('UPDATE bodies SET used = ? WHERE jd = ? AND flags = ? AND body = ?',
+                                         [(now, jd, flags, body) for body in stale])
+                        conn.commit()
+            except sqlite3.Error as e:
+                logging.warning("Ephemeris cache read failed: %s", e)
+                result = {}
+
+        missing = [body for body in body_ids if body not in result]
+        if not missing:
+            self.stats['bodies']['shared_hits'] += 1
+        else:
+            self.stats['bodies']['misses'] += 1
+            computed = {}
+            for body in missing:
+                try:
+                    computed[body] = compute(jd, body, flags)
+                except Exception as e:
+                    logging.error("Error calculating planet %s: %s", body, e)
+            result.update(computed)
+            if use_shared and computed:
+                now = int(time.time())
+                try:
+                    with self._lock:
+                        conn = self._connection()
+                        conn.executemany(
+                            'INSERT OR REPLACE INTO bodies (jd, flags, body, lon, speed, used) VALUES (?, ?, ?, ?, ?, ?)',
+                            [(jd, flags, body, lon, speed, now) for body, (lon, speed) in computed.items()])
+                        self._evict(conn, 'bodies')
+                        conn.commit()
+                except sqlite3.Error as e:
+                    logging.warning("Ephemeris cache write failed: %s", e)
+            if len(computed) != len(missing):
+                return result   # do not remember a partial answer
+        self._memory_put(key, result)
+        return result
+
+    def houses(self, jd, lat, lon, house_system, compute):
+        """(cusps, ascmc) at a moment and place, from the in-process tier; compute() fills a miss."""
+        key = ('houses', jd, lat, lon, house_system)
+        result = self._memory_get(key)
+        if result is not None:
+            self.stats['houses']['memory_hits'] += 1
+            return result
+
+        self.stats['houses']['misses'] += 1
+        cusps, ascmc = compute()
+        result = (tuple(cusps), tuple(ascmc))
+        self._memory_put(key, result)
+        return result
+
+    def hit_rate(self, kind):
+        """Share of lookups answered by either tier (None before the first lookup)."""
+        stats = self.stats[kind]
+        hits = stats['memory_hits'] + stats['shared_hits']
+        total = hits + stats['misses']
+        return hits / total if total else None
+
+    def clear_memory(self):
+        with self._lock:
+            self._memory.clear()
+
+
+ephemeris_cache = EphemerisCache()
@@ -0,0 +1,297 @@
+# -- coding: utf-8 --
+"""
+Precomputed, memory-mapped ephemeris table for fast transit lookups.
+
+A build step samples every body's longitude and speed at a fixed step
+over a range of years and writes them to a compact binary file (float32,
+about 39 MB for 50 years at one hour). At runtime the file is mapped
+read-only, so all workers share it, and a position is a cubic Hermite
+interpolation between the two surrounding samples. A lookup needs a
+couple of array reads and no Swiss Ephemeris call, and whole arrays of
+times are answered in one vectorized call.
+
+The build also measures the worst interpolation error per body against
+swe.calc_ut on random instants and stores it in the header. Lookups can
+therefore state their accuracy (usually well under an arcsecond at a
+one-hour step).
+
+Transit lookups go through it when it covers the instant: the current
+sky (chart_pipeline.compute_sky, so /api/planets/now and daily_sky),
+event_finder's root finding and birth_time_sweep. Outside the table's
+range, or without a table, they fall back to Swiss Ephemeris. Natal
+charts always use Swiss Ephemeris directly.
+
+    python ephemeris_table.py build --start-year 2000 --end-year 2050
+    python ephemeris_table.py verify
+    python ephemeris_table.py bench
+"""
+import argparse
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+import swisseph as swe
+
+from astro import PLANET_IDS
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TABLE_PATH = os.environ.get(
+    'FALAKY_EPHEMERIS_TABLE', os.path.join(BASE_DIR, 'cache', 'ephemeris_table.bin'))
+
+TABLE_BODIES = dict(PLANET_IDS, Rahu=swe.MEAN_NODE)
+MAGIC = b'FLKEPH01'
+# magic, n_bodies, n_steps, jd_start, step_days
+_HEADER = struct.Struct('<8sIQdd')
+
+
+def _header_size(n_bodies):
+    # fixed header + body ids (int32) + per-body max error (float64), padded to 64 bytes
+    raw = _HEADER.size + 4 * n_bodies + 8 * n_bodies
+    return (raw + 63) // 64 * 64
+
+
+def _calc(jd, pid):
+    pos = swe.calc_ut(jd, pid, swe.FLG_SWIEPH | swe.FLG_SPEED)[0]
+    return pos[0], pos[3]
+
+
+def build_table(path, start_year, end_year, step_hours=1.0, bodies=TABLE_BODIES, verify_samples=2000,
+                progress=None):
+    """Sample all bodies from 1 Jan start_year to 1 Jan end_year + 1 and write the table."""
+    jd_start = swe.julday(start_year, 1, 1, 0.0)
+    jd_end = swe.julday(end_year + 1, 1, 1, 0.0)
+    step = step_hours / 24.0
+    n_steps = int(np.ceil((jd_end - jd_start) / step)) + 2   # one extra sample past the end
+    names = list(bodies)
+    n_bodies = len(names)
+    header_size = _header_size(n_bodies)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, n_bodies, n_steps, jd_start, step))
+        f.write(struct.pack(f'<{n_bodies}i', *[bodies[name] for name in names]))
+        f.write(struct.pack(f'<{n_bodies}d', *([0.0] * n_bodies)))
+        f.write(b'\0' * (header_size - f.tell()))
+        f.truncate(header_size + n_steps * n_bodies * 2 * 4)
+
+    data = np.memmap(tmp_path, dtype=np.float32, mode='r+', offset=header_size, shape=(n_steps, n_bodies, 2))
+    chunk = 10000
+    for first in range(0, n_steps, chunk):
+        last = min(first + chunk, n_steps)
+        block = np.empty((last - first, n_bodies, 2), dtype=np.float32)
+        for i in range(first, last):
+            jd = jd_start + i * step
+            for b, name in enumerate(names):
+                block[i - first, b] = _calc(jd, bodies[name])
+        data[first:last] = block
+        if progress:
+            progress(last, n_steps)
+    data.flush()
+    del data
+    os.replace(tmp_path, path)
+
+    table = EphemerisTable(path)
+    errors = table.measure_error(verify_samples)
+    table.close()
+    with open(path, 'r+b') as f:
+        f.seek(_HEADER.size + 4 * n_bodies)
+        f.write(struct.pack(f'<{n_bodies}d', *[errors[name] for name in names]))
+    return errors
+
+
+class EphemerisTable:
+    """Read-only view of a table file; all lookups are vectorized over jd."""
+
+    def __init__(self, path=DEFAULT_TABLE_PATH):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, n_bodies, n_steps, jd_start, step = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an ephemeris table")
+            ids = struct.unpack(f'<{n_bodies}i', f.read(4 * n_bodies))
+            errors = struct.unpack(f'<{n_bodies}d', f.read(8 * n_bodies))
+        id_to_name = {pid: name for name, pid in TABLE_BODIES.items()}
+        self.names = [id_to_name.get(pid, str(pid)) for pid in ids]
+        self.body_index = {name: i for i, name in enumerate(self.names)}
+        self.max_error = dict(zip(self.names, errors))   # degrees, measured at build time
+        self.jd_start = jd_start
+        self.step = step
+        self.n_steps = n_steps
+        self.jd_end = jd_start + (n_steps - 2) * step
+        self.data = np.memmap(path, dtype=np.float32, mode='r', offset=_header_size(n_bodies),
+                              shape=(n_steps, n_bodies, 2))
+
+    def close(self):
+        mm = getattr(self.data, '_mmap', None)
+        self.data = None
+        if mm is not None:
+            mm.close()
+
+    def covers(self, jd):
+        jd = np.asarray(jd)
+        return bool(np.all((jd >= self.jd_start) & (jd < self.jd_end)))
+
+    def lookup(self, jd, bodies=None):
+        """
+        Longitudes and speeds for an array of Julian days (UT).
+        Returns (lon[N, B], speed[N, B]) in degrees and degrees/day, with
+        B following `bodies` (default: every body in the table).
+        """
+        jd = np.atleast_1d(np.asarray(jd, dtype=np.float64))
+        if not self.covers(jd):
+            raise ValueError(f"Julian day outside table range [{self.jd_start}, {self.jd_end})")
+        cols = slice(None) if bodies is None else [self.body_index[name] for name in bodies]
+
+        pos = (jd - self.jd_start) / self.step
+        idx = np.floor(pos).astype(np.int64)
+        t = (pos - idx)[:, None]
+        a = self.data[idx][:, cols].astype(np.float64)
+        b = self.data[idx + 1][:, cols].astype(np.float64)
+        p0, v0 = a[..., 0], a[..., 1] * self.step
+        v1 = b[..., 1] * self.step
+        delta = (b[..., 0] - p0 + 180.0) % 360.0 - 180.0
+
+        # Cubic Hermite on (position, derivative) at both ends of the step.
+        t2, t3 = t * t, t * t * t
+        lon = p0 + (t3 - 2 * t2 + t) * v0 + (-2 * t3 + 3 * t2) * delta + (t3 - t2) * v1
+        speed = a[..., 1] + (b[..., 1] - a[..., 1]) * t   # see motion_at()
+        return lon % 360.0, speed
+
+    def longitude(self, jd, body):
+        """Scalar convenience wrapper: longitude of one body at one instant."""
+        return float(self.lookup(jd, [body])[0][0, 0])
+
+    def motion_at(self, jd, body):
+        """
+        (longitude, speed) of one body at one covered instant, the same
+        interpolation as lookup() in plain floats: a root finder calling it
+        thousands of times would spend more on numpy's per-call overhead.
+        """
+        pos = (jd - self.jd_start) / self.step
+        idx = int(pos)
+        t = pos - idx
+        b = self.body_index[body]
+        p0, s0 = self.data[idx, b].tolist()
+        p1, s1 = self.data[idx + 1, b].tolist()
+        v0, v1 = s0 * self.step, s1 * self.step
+        delta = (p1 - p0 + 180.0) % 360.0 - 180.0
+        t2 = t * t
+        t3 = t2 * t
+        lon = p0 + (t3 - 2 * t2 + t) * v0 + (-2 * t3 + 3 * t2) * delta + (t3 - t2) * v1
+        # Speed is interpolated linearly between the stored speeds rather than taken from the
+        # cubic's derivative, which divides a float32 position difference by the step and is
+        # too coarse near a station.
+        speed = s0 + (s1 - s0) * t
+        return lon % 360.0, speed
+
+    def measure_error(self, samples=2000, seed=0):
+        """Worst absolute longitude error (degrees) per body against swe.calc_ut."""
+        rng = np.random.default_rng(seed)
+        jds = rng.uniform(self.jd_start, self.jd_end, samples)
+        lon, _ = self.lookup(jds)
+        errors = {}
+        for b, name in enumerate(self.names):
+            pid = TABLE_BODIES[name]
+            exact = np.array([_calc(jd, pid)[0] for jd in jds])
+            diff = np.abs((lon[:, b] - exact + 180.0) % 360.0 - 180.0)
+            errors[name] = float(diff.max())
+        return errors
+
+
+_table = None
+_table_path = None
+
+
+def load_table(path=DEFAULT_TABLE_PATH):
+    """The shared table for this process, or None when no table has been built."""
+    global _table, _table_path
+    if _table is None or _table_path != path:
+        if not os.path.exists(path):
+            return None
+        _table, _table_path = EphemerisTable(path), path
+    return _table
+
+
+def covering_table(jd_start, jd_end=None):
+    """The shared table when it covers [jd_start, jd_end] (or the instant jd_start), else None."""
+    table = load_table()
+    if table is None:
+        return None
+    if jd_start >= table.jd_start and (jd_end if jd_end is not None else jd_start) < table.jd_end:
+        return table
+    return None
+
+
+def transit_motion(jd):
+    """
+    ({body: longitude}, {body: speed}) at one instant, Ketu included, from
+    the table; None when no table covers jd.
+    """
+    table = covering_table(jd)
+    if table is None:
+        return None
+    lon, speed = table.lookup(jd)
+    positions, speeds = {}, {}
+    for name in TABLE_BODIES:
+        b = table.body_index[name]
+        positions[name], speeds[name] = float(lon[0, b]), float(speed[0, b])
+    positions['Ketu'] = (positions['Rahu'] + 180.0) % 360.0
+    speeds['Ketu'] = speeds['Rahu']
+    return positions, speeds
+
+
+def transit_longitudes(jd, path=DEFAULT_TABLE_PATH):
+    """
+    {body: longitude} at one instant (Ketu included): from the table
+    when it covers jd, otherwise straight from Swiss Ephemeris.
+    """
+    table = load_table(path)
+    if table is not None and table.covers(jd):
+        lon, _ = table.lookup(jd)
+        positions = dict(zip(table.names, lon[0].tolist()))
+    else:
+        positions = {name: _calc(jd, pid)[0] for name, pid in TABLE_BODIES.items()}
+    positions['Ketu'] = (positions['Rahu'] + 180.0) % 360.0
+    return positions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build, verify or benchmark the ephemeris table.")
+    parser.add_argument('command', choices=('build', 'verify', 'bench'))
+    parser.add_argument('--path', default=DEFAULT_TABLE_PATH)
+    parser.add_argument('--start-year', type=int, default=2000)
+    parser.add_argument('--end-year', type=int, default=2050)
+    parser.add_argument('--step-hours', type=float, default=1.0)
+    parser.add_argument('--samples', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        def progress(done, total):
+            print(f"\r{done}/{total} steps", end='', file=sys.stderr)
+        start = time.perf_counter()
+        errors = build_table(args.path, args.start_year, args.end_year, args.step_hours,
+                             verify_samples=args.samples, progress=progress)
+        print(f"\nBuilt {args.path} in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+    else:
+        table = EphemerisTable(args.path)
+        errors = table.measure_error(args.samples, seed=int(time.time())) if args.command == 'verify' \
+            else table.max_error
+
+    for name, err in errors.items():
+        print(f"{name:8s} max error {err * 3600:8.3f} arcsec")
+
+    if args.command == 'bench':
+        rng = np.random.default_rng(1)
+        jds = rng.uniform(table.jd_start, table.jd_end, 1_000_000)
+        start = time.perf_counter()
+        table.lookup(jds)
+        elapsed = time.perf_counter() - start
+        queries = jds.size * len(table.names)
+        print(f"{queries / elapsed / 1e6:.1f} M body positions/s ({jds.size} instants x {len(table.names)} bodies)")
+
+
+if __name__ == '__main__':
+    main()
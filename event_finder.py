@@ -0,0 +1,329 @@
+# -- coding: utf-8 --
+"""
+Astronomical event finder: sign ingresses, retrograde stations, exact
+transit aspects to a natal chart, and solar/lunar returns over a date
+range.
+
+Nothing is found by fixed-step scanning. For each body the range is cut
+at its stations, the points where its speed changes sign. Between two
+stations the longitude is monotonic, and the pieces are short enough that
+a body moves less than CHUNK_DEGREES in each. A target longitude (a sign
+boundary, natal point + aspect angle) is then crossed inside a piece
+exactly when it lies between the longitudes at the two ends, which also
+brackets the crossing. The crossing is refined with the Illinois variant
+of regula falsi to ROOT_TOLERANCE_SECONDS. Stations themselves are
+bracketed by sampling the speed every few days (STATION_STEP_DAYS), far
+more often than any retrograde period lasts, and refined the same way.
+Positions and speeds come from the ephemeris table (ephemeris_table.py)
+in windows it covers, and from Swiss Ephemeris elsewhere.
+
+find_events() is a generator. It works through the range in windows of
+WINDOW_DAYS and yields each window's events in time order, so a year of
+events can be streamed while the later months are still being computed.
+
+    python event_finder.py 2025-01-01 2026-01-01 --kinds ingress,station
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pytz
+import swisseph as swe
+
+from aspects import SYNASTRY_ASPECTS
+from astro import PLANET_NAMES_ARABIC, SIGN_NAMES_ARABIC, SIGN_NAMES_ENGLISH, get_zodiac_info
+from chart_model import jd_to_utc
+from chart_pipeline import CHART_BODIES, EPHEMERIS_FLAGS, ChartInputError, compute_chart, parse_birth_data
+from ephemeris_table import covering_table
+
+EVENT_KINDS = ('ingress', 'station', 'aspect', 'return')
+# Transiting bodies; Ketu mirrors Rahu, so it is only a natal point.
+TRANSIT_BODIES = dict(CHART_BODIES)
+# Conjunction included: exact transits are mostly read as conjunctions.
+EVENT_ASPECTS = {name: spec['angle'] for name, spec in SYNASTRY_ASPECTS.items()}
+RETURN_NAMES = {'Sun': 'solar', 'Moon': 'lunar'}
+
+# Upper bounds of |speed| in degrees/day, to size the bracketing pieces.
+MAX_SPEED = {'Moon': 15.5, 'Sun': 1.03, 'Mercury': 2.3, 'Venus': 1.3, 'Mars': 0.8, 'Jupiter': 0.25,
+             'Saturn': 0.14, 'Uranus': 0.07, 'Neptune': 0.04, 'Pluto': 0.05, 'Rahu': 0.06}
+# Speed sampling for stations; the Sun, the Moon and the mean node never station.
+STATION_STEP_DAYS = {'Mercury': 2.0, 'Venus': 4.0, 'Mars': 4.0, 'Jupiter': 8.0, 'Saturn': 8.0,
+                     'Uranus': 8.0, 'Neptune': 8.0, 'Pluto': 8.0}
+CHUNK_DEGREES = 170.0
+WINDOW_DAYS = 30.0
+ROOT_TOLERANCE_SECONDS = 1.0
+MAX_ITERATIONS = 100
+
+
+def _motion(jd_ut, pid):
+    pos = swe.calc_ut(jd_ut, pid, EPHEMERIS_FLAGS)[0]
+    return pos[0], pos[3]
+
+
+def _motion_of(pid, name, table=None):
+    """t -> (longitude, speed) of one body: from `table` when given (it covers the search), else swe."""
+    if table is not None and name in table.body_index:
+        return lambda t: table.motion_at(t, name)
+    return lambda t: _motion(t, pid)
+
+
+def _wrap(deg):
+    """Degrees wrapped into [-180, 180)."""
+    return (deg + 180.0) % 360.0 - 180.0
+
+
+def solve(func, a, b, fa, fb, tol=ROOT_TOLERANCE_SECONDS / 86400.0):
+    """
+    Root of func in [a, b], where fa = func(a) and fb = func(b) have
+    opposite signs (Illinois regula falsi).
+    """
+    side = 0
+    for _ in range(MAX_ITERATIONS):
+        if b - a <= tol:
+            break
+        c = (a * fb - b * fa) / (fb - fa)
+        fc = func(c)
+        if fc == 0.0:
+            return c
+        if (fc > 0) == (fb > 0):
+            b, fb = c, fc
+            if side == -1:
+                fa /= 2.0
+            side = -1
+        else:
+            a, fa = c, fc
+            if side == 1:
+                fb /= 2.0
+            side = 1
+    return (a + b) / 2.0
+
+
+def stations(pid, name, a, b, table=None):
+    """[(jd, 'retrograde' | 'direct')] for the stations of a body in [a, b)."""
+    step = STATION_STEP_DAYS.get(name)
+    if step is None:
+        return []
+    motion = _motion_of(pid, name, table)
+    speed = lambda t: motion(t)[1]   # noqa: E731
+    grid = np.append(np.arange(a, b, step), b).tolist()
+    found = []
+    prev_t, prev_v = grid[0], speed(grid[0])
+    for t in grid[1:]:
+        v = speed(t)
+        if (prev_v > 0) != (v > 0) and prev_v != 0.0:
+            found.append((solve(speed, prev_t, t, prev_v, v), 'retrograde' if prev_v > 0 else 'direct'))
+        prev_t, prev_v = t, v
+    return found
+
+
+def crossings(pid, name, a, b, targets, cuts=(), table=None):
+    """
+    Yield (jd, target index, retrograde) for every time the body's
+    longitude passes one of `targets` (array of degrees) in (a, b].
+    `cuts` are the body's stations inside the range.
+    """
+    motion = _motion_of(pid, name, table)
+    longitude = lambda t: motion(t)[0]   # noqa: E731
+    chunk = CHUNK_DEGREES / MAX_SPEED.get(name, 1.0)
+    bounds = [a]
+    for end in [t for t, _ in cuts] + [b]:
+        pieces = max(1, int(np.ceil((end - bounds[-1]) / chunk)))
+        bounds.extend(np.linspace(bounds[-1], end, pieces + 1)[1:].tolist())
+
+    l0 = longitude(bounds[0])
+    for c0, c1 in zip(bounds, bounds[1:]):
+        l1 = longitude(c1)
+        moved = _wrap(l1 - l0)
+        if moved > 0:
+            offsets = (targets - l0) % 360.0
+        else:
+            offsets = (l0 - targets) % 360.0
+        for i in np.flatnonzero((offsets > 0) & (offsets <= abs(moved))).tolist():
+            target = float(targets[i])
+            root = solve(lambda t: _wrap(longitude(t) - target), c0, c1, _wrap(l0 - target), _wrap(l1 - target))
+            yield root, i, moved < 0
+        l0 = l1
+
+
+def natal_points(chart):
+    """{name: degree} of the natal bodies plus the ascendant and MC when known."""
+    points = dict(chart.get('planets_deg') or {})
+    angles = chart.get('angles') or {}
+    for key in ('AC', 'MC'):
+        if key in angles:
+            points[key] = angles[key]['degree']
+    return points
+
+
+def _targets(name, kinds, points):
+    """Target longitudes for one transiting body and what crossing each one means."""
+    values, meanings = [], []
+    if 'ingress' in kinds:
+        for sign in range(12):
+            values.append(sign * 30.0)
+            meanings.append(('ingress', sign))
+    for point, degree in points.items():
+        for aspect, angle in EVENT_ASPECTS.items():
+            kind = 'return' if angle == 0 and point == name and name in RETURN_NAMES else 'aspect'
+            if kind not in kinds:
+                continue
+            for value in {(degree + angle) % 360.0, (degree - angle) % 360.0}:
+                values.append(value)
+                meanings.append((kind, point, aspect, angle))
+    return np.array(values, dtype=np.float64), meanings
+
+
+def _describe(jd_ut, name, meaning, degree, retrograde, local_tz):
+    utc_dt = jd_to_utc(jd_ut)
+    event = {"kind": meaning[0], "jd_ut": jd_ut, "utc_time": utc_dt.strftime("%Y-%m-%d %H:%M:%S")}
+    if local_tz is not None:
+        event["local_time"] = pytz.utc.localize(utc_dt).astimezone(local_tz).strftime("%Y-%m-%d %H:%M:%S")
+    event["body"] = name
+    event["body_ar"] = PLANET_NAMES_ARABIC.get(name, name)
+    info = get_zodiac_info(degree % 360.0)
+    if meaning[0] == 'ingress':
+        # Moving backwards over a boundary enters the previous sign.
+        sign = (meaning[1] - 1) % 12 if retrograde else meaning[1]
+        event.update(sign_en=SIGN_NAMES_ENGLISH[sign], sign_ar=SIGN_NAMES_ARABIC[sign])
+    elif meaning[0] == 'station':
+        event["station"] = meaning[1]
+        event.update(degree=degree, sign_en=info['sign_en'], sign_ar=info['sign_ar'],
+                     degree_in_sign=info['degree_in_sign'])
+    elif meaning[0] == 'return':
+        event["return"] = RETURN_NAMES[name]
+        event.update(degree=degree, sign_en=info['sign_en'], sign_ar=info['sign_ar'])
+    else:
+        event.update(natal=meaning[1], aspect=meaning[2], angle=meaning[3], degree=degree,
+                     sign_en=info['sign_en'], sign_ar=info['sign_ar'])
+    if meaning[0] != 'station':
+        event["retrograde"] = retrograde
+    return event
+
+
+def find_events(jd_start, jd_end, kinds=EVENT_KINDS, bodies=None, points=None, timezone_str=None):
+    """
+    Yield event dicts in time order for [jd_start, jd_end).
+    points: natal {name: degree} for aspects and returns (see natal_points).
+    """
+    kinds = set(kinds)
+    points = points or {}
+    local_tz = pytz.timezone(timezone_str) if timezone_str else None
+    transit = {name: pid for name, pid in TRANSIT_BODIES.items() if bodies is None or name in bodies}
+    targets = {name: _targets(name, kinds, points) for name in transit}
+
+    a = jd_start
+    while a < jd_end:
+        b = min(a + WINDOW_DAYS, jd_end)
+        table = covering_table(a, b)   # the ephemeris table when it covers this window
+        found = []
+        for name, pid in transit.items():
+            cuts = stations(pid, name, a, b, table)
+            if 'station' in kinds:
+                longitude = _motion_of(pid, name, table)
+                found.extend((t, name, ('station', direction), longitude(t)[0], None) for t, direction in cuts)
+            values, meanings = targets[name]
+            if len(values):
+                found.extend((t, name, meanings[i], float(values[i]), retrograde)
+                             for t, i, retrograde in crossings(pid, name, a, b, values, cuts, table))
+        found.sort(key=lambda event: event[0])
+        for jd_ut, name, meaning, degree, retrograde in found:
+            yield _describe(jd_ut, name, meaning, degree, retrograde, local_tz)
+        a = b
+
+
+def parse_date(value, field):
+    try:
+        return datetime.strptime(str(value), "%Y-%m-%d")
+    except ValueError:
+        raise ChartInputError(f"التاريخ يجب أن يكون بصيغة YYYY-MM-DD: {field}")
+
+
+def _check_ephemeris_range(day):
+    """Raise ChartInputError unless Swiss Ephemeris can place every transit body on `day`."""
+    jd = swe.julday(day.year, day.month, day.day, 0.0)
+    for pid in TRANSIT_BODIES.values():
+        try:
+            swe.calc_ut(jd, pid, EPHEMERIS_FLAGS)
+        except swe.Error:
+            raise ChartInputError(f"التاريخ {day:%Y-%m-%d} خارج نطاق ملفات التقويم الفلكي المتاحة.")
+    return jd
+
+
+def parse_event_request(data, max_days):
+    """
+    Validate {start, end?, kinds?, bodies?, chart?} into keyword arguments
+    for find_events(). chart is a birth record or {"planets_deg": {...}};
+    without one only ingresses and stations are available.
+    """
+    start = parse_date(data.get('start') or datetime.now(timezone.utc).strftime("%Y-%m-%d"), 'start')
+    # Checked here, before the response starts: a failing calc_ut would break the stream midway.
+    jd_start = _check_ephemeris_range(start)
+    if data.get('end'):
+        end = parse_date(data['end'], 'end')
+    else:
+        # One year; 29 February runs to 28 February.
+        leap_day = (start.month, start.day) == (2, 29)
+        end = start.replace(year=start.year + 1, day=28 if leap_day else start.day)
+    if end <= start:
+        raise ChartInputError("تاريخ النهاية يجب أن يكون بعد تاريخ البداية.")
+    if (end - start).days > max_days:
+        raise ChartInputError(f"الحد الأقصى للمدة هو {max_days} يوماً.")
+    jd_end = _check_ephemeris_range(end)
+
+    kinds = data.get('kinds') or EVENT_KINDS
+    bodies = data.get('bodies')
+    if isinstance(kinds, str):
+        kinds = kinds.split(',')
+    if isinstance(bodies, str):
+        bodies = bodies.split(',')
+    unknown = [k for k in kinds if k not in EVENT_KINDS] + [b for b in bodies or () if b not in TRANSIT_BODIES]
+    if unknown:
+        raise ChartInputError(f"قيم غير معروفة: {', '.join(map(str, unknown))}")
+
+    points, timezone_str = {}, None
+    chart = data.get('chart')
+    if isinstance(chart, dict) and chart.get('planets_deg'):
+        try:
+            points = {name: float(degree) for name, degree in chart['planets_deg'].items()}
+        except (TypeError, ValueError):
+            raise ChartInputError("planets_deg يجب أن تحتوي على درجات رقمية.")
+        timezone_str = chart.get('timezone')
+    elif isinstance(chart, dict):
+        natal = compute_chart(parse_birth_data(chart))
+        points, timezone_str = natal_points(natal), natal['timezone']
+    elif set(kinds) & {'aspect', 'return'} and chart is not None:
+        raise ChartInputError("chart يجب أن يكون كائن JSON.")
+    if timezone_str and timezone_str not in pytz.all_timezones_set:
+        raise ChartInputError(f"منطقة زمنية غير معروفة: {timezone_str}")
+
+    return {
+        'jd_start': jd_start,
+        'jd_end': jd_end,
+        'kinds': tuple(kinds),
+        'bodies': tuple(bodies) if bodies else None,
+        'points': points,
+        'timezone_str': timezone_str,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Print sky events between two dates as NDJSON.")
+    parser.add_argument('start', help='YYYY-MM-DD')
+    parser.add_argument('end', help='YYYY-MM-DD')
+    parser.add_argument('--kinds', default='ingress,station')
+    parser.add_argument('--bodies', default=None, help='comma separated, default all')
+    args = parser.parse_args(argv)
+    options = parse_event_request({'start': args.start, 'end': args.end, 'kinds': args.kinds,
+                                   'bodies': args.bodies}, max_days=365 * 200)
+    started, count = time.perf_counter(), 0
+    for event in find_events(**options):
+        sys.stdout.write(json.dumps(event, ensure_ascii=False) + '\n')
+        count += 1
+    print(f"{count} events in {time.perf_counter() - started:.3f} s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -- coding: utf-8 --
+"""
+Local stand-in for the Nominatim search API.
+
+Benchmarks and load tests point the geocoder at this server instead of
+nominatim.openstreetmap.org, so runs are reproducible, work offline and
+do not hit the public service. It answers /search?q=... from a fixed
+table of places, with an optional artificial latency that simulates the
+real round trip.
+
+    python geocode_stub.py --port 8765 --latency-ms 120
+    FALAKY_GEOCODER_DOMAIN=127.0.0.1:8765 FALAKY_GEOCODER_SCHEME=http python app.py
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Places outside the bundled gazetteer, so the network tier is exercised.
+STUB_PLACES = {
+    'Longyearbyen, Norway': (78.2232, 15.6267),
+    'Alert, Canada': (82.5018, -62.3481),
+    'Utqiagvik, United States': (71.2906, -156.7886),
+    'Nuuk, Greenland': (64.1835, -51.7216),
+    'Santiago, Chile': (-33.4489, -70.6693),
+    'Ushuaia, Argentina': (-54.8019, -68.3030),
+    'McMurdo Station, Antarctica': (-77.8419, 166.6863),
+}
+
+
+def _normalize(query):
+    # geocoding.py is deliberately not imported: it reads its settings at
+    # import time, and callers configure it to point here only after start().
+    return ' '.join(query.casefold().replace(',', ' ').split())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like Nominatim, so pooled clients can reuse connections.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip('/') != '/search':
+            self.send_error(404)
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        query = parse_qs(url.query).get('q', [''])[0]
+        self.server.requests += 1
+        place = self.server.places.get(_normalize(query))
+        results = []
+        if place:
+            name, (lat, lon) = place
+            results.append({'lat': str(lat), 'lon': str(lon), 'display_name': name,
+                            'place_id': abs(hash(name)) % 10 ** 9, 'boundingbox': [str(lat), str(lat), str(lon), str(lon)]})
+        body = json.dumps(results).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubGeocoder:
+    """A Nominatim-compatible server on a background thread."""
+
+    def __init__(self, places=STUB_PLACES, host='127.0.0.1', port=0, latency=0.0):
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.places = {_normalize(name): (name, coords) for name, coords in places.items()}
+        self.server.latency = latency
+        self.server.requests = 0
+        self._thread = None
+
+    @property
+    def domain(self):
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='geocode-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def environ(self):
+        """Environment variables that point geocoding.py at this server."""
+        return {'FALAKY_GEOCODER_DOMAIN': self.domain, 'FALAKY_GEOCODER_SCHEME': 'http',
+                'FALAKY_GEOCODER_OFFLINE': ''}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a local Nominatim stand-in.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    args = parser.parse_args(argv)
+    stub = StubGeocoder(host=args.host, port=args.port, latency=args.latency_ms / 1000.0)
+    print(f"Stub geocoder on http://{stub.domain}/search")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
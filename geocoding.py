@@ -0,0 +1,298 @@
+# -- geocoding.py --
+"""
+Local geocoding layer used by the chart form and timezone_utils.
+
+Lookups go through three tiers, cheapest first:
+
+1. the bundled gazetteer (static/gazetteer.json), indexed in memory by
+   normalized Arabic/English city and country names;
+2. a persistent SQLite cache of earlier Nominatim answers, misses included;
+3. Nominatim itself, only when both tiers above have nothing.
+
+The async server (asgi.py) asks Nominatim from its event loop with a
+pooled client and then runs the view under local_only(), so under it a
+slow lookup never holds a worker thread.
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextlib import contextmanager
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+GAZETTEER_PATH = os.path.join(BASE_DIR, 'static', 'gazetteer.json')
+GEOCODE_CACHE_PATH = os.environ.get(
+    'FALAKY_GEOCODE_CACHE', os.path.join(BASE_DIR, 'cache', 'geocode.sqlite3'))
+
+# Misses are cached too, but only for a while: a city missing today may be
+# spelled the same way by someone tomorrow after Nominatim learns about it.
+MISS_TTL_SECONDS = int(os.environ.get('FALAKY_GEOCODE_MISS_TTL', 7 * 24 * 3600))
+NOMINATIM_TIMEOUT = float(os.environ.get('FALAKY_GEOCODE_TIMEOUT', 5))
+NOMINATIM_DOMAIN = os.environ.get('FALAKY_GEOCODER_DOMAIN', 'nominatim.openstreetmap.org')
+NOMINATIM_SCHEME = os.environ.get('FALAKY_GEOCODER_SCHEME', 'https')
+# FALAKY_GEOCODER_OFFLINE=1 disables the network tier entirely.
+GEOCODER_OFFLINE = os.environ.get('FALAKY_GEOCODER_OFFLINE', '') == '1'
+
+_ARABIC_DIACRITICS = re.compile('[\u064B-\u0670\u0640]')
+_ARABIC_FOLD = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ة': 'ه', 'ى': 'ي', 'ؤ': 'و', 'ئ': 'ي',
+})
+_NON_WORD = re.compile(r'[^\w]+')
+_ARTICLE_PREFIXES = ('ال', 'al ', 'el ')
+
+stats = {'gazetteer_hits': 0, 'cache_hits': 0, 'cache_misses': 0, 'network_lookups': 0}
+
+
+def normalize_name(text):
+    """Fold a place name to a lookup key (case, accents, Arabic letter forms)."""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKD', text.strip().lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    text = _ARABIC_DIACRITICS.sub('', text).translate(_ARABIC_FOLD)
+    return _NON_WORD.sub(' ', text.replace('_', ' ')).strip()
+
+
+def _name_keys(name):
+    """All index keys for a name: the normalized form and, if any, the article-less one."""
+    norm = normalize_name(name)
+    if not norm:
+        return []
+    keys = [norm]
+    for prefix in _ARTICLE_PREFIXES:
+        if norm.startswith(prefix) and len(norm) > len(prefix) + 2:
+            keys.append(norm[len(prefix):].lstrip())
+            break
+    compact = norm.replace(' ', '')
+    if compact != norm:
+        keys.append(compact)
+    return keys
+
+
+class Gazetteer:
+    """In-memory index over the bundled city/country list."""
+
+    def __init__(self, path=GAZETTEER_PATH):
+        self.path = path
+        self.countries = {}   # normalized country name -> country code
+        self.cities = {}      # normalized city name -> [(code, lat, lon), ...]
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8-sig') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logging.error("Gazetteer could not be loaded from %s: %s", self.path, e)
+            return
+
+        for country in data.get('countries', []):
+            code = country['code']
+            for name in [code, country['name_en'], country['name_ar']] + country.get('aliases', []):
+                for key in _name_keys(name):
+                    self.countries.setdefault(key, code)
+
+        for city in data.get('cities', []):
+            entry = (city['country'], city['lat'], city['lon'])
+            for name in [city['name_en'], city['name_ar']] + city.get('aliases', []):
+                for key in _name_keys(name):
+                    bucket = self.cities.setdefault(key, [])
+                    if entry not in bucket:
+                        bucket.append(entry)
+
+    def country_code(self, country):
+        for key in _name_keys(country):
+            code = self.countries.get(key)
+            if code:
+                return code
+        return None
+
+    def lookup(self, city, country=None):
+        """Return (lat, lon) for a city, or None when the gazetteer cannot tell."""
+        code = self.country_code(country) if country else None
+        if country and code is None:
+            # Unknown country spelling: do not guess between same-named cities.
+            return None
+        for key in _name_keys(city):
+            candidates = self.cities.get(key)
+            if not candidates:
+                continue
+            if code:
+                for cand_code, lat, lon in candidates:
+                    if cand_code == code:
+                        return lat, lon
+            elif len(candidates) == 1:
+                return candidates[0][1], candidates[0][2]
+        return None
+
+
+class GeocodeCache:
+    """SQLite-backed cache of Nominatim answers, safe to share between workers."""
+
+    def __init__(self, path=GEOCODE_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        # Connections must not cross a fork, so reopen in each gunicorn worker.
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS geocode ('
+                ' key TEXT PRIMARY KEY, lat REAL, lon REAL, created REAL NOT NULL)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        """Return (found, (lat, lon) | None); found is False when the key is absent or stale."""
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    'SELECT lat, lon, created FROM geocode WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning("Geocode cache read failed: %s", e)
+            return False, None
+        if row is None:
+            return False, None
+        lat, lon, created = row
+        if lat is None or lon is None:
+            if time.time() - created > MISS_TTL_SECONDS:
+                return False, None
+            return True, None
+        return True, (lat, lon)
+
+    def put(self, key, coords):
+        lat, lon = coords if coords else (None, None)
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute('INSERT OR REPLACE INTO geocode (key, lat, lon, created) VALUES (?, ?, ?, ?)',
+                             (key, lat, lon, time.time()))
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.warning("Geocode cache write failed: %s", e)
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+_cache = GeocodeCache()
+_nominatim = None
+_local = threading.local()
+
+
+def get_gazetteer():
+    """Return the process-wide gazetteer, loading it on first use."""
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer()
+    return _gazetteer
+
+
+def _get_nominatim():
+    global _nominatim
+    if _nominatim is None:
+        from geopy.geocoders import Nominatim
+        _nominatim = Nominatim(user_agent="falaky_app", timeout=NOMINATIM_TIMEOUT,
+                               domain=NOMINATIM_DOMAIN, scheme=NOMINATIM_SCHEME)
+    return _nominatim
+
+
+def nominatim_params(query, language):
+    """Query string parameters of a Nominatim /search request (as geopy sends them)."""
+    return {'q': query, 'format': 'json', 'limit': 1, 'accept-language': language}
+
+
+def _query_nominatim(query):
+    """Ask Nominatim (Arabic first, then English). Raises on network/service errors."""
+    geolocator = _get_nominatim()
+    stats['network_lookups'] += 1
+    location = geolocator.geocode(query, language='ar') or \
+               geolocator.geocode(query, language='en')
+    return (location.latitude, location.longitude) if location else None
+
+
+def _cache_key(city, country):
+    return f"{normalize_name(city)}|{normalize_name(country)}"
+
+
+def lookup_local(city, country=None):
+    """
+    (found, (lat, lon) | None) from the gazetteer and the cache of earlier
+    Nominatim answers, without touching the network. found is False when
+    only Nominatim could tell.
+    """
+    coords = get_gazetteer().lookup(city, country)
+    if coords:
+        stats['gazetteer_hits'] += 1
+        return True, coords
+
+    found, coords = _cache.get(_cache_key(city, country))
+    if found:
+        stats['cache_hits'] += 1
+        return True, coords
+    stats['cache_misses'] += 1
+    return False, None
+
+
+def remember(city, country, coords):
+    """Cache a Nominatim answer (None for "no such place") for every worker."""
+    _cache.put(_cache_key(city, country), coords)
+
+
+def network_allowed():
+    return not GEOCODER_OFFLINE and not getattr(_local, 'offline', False)
+
+
+@contextmanager
+def local_only():
+    """
+    Within the block, geocode() on this thread answers from the gazetteer
+    and the cache only. The async server (asgi.py) resolves places on the
+    event loop first, so the view never waits on Nominatim.
+    """
+    previous = getattr(_local, 'offline', False)
+    _local.offline = True
+    try:
+        yield
+    finally:
+        _local.offline = previous
+
+
+def geocode(city, country=None):
+    """
+    Resolve a city/country pair to (lat, lon), or (None, None) when unknown.
+    Network failures are not cached, so a later request can still succeed.
+    """
+    found, coords = lookup_local(city, country)
+    if found:
+        return coords if coords else (None, None)
+
+    if not network_allowed():
+        return None, None
+
+    query = f"{city}, {country}" if country else city
+    try:
+        coords = _query_nominatim(query)
+    except Exception as e:
+        logging.error("Nominatim lookup failed for %r: %s", query, e)
+        return None, None
+
+    remember(city, country, coords)
+    return coords if coords else (None, None)
+
+
+def geocode_query(query):
+    """Resolve a free-form "city, country" (or bare city) string."""
+    city, _, country = query.partition(',')
+    return geocode(city.strip(), country.strip() or None)
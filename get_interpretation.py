@@ -2,57 +2,150 @@
 import json
 import os
 import logging
+import threading
+import time
 
 # تهيئة ملف log (للمساعدة في تتبع الأخطاء)
 logging.basicConfig(level=logging.INFO)
 
-def get_planet_interpretation(planet_name, house, sign):
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# الملف موجود فعلياً في مجلد static؛ المسار القديم يبقى كاحتياط
+INTERPRETATIONS_PATHS = (
+    os.path.join(BASE_DIR, 'static', 'interpretations_ar.json'),
+    os.path.join(BASE_DIR, 'interpretations_ar.json'),
+)
+# أقل فاصل زمني (بالثواني) بين فحصين لتاريخ تعديل الملف
+RELOAD_CHECK_SECONDS = float(os.environ.get('FALAKY_INTERPRETATIONS_CHECK_SECONDS', 2))
+
+
+class InterpretationStore:
     """
-    تقوم هذه الدالة بقراءة التفسيرات من ملف interpretations_ar.json
-    بناءً على الكوكب (planet_name)، البيت (house)، والبرج (sign).
+    Interpretations loaded once into a flat index keyed by
+    (planet, 'houses'|'signs', key), plus the ascendant sign readings under
+    ('ascendant', 'signs', sign). The file is re-read only when its mtime
+    changes. Loaded on first use, or in the gunicorn master by
+    startup.warm() so the index is built once and shared by forked workers.
     """
-    
-    file_path = os.path.join(os.path.dirname(__file__), 'interpretations_ar.json')
-    
-    try:
-        # قراءة محتوى الملف كنص أولاً لمعالجة مشاكل الترميز/BOM
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # 💡 خطوة حاسمة: إزالة علامة BOM (Byte Order Mark) يدوياً إذا وجدت
-        content = content.lstrip('\ufeff')
-        
-        # فك تشفير النص المعالج
-        data = json.loads(content)
-        
-    except FileNotFoundError:
-        logging.error(f"ملف التفسيرات غير موجود: {file_path}")
-        return (f"خطأ: ملف التفسيرات (interpretations_ar.json) غير موجود للبيت {house}.", 
+
+    def __init__(self, paths=INTERPRETATIONS_PATHS):
+        self.paths = paths
+        self.path = None
+        self.index = {}
+        self.error = None       # (kind, detail) when the last load failed
+        self.mtime = None
+        self.version = 0
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _resolve_path(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                return path
+        return self.paths[0]
+
+    def load(self):
+        path = self._resolve_path()
+        try:
+            mtime = os.stat(path).st_mtime
+            # قراءة محتوى الملف كنص أولاً لمعالجة مشاكل الترميز/BOM
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read()
+            # 💡 خطوة حاسمة: إزالة علامة BOM (Byte Order Mark) يدوياً إذا وجدت
+            data = json.loads(content.lstrip('\ufeff'))
+        except FileNotFoundError:
+            logging.error(f"ملف التفسيرات غير موجود: {path}")
+            self.index, self.error, self.mtime = {}, ('missing', path), None
+            return
+        except json.JSONDecodeError as e:
+            logging.error(f"فشل فك تشفير JSON في ملف التفسيرات. تأكد من صحة الصياغة. الخطأ: {e}")
+            self.index, self.error, self.mtime = {}, ('invalid', str(e)), mtime
+            return
+
+        index = {}
+        for planet_key, planet_data in data.items():
+            if not isinstance(planet_data, dict):
+                continue
+            if planet_key == 'ascendant':
+                for sign_key, text in planet_data.items():
+                    index[('ascendant', 'signs', sign_key)] = text
+                continue
+            for section in ('houses', 'signs'):
+                for key, text in planet_data.get(section, {}).items():
+                    index[(planet_key, section, str(key))] = text
+
+        self.path, self.index, self.error, self.mtime = path, index, None, mtime
+        self.version += 1
+        logging.info(f"Loaded {len(index)} interpretations from {path}")
+
+    def refresh(self):
+        """Reload if the file changed; stats at most every RELOAD_CHECK_SECONDS."""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < RELOAD_CHECK_SECONDS:
+            return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < RELOAD_CHECK_SECONDS:
+                return
+            first_check = self._checked_at is None
+            self._checked_at = now
+            try:
+                mtime = os.stat(self._resolve_path()).st_mtime
+            except OSError:
+                mtime = None
+            if first_check or mtime != self.mtime:
+                self.load()
+
+    def get(self, planet_name, section, key):
+        self.refresh()
+        return self.index.get((planet_name.lower(), section, str(key).lower()))
+
+
+store = InterpretationStore()
+
+
+def _error_messages(house, sign):
+    kind = store.error[0]
+    if kind == 'missing':
+        return (f"خطأ: ملف التفسيرات (interpretations_ar.json) غير موجود للبيت {house}.",
                 f"خطأ: ملف التفسيرات (interpretations_ar.json) غير موجود للبرج {sign}.")
-    except json.JSONDecodeError as e:
-         logging.error(f"فشل فك تشفير JSON في ملف التفسيرات. تأكد من صحة الصياغة. الخطأ: {e}")
-         return (f"خطأ: فشل قراءة JSON في ملف التفسيرات للبيت {house}.", 
-                f"خطأ: فشل قراءة JSON في ملف التفسيرات للبرج {sign}.")
+    return (f"خطأ: فشل قراءة JSON في ملف التفسيرات للبيت {house}.",
+            f"خطأ: فشل قراءة JSON في ملف التفسيرات للبرج {sign}.")
 
 
+def get_planet_interpretation(planet_name, house, sign):
+    """
+    تقوم هذه الدالة بإرجاع التفسيرات من ملف interpretations_ar.json
+    بناءً على الكوكب (planet_name)، البيت (house)، والبرج (sign).
+    """
+    store.refresh()
+    if store.error:
+        return _error_messages(house, sign)
+
     # التأكد من تحويل اسم الكوكب والبرج إلى أحرف صغيرة للمطابقة مع مفاتيح JSON
-    planet_key = planet_name.lower()
-    sign_key = sign.lower()
-    house_key = str(house)
-
-    # الحصول على البيانات الخاصة بالكوكب
-    planet_data = data.get(planet_key, {})
-    
-    # البحث عن تفسير البيت
-    house_interp = planet_data.get("houses", {}).get(house_key)
-    # البحث عن تفسير البرج
-    sign_interp = planet_data.get("signs", {}).get(sign_key)
-    
+    house_interp = store.get(planet_name, 'houses', house)
+    sign_interp = store.get(planet_name, 'signs', sign)
+
     # رسالة افتراضية
     default_house = f"لا يوجد تفسير محدد لـ {planet_name} في البيت {house} في ملف التفسيرات."
     default_sign = f"لا يوجد تفسير محدد لـ {planet_name} في برج {sign} في ملف التفسيرات."
 
     house_result = house_interp if house_interp else default_house
     sign_result = sign_interp if sign_interp else default_sign
-    
-    return house_result, sign_result
\ No newline at end of file
+
+    return house_result, sign_result
+
+
+def get_chart_interpretations(planets, ascendant_sign=None):
+    """
+    جميع تفسيرات الخريطة دفعة واحدة.
+    planets: قائمة عناصر فيها name_en و house و sign_en (كما يعيدها compute_chart).
+    تعيد قاموساً {اسم الكوكب: {"house": ..., "sign": ...}} مع "ascendant" إن وُجد.
+    """
+    readings = {}
+    for planet in planets:
+        house_text, sign_text = get_planet_interpretation(planet['name_en'], planet['house'], planet['sign_en'])
+        readings[planet['name_en']] = {"house": house_text, "sign": sign_text}
+    if ascendant_sign and not store.error:
+        text = store.get('ascendant', 'signs', ascendant_sign)
+        if text:
+            readings['ascendant'] = {"sign": text}
+    return readings
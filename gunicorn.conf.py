@@ -0,0 +1,44 @@
+# -- coding: utf-8 --
+"""
+gunicorn settings: gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload_app) with
+FALAKY_STARTUP=preload, so timezone polygons, interpretations,
+horoscopes and the ephemeris table are loaded before fork and shared by
+every worker. Set FALAKY_STARTUP=lazy to let each worker load things on
+first use instead. Each worker keeps the next days' sky objects built
+(daily_sky.start_scheduler).
+
+With FALAKY_ASYNC=1 the workers are uvicorn's and serve asgi:app, where
+geocoding is awaited on an event loop instead of holding a worker
+thread (see asgi.py; FALAKY_ASYNC_THREADS replaces FALAKY_THREADS):
+
+    FALAKY_ASYNC=1 gunicorn -c gunicorn.conf.py asgi:app
+"""
+import os
+import time
+
+os.environ.setdefault('FALAKY_STARTUP', 'preload')
+
+bind = os.environ.get('FALAKY_BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('FALAKY_THREADS', 1))
+timeout = int(os.environ.get('FALAKY_WORKER_TIMEOUT', 60))
+preload_app = os.environ['FALAKY_STARTUP'] == 'preload'
+if os.environ.get('FALAKY_ASYNC', '') == '1':
+    worker_class = 'uvicorn.workers.UvicornWorker'
+
+_started = time.monotonic()
+
+
+def when_ready(server):
+    server.log.info("Master ready in %.2f s (startup mode: %s)", time.monotonic() - _started,
+                    os.environ['FALAKY_STARTUP'])
+
+
+def post_worker_init(worker):
+    from daily_sky import start_scheduler
+    from startup import rss_kb
+    start_scheduler()
+    worker.log.info("Worker %s ready %.2f s after master start, RSS %s KiB", worker.pid,
+                    time.monotonic() - _started, rss_kb())
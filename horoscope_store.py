@@ -0,0 +1,137 @@
+# -- coding: utf-8 --
+"""
+Versioned in-memory store for the daily horoscopes file.
+
+The JSON is parsed and serialized once per version. /api/horoscopes then
+serves the ready bytes with an ETag and Last-Modified, and answers
+repeat requests with 304. A version ends when an admin save goes through
+this store, or when another worker's save changes the file mtime
+(checked at most every CHECK_SECONDS). Saves hold an exclusive lock and
+replace the file atomically (write to a temp file, then rename), so no
+worker ever reads a half-written file.
+"""
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows development server: single process, thread lock is enough
+    fcntl = None
+
+CHECK_SECONDS = float(os.environ.get('FALAKY_HOROSCOPES_CHECK_SECONDS', 1))
+
+
+class Snapshot:
+    """One immutable version of the file: parsed data and pre-serialized bodies."""
+
+    __slots__ = ('data', 'body', 'etag', 'last_modified', 'signs')
+
+    def __init__(self, data, mtime):
+        self.data = data
+        self.body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.last_modified = datetime.fromtimestamp(int(mtime), tz=timezone.utc) if mtime else None
+        self.signs = {}
+        for sign, entry in data.items():
+            body = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+            self.signs[sign] = (body, hashlib.sha1(body).hexdigest())
+
+
+class HoroscopeStore:
+    def __init__(self, path):
+        self.path = path
+        self._snapshot = None
+        self._mtime = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _read_file(self):
+        """Return (data, mtime) from disk; an empty dict if missing or corrupt."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f), mtime
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            logging.warning("Could not read horoscopes from %s: %s", self.path, e)
+            return {}, None
+
+    def _reload(self):
+        data, mtime = self._read_file()
+        self._snapshot = Snapshot(data, mtime)
+        self._mtime = mtime
+
+    def snapshot(self):
+        """Current version, reloading first if the file changed on disk."""
+        now = time.monotonic()
+        if self._snapshot is not None and now - self._checked_at < CHECK_SECONDS:
+            return self._snapshot
+        with self._lock:
+            if self._snapshot is None or now - self._checked_at >= CHECK_SECONDS:
+                try:
+                    mtime = os.stat(self.path).st_mtime
+                except OSError:
+                    mtime = None
+                if self._snapshot is None or mtime != self._mtime:
+                    self._reload()
+                self._checked_at = now
+        return self._snapshot
+
+    def data(self):
+        """A private copy of the horoscopes dict, safe to modify."""
+        return copy.deepcopy(self.snapshot().data)
+
+    @contextmanager
+    def _exclusive(self):
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.path + '.lock', 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self, contents):
+        """
+        Update the 'content' of existing signs from {sign: text} and write
+        the file atomically. Only signs already in the file are touched.
+        """
+        with self._exclusive():
+            # Re-read under the lock so a save in another worker is not lost.
+            horoscopes, _ = self._read_file()
+            for sign, new_content in contents.items():
+                if sign in horoscopes and new_content is not None:
+                    horoscopes[sign]['content'] = new_content
+
+            directory = os.path.dirname(self.path)
+            try:
+                mode = os.stat(self.path).st_mode & 0o777
+            except OSError:
+                mode = 0o644
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.daily_horoscopes-', suffix='.tmp')
+            try:
+                os.chmod(tmp_path, mode)
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    # ensure_ascii=False يضمن حفظ الأحرف العربية بشكل صحيح
+                    json.dump(horoscopes, f, ensure_ascii=False, indent=4)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+
+            self._reload()
+            self._checked_at = time.monotonic()
+        return self._snapshot
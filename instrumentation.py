@@ -0,0 +1,215 @@
+# -- coding: utf-8 --
+"""
+Stage-level instrumentation: named spans, latency histograms, counters
+and sampled structured trace logging.
+
+    with span('houses'):
+        cusps, ascmc = swe.houses_ex(...)
+
+Each span adds its duration to the `falaky_stage_seconds{stage=...}`
+histogram and to the timings of the current request. The app turns those
+timings into a Server-Timing header. render_metrics() produces the
+Prometheus text format for /metrics, including the counters that
+registered collectors (cache hit/miss stats and the like) report at
+scrape time.
+
+trace() replaces the per-request debug logging. A request is sampled
+once, with probability FALAKY_TRACE_SAMPLE. Only sampled requests emit
+their trace events, one JSON line each on the 'falaky.trace' logger, and
+the JSON is only built if a handler actually writes the record.
+
+Metrics are per process: with several gunicorn workers, each worker
+reports its own numbers.
+"""
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+TRACE_SAMPLE = float(os.environ.get('FALAKY_TRACE_SAMPLE', 0.01))
+SERVER_TIMING = os.environ.get('FALAKY_SERVER_TIMING', '1').lower() not in ('0', 'false', 'no')
+# Upper bounds in seconds; +Inf is implicit.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+trace_logger = logging.getLogger('falaky.trace')
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, one series per label value."""
+
+    def __init__(self, name, help_text, label, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}   # label value -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        for value, series in sorted(snapshot.items()):
+            label = f'{self.label}="{_escape(value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{self.name}_bucket{{{label},le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label}}} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{{{label}}} {cumulative}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+stage_seconds = Histogram('falaky_stage_seconds', 'Time spent per pipeline stage.', 'stage')
+request_seconds = Histogram('falaky_request_seconds', 'Request latency per endpoint.', 'endpoint')
+
+# (name, help, type) -> collector returning [(labels dict, value), ...]
+_collectors = []
+
+
+def register_collector(name, help_text, metric_type, collect):
+    """Report a counter/gauge family computed at scrape time by collect()."""
+    _collectors.append((name, help_text, metric_type, collect))
+
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = stage_seconds.render() + request_seconds.render()
+    for name, help_text, metric_type, collect in _collectors:
+        try:
+            samples = collect()
+        except Exception as e:
+            logging.warning("Metrics collector %s failed: %s", name, e)
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in samples:
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+# -- per-request state -------------------------------------------------
+
+class _RequestState:
+    __slots__ = ('timings', 'sampled', 'trace_id')
+
+    def __init__(self, sampled):
+        self.timings = {}
+        self.sampled = sampled
+        self.trace_id = f"{random.getrandbits(48):012x}"
+
+
+_current = ContextVar('falaky_request', default=None)
+
+
+def start_request(sample_rate=None):
+    """Begin collecting timings (and decide trace sampling) for a request."""
+    rate = TRACE_SAMPLE if sample_rate is None else sample_rate
+    state = _RequestState(rate > 0 and random.random() < rate)
+    _current.set(state)
+    return state
+
+
+def end_request():
+    state = _current.get()
+    _current.set(None)
+    return state
+
+
+@contextmanager
+def span(name):
+    """Time a pipeline stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(name, elapsed)
+        state = _current.get()
+        if state is not None:
+            state.timings[name] = state.timings.get(name, 0.0) + elapsed
+
+
+def server_timing_header(state):
+    """Server-Timing value ("stage;dur=ms, ...") for a finished request."""
+    return ', '.join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in state.timings.items())
+
+
+# -- sampled structured trace logging ----------------------------------
+
+class _TraceRecord:
+    """Serialized to JSON only when a handler formats the log record."""
+
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __str__(self):
+        return json.dumps(self.fields, ensure_ascii=False, default=str)
+
+
+def trace_enabled():
+    state = _current.get()
+    if state is not None:
+        return state.sampled
+    return TRACE_SAMPLE > 0 and random.random() < TRACE_SAMPLE
+
+
+def trace(event, **fields):
+    """
+    Emit one structured debug event if the current request is sampled.
+    Unsampled calls cost a context lookup; nothing is formatted.
+    """
+    state = _current.get()
+    if state is None:
+        if not (TRACE_SAMPLE > 0 and random.random() < TRACE_SAMPLE):
+            return
+    elif not state.sampled:
+        return
+    if not trace_logger.isEnabledFor(logging.INFO):
+        return
+    fields['event'] = event
+    if state is not None:
+        fields['trace_id'] = state.trace_id
+    trace_logger.info('%s', _TraceRecord(fields))
+
+
+def init_app(app):
+    """Per-request spans, Server-Timing headers and the request histogram for a Flask app."""
+    from flask import request
+
+    @app.before_request
+    def _start_instrumentation():
+        request.environ['falaky.start'] = time.perf_counter()
+        start_request()
+
+    @app.after_request
+    def _finish_instrumentation(response):
+        state = end_request()
+        start = request.environ.get('falaky.start')
+        if start is not None:
+            request_seconds.observe(request.endpoint or 'unknown', time.perf_counter() - start)
+        if SERVER_TIMING and state is not None and state.timings:
+            response.headers['Server-Timing'] = server_timing_header(state)
+        return response
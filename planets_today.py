@@ -1,6 +1,8 @@
 import swisseph as swe
 from datetime import datetime
 
+from ephemeris_table import transit_longitudes
+
 # Get current date
 now = datetime.now()
 
@@ -8,20 +10,11 @@ now = datetime.now()
 jd = swe.julday(now.year, now.month, now.day)
 
 # List of planets to calculate
-planets = {
-    "Sun": swe.SUN,
-    "Moon": swe.MOON,
-    "Mercury": swe.MERCURY,
-    "Venus": swe.VENUS,
-    "Mars": swe.MARS,
-    "Jupiter": swe.JUPITER,
-    "Saturn": swe.SATURN,
-    "Uranus": swe.URANUS,
-    "Neptune": swe.NEPTUNE,
-    "Pluto": swe.PLUTO
-}
+planets = ["Sun", "Moon", "Mercury", "Venus", "Mars", "Jupiter", "Saturn", "Uranus", "Neptune", "Pluto"]
+
+# Positions come from the precomputed table when it covers today, otherwise from Swiss Ephemeris
+positions = transit_longitudes(jd)
 
 # Calculate and print positions
-for name, code in planets.items():
-    pos = swe.calc_ut(jd, code)[0]
-    print(f"{name}: {pos[0]:.2f}°")
+for name in planets:
+    print(f"{name}: {positions[name]:.2f}°")
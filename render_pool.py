@@ -0,0 +1,283 @@
+# -- coding: utf-8 --
+"""
+Process pool for chart rendering.
+
+pyplot's global state is not thread-safe, so PNG renders run in a small
+pool of warm worker processes, where matplotlib is imported and the
+fonts are loaded up front. The request thread only waits on a future,
+which also makes threaded gunicorn workers safe. The SVG backend is
+plain string building and stays inline.
+
+A render is a job identified by "<chart key>-<size|full>". Submitting
+the same job twice joins the render already in flight. Finished images
+go into chart_cache, so a job's result is simply the cached image. The
+pool is created lazily in each process (it is never inherited across a
+fork). FALAKY_RENDER_WORKERS=0 renders inline, as before.
+
+Job state is shared between gunicorn workers through marker files in
+chart_cache's directory: "<job>.pending" while a worker renders it and
+"<job>.failed" (holding the error) if the render failed. A status poll
+or image request that reaches another worker sees the same state, and
+an image request waits for the render under way instead of starting a
+second one. A pending marker older than RENDER_TIMEOUT is ignored (its
+worker died), and a failure is forgotten after FAILED_TTL seconds, so
+the next request renders the chart again.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from chart_cache import chart_cache
+from chart_render import CHART_MIMETYPES, render_chart
+
+RENDER_WORKERS = int(os.environ.get('FALAKY_RENDER_WORKERS', 2))
+RENDER_TIMEOUT = float(os.environ.get('FALAKY_RENDER_TIMEOUT', 30))
+# Formats whose renderer is not thread-safe and therefore goes to the pool.
+POOLED_FORMATS = ('png',)
+FAILED_JOBS_LIMIT = 256
+FAILED_TTL = float(os.environ.get('FALAKY_RENDER_FAILED_TTL', 300))
+
+
+def _warm_worker():
+    """Pool initializer: import matplotlib and render once so fonts are cached."""
+    from chart_png import render_chart_png
+    render_chart_png({'Sun': 0.0}, [i * 30.0 for i in range(12)], 0.0, dpi=10)
+
+
+def job_id(key, size=None):
+    return f"{key}-{size or 'full'}"
+
+
+def parse_job_id(value):
+    """Inverse of job_id(): (key, size) or None if malformed."""
+    key, _, size = value.rpartition('-')
+    if not key:
+        return None
+    if size == 'full':
+        return key, None
+    return (key, int(size)) if size.isdigit() else None
+
+
+class RenderPool:
+    def __init__(self, workers=RENDER_WORKERS, cache=chart_cache):
+        self.workers = workers
+        self.cache = cache
+        self._executor = None
+        self._pid = None
+        self._jobs = {}                  # job id -> Future, while rendering
+        self._failed = OrderedDict()     # job id -> (error message, time.time() of the failure)
+        self._lock = threading.Lock()
+        self.stats = {'submitted': 0, 'joined': 0, 'completed': 0, 'failed': 0, 'inline': 0}
+
+    def _get_executor(self):
+        if self._executor is None or self._pid != os.getpid():
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                 initializer=_warm_worker)
+            self._pid = os.getpid()
+            self._jobs = {}
+        return self._executor
+
+    def warm(self):
+        """Start the worker processes now instead of on the first render."""
+        if self.workers > 0:
+            executor = self._get_executor()
+            for _ in range(self.workers):
+                executor.submit(int)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    # -- shared job markers ------------------------------------------------
+    def _marker(self, job, state):
+        return os.path.join(self.cache.disk_dir, f'{job}.{state}') if self.cache.disk_dir else None
+
+    def _mark(self, job, state, message=''):
+        """Record a job's state for the other workers: 'pending', 'failed' or None (finished)."""
+        if not self.cache.disk_dir:
+            return
+        for other in ('pending', 'failed'):
+            if other != state:
+                try:
+                    os.unlink(self._marker(job, other))
+                except OSError:
+                    pass
+        if state is not None:
+            try:
+                with open(self._marker(job, state), 'w', encoding='utf-8') as f:
+                    f.write(message)
+            except OSError as e:
+                logging.warning("Could not mark render job %s %s: %s", job, state, e)
+
+    def _shared_failure(self, job):
+        """The error of a failed render marked by any worker, or None; stale markers are removed."""
+        if not self.cache.disk_dir:
+            return None
+        path = self._marker(job, 'failed')
+        try:
+            if time.time() - os.stat(path).st_mtime >= FAILED_TTL:
+                os.unlink(path)
+                return None
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _local_failure(self, job):
+        """The error of this process's failed render of a job within FAILED_TTL, or None. Call with _lock held."""
+        failure = self._failed.get(job)
+        if failure is None:
+            return None
+        message, failed_at = failure
+        if time.time() - failed_at >= FAILED_TTL:
+            del self._failed[job]
+            return None
+        return message
+
+    def _shared_state(self, job):
+        """'pending' or 'failed' as marked by any worker, else None."""
+        if not self.cache.disk_dir:
+            return None
+        if self._shared_failure(job) is not None:
+            return 'failed'
+        try:
+            if time.time() - os.stat(self._marker(job, 'pending')).st_mtime < RENDER_TIMEOUT:
+                return 'pending'
+        except OSError:
+            pass
+        return None
+
+    def _wait_shared(self, key, size, timeout):
+        """Wait for another worker's render of a variant; its bytes, or None if it ended without an image."""
+        job = job_id(key, size)
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while self._shared_state(job) == 'pending' and time.monotonic() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+            data = self.cache.peek_image(key, size)
+            if data is not None:
+                return data
+        return self.cache.peek_image(key, size)
+
+    def _finish(self, key, size, job, future):
+        try:
+            data, _ = future.result()
+        except Exception as e:
+            logging.error("Chart render %s failed: %s", job, e)
+            message = str(e) or e.__class__.__name__
+            self._mark(job, 'failed', message)
+            with self._lock:
+                self._jobs.pop(job, None)
+                self._failed[job] = (message, time.time())
+                while len(self._failed) > FAILED_JOBS_LIMIT:
+                    self._failed.popitem(last=False)
+                self.stats['failed'] += 1
+            return
+        # Cache first, then drop the job, so status() goes straight from pending to done.
+        self.cache.put_image(key, size, data)
+        self._mark(job, None)
+        with self._lock:
+            self._jobs.pop(job, None)
+            self.stats['completed'] += 1
+
+    def submit(self, key, size=None):
+        """
+        Start rendering a chart variant unless it is cached or already in
+        flight. Returns the Future (None when the image is already cached
+        or was rendered inline). Raises KeyError for unknown keys.
+        """
+        spec = self.cache.get_spec(key)
+        if spec is None:
+            raise KeyError(key)
+        job = job_id(key, size)
+        with self._lock:
+            future = self._jobs.get(job)
+            if future is not None and self._pid == os.getpid():
+                self.stats['joined'] += 1
+                return future
+        if self.cache.peek_image(key, size) is not None:
+            return None
+
+        if self.workers <= 0 or spec['fmt'] not in POOLED_FORMATS:
+            self.stats['inline'] += 1
+            self.cache.get_image(key, size)
+            return None
+
+        with self._lock:
+            future = self._jobs.get(job)
+            if future is not None and self._pid == os.getpid():
+                self.stats['joined'] += 1
+                return future
+            self._failed.pop(job, None)
+            try:
+                future = self._get_executor().submit(
+                    render_chart, spec['planets_deg'], spec['houses_deg'], spec['ascendant_deg'],
+                    fmt=spec['fmt'], size=size)
+            except BrokenProcessPool:
+                logging.warning("Render pool is broken; restarting it")
+                self._executor = None
+                future = self._get_executor().submit(
+                    render_chart, spec['planets_deg'], spec['houses_deg'], spec['ascendant_deg'],
+                    fmt=spec['fmt'], size=size)
+            self._jobs[job] = future
+            self.stats['submitted'] += 1
+        self._mark(job, 'pending')
+        future.add_done_callback(lambda f: self._finish(key, size, job, f))
+        return future
+
+    def status(self, key, size=None):
+        """'done', 'pending', 'failed' or 'idle' (known but not started); 'unknown' for bad keys."""
+        job = job_id(key, size)
+        with self._lock:
+            if job in self._jobs:
+                return 'pending'
+            if self._local_failure(job) is not None:
+                return 'failed'
+        if self.cache.get_spec(key) is None:
+            return 'unknown'
+        if self.cache.peek_image(key, size) is not None:
+            return 'done'
+        return self._shared_state(job) or 'idle'
+
+    def error(self, key, size=None):
+        job = job_id(key, size)
+        with self._lock:
+            message = self._local_failure(job)
+        if message is None:
+            message = self._shared_failure(job)
+        return message
+
+    def result(self, key, size=None, timeout=RENDER_TIMEOUT):
+        """
+        (bytes, mimetype) for a chart variant, rendering through the pool on
+        a miss. None for unknown keys; raises concurrent.futures.TimeoutError
+        if the render does not finish in time and re-raises render errors.
+        """
+        spec = self.cache.get_spec(key)
+        if spec is None:
+            return None
+        data = self.cache.peek_image(key, size)
+        if data is None and self._jobs.get(job_id(key, size)) is None:
+            data = self._wait_shared(key, size, timeout)
+        if data is None:
+            future = self.submit(key, size)
+            if future is not None:
+                data, _ = future.result(timeout)
+            else:
+                data = self.cache.peek_image(key, size)
+            if data is None:   # evicted straight away (tiny cache): render inline
+                return self.cache.get_image(key, size)
+        return data, CHART_MIMETYPES[spec['fmt']]
+
+
+render_pool = RenderPool()
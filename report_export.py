@@ -0,0 +1,328 @@
+# -- coding: utf-8 --
+"""
+Streaming export of full chart reports for large sets of birth records.
+
+A report is the chart (angles, each body's degree, sign and house) plus
+the Arabic readings for each body's house and sign and for the ascendant
+sign, straight from the in-memory interpretation index. Records are read
+lazily (CSV or NDJSON, same fields as the chart form plus an optional
+``id``), computed in chunks, optionally in worker processes, and written
+as NDJSON or CSV one chunk at a time in input order. Memory stays flat
+however long the input is.
+
+    python report_export.py births.csv reports.ndjson --workers 4
+    python report_export.py births.csv reports.csv --resume
+
+The CLI records a checkpoint (<output>.checkpoint) after every chunk: the
+number of records done and the size of the output at that point. --resume
+truncates the output back to the last checkpoint and continues with the
+next record, so an interrupted export neither loses nor duplicates rows.
+Progress and throughput go to stderr.
+
+POST /api/export streams the same reports over a chunked HTTP response
+(see app.py); there FALAKY_EXPORT_WORKERS sets the worker processes
+(0, the default, computes inline in the request). A request is capped
+at FALAKY_MAX_EXPORT_RECORDS records so that, inline, it finishes well
+within the timeout of gunicorn's default sync workers. Larger exports
+belong to the CLI, or to gthread (FALAKY_THREADS > 1) or async workers,
+which stay alive through a long request.
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from chart_model import BODY_ORDER
+from chart_pipeline import ChartContext, ChartInputError, compute_chart_model, parse_birth_data
+from get_interpretation import get_planet_interpretation, store
+
+EXPORT_WORKERS = int(os.environ.get('FALAKY_EXPORT_WORKERS', 0))
+CHUNK_SIZE = 200
+FORMATS = ('ndjson', 'csv')
+
+
+# -- reading ---------------------------------------------------------------
+
+def iter_records(f, fmt):
+    """Yield birth record dicts from a text file object, one line at a time."""
+    if fmt == 'csv':
+        yield from csv.DictReader(f)
+        return
+    for line in f:
+        line = line.strip()
+        if line:
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = {'_error': f"سطر JSON غير صالح: {e}"}
+            yield record if isinstance(record, dict) else {'_error': "كل سجل يجب أن يكون كائن JSON."}
+
+
+def chunks(records, size, start=0):
+    """Group records into lists of (index, record), numbering from start."""
+    chunk = []
+    for index, record in enumerate(records, start):
+        chunk.append((index, record))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def format_for_path(path):
+    return 'csv' if path.endswith('.csv') else 'ndjson'
+
+
+# -- computing -------------------------------------------------------------
+
+def build_report(chart):
+    """Report dict for a ChartModel: positions, houses and readings."""
+    planets = []
+    for body in chart.planets:
+        house_text, sign_text = get_planet_interpretation(body.name_en, body.house, body.sign_en)
+        planets.append({"name_en": body.name_en, "name_ar": body.name_ar, "degree": body.degree,
+                        "sign_en": body.sign_en, "sign_ar": body.sign_ar, "house": body.house,
+                        "house_text": house_text, "sign_text": sign_text})
+    angles = chart.angles
+    ascendant, mc = angles['AC'], angles['MC']
+    return {
+        "location": chart.location,
+        "timezone": chart.timezone,
+        "local_time": chart.local_time,
+        "utc_time": chart.utc_time,
+        "house_system": chart.house_system,
+        "ascendant": {"degree": ascendant.degree, "sign_en": ascendant.sign_en, "sign_ar": ascendant.sign_ar},
+        "mc": {"degree": mc.degree, "sign_en": mc.sign_en, "sign_ar": mc.sign_ar},
+        "ascendant_text": store.get('ascendant', 'signs', ascendant.sign_en) if not store.error else None,
+        "planets": planets,
+    }
+
+
+def report_chunk(chunk):
+    """Compute [(index, record), ...] into report dicts in the same order (runs in workers)."""
+    context = ChartContext()
+    reports = []
+    for index, record in chunk:
+        report = {"index": index, "id": record.get('id', '')}
+        try:
+            if '_error' in record:
+                raise ChartInputError(record['_error'])
+            report.update(build_report(compute_chart_model(parse_birth_data(record), context)))
+        except ChartInputError as e:
+            report["error"] = str(e)
+        except Exception as e:
+            logging.error("Report %s failed: %s", index, e)
+            report["error"] = "حدث خطأ غير متوقع."
+        reports.append(report)
+    return reports
+
+
+def _pool(workers):
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+_shared_pool = None
+_shared_pid = None
+
+
+def shared_pool():
+    """The HTTP export's worker pool (FALAKY_EXPORT_WORKERS), one per server process; None when inline."""
+    global _shared_pool, _shared_pid
+    if EXPORT_WORKERS < 1:
+        return None
+    if _shared_pool is None or _shared_pid != os.getpid():
+        _shared_pool, _shared_pid = _pool(EXPORT_WORKERS), os.getpid()
+    return _shared_pool
+
+
+def _in_order(pool, chunked_records, in_flight):
+    pending = deque()
+    for chunk in chunked_records:
+        pending.append(pool.submit(report_chunk, chunk))
+        if len(pending) >= in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def export_reports(chunked_records, workers=0, pool=None):
+    """
+    Yield report lists, one per input chunk, in input order. With workers,
+    at most 2 * workers chunks are in flight at a time, on pool or on a
+    pool started for this export.
+    """
+    if not workers or workers < 1:
+        for chunk in chunked_records:
+            yield report_chunk(chunk)
+    elif pool is not None:
+        yield from _in_order(pool, chunked_records, workers * 2)
+    else:
+        with _pool(workers) as pool:
+            yield from _in_order(pool, chunked_records, workers * 2)
+
+
+# -- writing ---------------------------------------------------------------
+
+def csv_columns():
+    columns = ['index', 'id', 'error', 'location', 'timezone', 'local_time', 'utc_time', 'house_system',
+               'asc_degree', 'asc_sign', 'mc_degree', 'mc_sign', 'ascendant_text']
+    for name in BODY_ORDER:
+        columns += [f'{name}_degree', f'{name}_sign', f'{name}_house', f'{name}_house_text', f'{name}_sign_text']
+    return columns
+
+
+def _csv_row(report):
+    row = {key: report.get(key, '') for key in ('index', 'id', 'error', 'location', 'timezone', 'local_time',
+                                               'utc_time', 'house_system', 'ascendant_text')}
+    if 'ascendant' in report:
+        row.update(asc_degree=report['ascendant']['degree'], asc_sign=report['ascendant']['sign_en'],
+                   mc_degree=report['mc']['degree'], mc_sign=report['mc']['sign_en'])
+    for planet in report.get('planets', ()):
+        name = planet['name_en']
+        row.update({f'{name}_degree': planet['degree'], f'{name}_sign': planet['sign_en'],
+                    f'{name}_house': planet['house'], f'{name}_house_text': planet['house_text'],
+                    f'{name}_sign_text': planet['sign_text']})
+    return row
+
+
+class ReportFormatter:
+    """Turns report lists into NDJSON or CSV text, one chunk at a time."""
+
+    def __init__(self, fmt):
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown format: {fmt}")
+        self.fmt = fmt
+        self.columns = csv_columns() if fmt == 'csv' else None
+
+    def header(self):
+        if self.fmt != 'csv':
+            return ''
+        buf = io.StringIO()
+        csv.writer(buf).writerow(self.columns)
+        return buf.getvalue()
+
+    def format(self, reports):
+        if self.fmt == 'ndjson':
+            return ''.join(json.dumps(report, ensure_ascii=False) + '\n' for report in reports)
+        buf = io.StringIO()
+        csv.DictWriter(buf, fieldnames=self.columns, extrasaction='ignore').writerows(map(_csv_row, reports))
+        return buf.getvalue()
+
+
+def stream_export(records, fmt='ndjson', workers=0, chunk_size=CHUNK_SIZE, pool=None):
+    """Yield the export as text pieces (header, then one piece per chunk)."""
+    formatter = ReportFormatter(fmt)
+    header = formatter.header()
+    if header:
+        yield header
+    for reports in export_reports(chunks(records, chunk_size), workers, pool):
+        yield formatter.format(reports)
+
+
+# -- CLI with checkpoints ----------------------------------------------------
+
+def _read_checkpoint(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_checkpoint(path, state):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def _count_lines(path):
+    count = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            count += block.count(b'\n')
+    return count
+
+
+def run(input_path, output_path, fmt=None, workers=0, chunk_size=CHUNK_SIZE, resume=False, progress=True):
+    """Export every record of input_path into output_path; returns the number of records written."""
+    fmt = fmt or format_for_path(output_path)
+    in_fmt = format_for_path(input_path)
+    checkpoint_path = output_path + '.checkpoint'
+    state = _read_checkpoint(checkpoint_path) if resume else None
+    if state and (state.get('input') != os.path.abspath(input_path) or state.get('format') != fmt):
+        raise SystemExit(f"{checkpoint_path} belongs to a different export; remove it or drop --resume.")
+    done = state['records'] if state else 0
+    if state and state.get('complete'):
+        print(f"Already complete: {done} records in {output_path}", file=sys.stderr)
+        return done
+
+    total = _count_lines(input_path) - (1 if in_fmt == 'csv' else 0) if progress else None
+    formatter = ReportFormatter(fmt)
+    out = open(output_path, 'r+b' if state else 'wb')
+    try:
+        if state:
+            out.truncate(state['bytes'])
+            out.seek(state['bytes'])
+        else:
+            out.write(formatter.header().encode('utf-8'))
+        errors = state.get('errors', 0) if state else 0
+        written, started = 0, time.perf_counter()
+
+        def save(complete=False):
+            out.flush()
+            os.fsync(out.fileno())
+            _write_checkpoint(checkpoint_path, {'input': os.path.abspath(input_path), 'format': fmt,
+                                                'records': done + written, 'bytes': out.tell(),
+                                                'errors': errors, 'complete': complete})
+
+        with open(input_path, newline='', encoding='utf-8-sig') as f:
+            records = iter_records(f, in_fmt)
+            for _ in range(done):   # already exported before the interruption
+                next(records, None)
+            for reports in export_reports(chunks(records, chunk_size, start=done), workers):
+                out.write(formatter.format(reports).encode('utf-8'))
+                written += len(reports)
+                errors += sum(1 for report in reports if 'error' in report)
+                save()
+                if progress:
+                    elapsed = time.perf_counter() - started
+                    rate = written / elapsed if elapsed else 0.0
+                    position = done + written
+                    eta = f", ETA {(total - position) / rate:.0f} s" if total and rate else ''
+                    print(f"{position}/{total or '?'} records, {errors} errors, {rate:.0f} records/s{eta}",
+                          file=sys.stderr)
+        save(complete=True)
+    finally:
+        out.close()
+    return done + written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export chart reports with interpretations (NDJSON or CSV).")
+    parser.add_argument('input', help="input .csv or .ndjson file of birth records")
+    parser.add_argument('output', help="output .ndjson or .csv file")
+    parser.add_argument('--format', choices=FORMATS, default=None, help="default: from the output extension")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes (0 or 1 runs in-process)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--resume', action='store_true', help="continue from <output>.checkpoint")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    run(args.input, args.output, args.format, args.workers if args.workers > 1 else 0, args.chunk_size,
+        args.resume)
+
+
+if __name__ == '__main__':
+    main()
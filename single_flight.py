@@ -0,0 +1,253 @@
+# -- coding: utf-8 --
+"""
+Single-flight coalescing of identical concurrent work.
+
+When a shared link goes viral, hundreds of identical chart requests
+arrive within seconds. SingleFlight.do(key, compute) runs compute() for
+the first caller of a key; callers with the same key that arrive while
+it runs wait for it and get its result (or its exception) instead of
+computing again.
+
+Across gunicorn workers, the leader also holds an exclusive lock file
+(fcntl.flock) for the key. A worker that finds the lock taken touches the
+stripe's ".wait" file and waits for the lock. Before releasing the lock,
+the leader saves its result in a store the workers share, but only if
+that file was touched since it took the lock, so a chart nobody else
+asked for costs no disk write. The waiting worker then takes the result
+from the store. If there is none (the leader failed, or it checked just
+before the waiter arrived), the waiter computes the result itself. Lock
+files are striped (LOCK_STRIPES per flight), so the directory does not
+grow with the number of keys. FlightStore keeps results for RESULT_TTL
+seconds only: it hands results to waiting workers and is not a cache.
+It stores the bytes of the flight's own encoder (e.g.
+ChartModel.to_bytes), never pickles.
+
+FALAKY_FLIGHT_DIR='' keeps coalescing within each process.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows development server: single process, in-process coalescing is enough
+    fcntl = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FLIGHT_DIR = os.environ.get('FALAKY_FLIGHT_DIR', os.path.join(BASE_DIR, 'cache', 'flight'))
+# How long a duplicate waits for the leader before computing on its own.
+WAIT_SECONDS = float(os.environ.get('FALAKY_FLIGHT_WAIT', 30))
+RESULT_TTL = 60
+LOCK_STRIPES = 1024
+# A ".wait" file touched this long before the leader took the lock still
+# counts as a waiter: file timestamps can lag time.time() by a clock tick.
+WAIT_MARK_SLACK = 1.0
+
+
+def _digest(key):
+    # repr() of tuples of str/int/bool is the same in every process (no hash seed).
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+class FlightStore:
+    """Results passed from the leading worker to the waiting ones (SQLite, as encode(value) bytes)."""
+
+    def __init__(self, path, encode, decode, ttl=RESULT_TTL):
+        self.path = path
+        self.encode = encode
+        self.decode = decode
+        self.ttl = ttl
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._puts = 0
+
+    def _connection(self):
+        # Connections must not cross a fork, so reopen in each gunicorn worker.
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, created REAL NOT NULL)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    'SELECT value FROM results WHERE key = ? AND created > ?',
+                    (_digest(key), time.time() - self.ttl)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning("Flight store read failed: %s", e)
+            return None
+        if row is None:
+            return None
+        try:
+            return self.decode(row[0])
+        except ValueError as e:
+            logging.warning("Flight store entry unreadable: %s", e)
+            return None
+
+    def put(self, key, value):
+        blob = self.encode(value)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (_digest(key), blob, now))
+                    self._puts += 1
+                    if self._puts % 100 == 0:
+                        conn.execute('DELETE FROM results WHERE created <= ?', (now - self.ttl,))
+        except sqlite3.Error as e:
+            logging.warning("Flight store write failed: %s", e)
+
+
+class _Call:
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with equal keys. Cross-worker coalescing
+    needs both lock_dir and a store (get(key) -> value or None, put(key,
+    value)); without them only the threads of one process are coalesced.
+    """
+
+    def __init__(self, name, lock_dir=None, store=None, wait_seconds=WAIT_SECONDS):
+        self.name = name
+        self.lock_dir = lock_dir if fcntl is not None and store is not None else None
+        self.store = store
+        self.wait_seconds = wait_seconds
+        self._calls = {}
+        self._lock = threading.Lock()
+        # led: computed; joined: got the result of a call in this process;
+        # joined_worker: got it from another worker; timeouts: gave up waiting;
+        # stored: results saved for waiting workers.
+        self.stats = {'led': 0, 'joined': 0, 'joined_worker': 0, 'timeouts': 0, 'stored': 0}
+
+    def do(self, key, compute):
+        """compute() once for all concurrent callers with this key; returns (or raises) its outcome."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(self.wait_seconds):
+                self.stats['timeouts'] += 1
+                return compute()
+            self.stats['joined'] += 1
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = self._lead(key, compute)
+            return call.value
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _lead(self, key, compute):
+        if self.lock_dir is None:
+            self.stats['led'] += 1
+            return compute()
+        stripe = int(_digest(key)[:8], 16) % LOCK_STRIPES
+        try:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            lock_file = open(os.path.join(self.lock_dir, f'{self.name}-{stripe}.lock'), 'a')
+        except OSError as e:
+            logging.warning("Flight lock unavailable, computing without it: %s", e)
+            self.stats['led'] += 1
+            return compute()
+
+        wait_path = os.path.join(self.lock_dir, f'{self.name}-{stripe}.wait')
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is computing this key (or one on the same stripe).
+                _touch(wait_path)
+                if self._wait_released(lock_file):
+                    value = self.store.get(key)
+                    if value is not None:
+                        self.stats['joined_worker'] += 1
+                        return value
+                else:
+                    self.stats['timeouts'] += 1
+                self.stats['led'] += 1
+                return compute()
+            try:
+                self.stats['led'] += 1
+                started = time.time()
+                value = compute()
+                if _touched_since(wait_path, started - WAIT_MARK_SLACK):
+                    self.store.put(key, value)
+                    self.stats['stored'] += 1
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _wait_released(self, lock_file):
+        deadline = time.monotonic() + self.wait_seconds
+        delay = 0.001
+        while time.monotonic() < deadline:
+            time.sleep(delay)
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                delay = min(delay * 2, 0.05)
+                continue
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            return True
+        return False
+
+    def __len__(self):
+        """Keys being computed in this process right now."""
+        return len(self._calls)
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        try:
+            open(path, 'a').close()
+        except OSError:
+            pass
+    except OSError:
+        pass
+
+
+def _touched_since(path, since):
+    try:
+        return os.stat(path).st_mtime >= since
+    except OSError:
+        return False
+
+
+def shared_flight(name, encode, decode):
+    """
+    A SingleFlight coalescing across the workers that share
+    FALAKY_FLIGHT_DIR; results travel between them as encode(value) bytes.
+    """
+    if not FLIGHT_DIR:
+        return SingleFlight(name)
+    return SingleFlight(name, FLIGHT_DIR, FlightStore(os.path.join(FLIGHT_DIR, f'{name}.sqlite3'), encode, decode))
@@ -0,0 +1,109 @@
+# -- coding: utf-8 --
+"""
+Startup modes.
+
+FALAKY_STARTUP=lazy (the default for `python app.py` and plain imports)
+loads nothing heavy at import time. numpy, matplotlib, geopy and the
+timezone polygons are imported or loaded on first use, so a process
+that never draws a PNG never pays for matplotlib.
+
+FALAKY_STARTUP=preload (the default under gunicorn.conf.py, which also
+sets preload_app) imports the request-path modules and loads the
+read-only data once in the gunicorn master, before the workers fork:
+the TimezoneFinder, gazetteer, interpretations, horoscopes, the daily
+sky files already built, and the ephemeris table and similar-charts
+index if they are built. The workers then share those pages
+copy-on-write instead of each building its own copy. gc.freeze()
+moves everything loaded so far out of the collector's reach, so the
+collector's reference counting does not dirty (and copy) those pages
+afterwards.
+
+What is deliberately not done in the master: opening SQLite
+connections and starting the render pool. Both are per-process and are
+reopened after fork anyway.
+"""
+import gc
+import logging
+import os
+import time
+
+STARTUP_MODE = os.environ.get('FALAKY_STARTUP', 'lazy').lower()
+
+
+def _step(timings, name, func):
+    start = time.perf_counter()
+    try:
+        func()
+    except Exception as e:
+        logging.warning("Startup step %s failed: %s", name, e)
+    timings[name] = time.perf_counter() - start
+
+
+def _import_request_modules():
+    import numpy  # noqa: F401
+    import aspects  # noqa: F401
+    import chart_svg  # noqa: F401  (builds the static SVG layers)
+
+
+def _load_ephemeris_table():
+    import ephemeris_table
+    ephemeris_table.load_table()
+
+
+def _load_chart_index():
+    import chart_index
+    chart_index.load_index()
+
+
+def _load_daily_sky():
+    from daily_sky import daily_sky
+    daily_sky.load_ahead()
+
+
+def warm(horoscope_store=None):
+    """Load shared read-only data now; returns {step: seconds}."""
+    import geocoding
+    import get_interpretation
+    import timezone_service
+
+    timings = {}
+    _step(timings, 'imports', _import_request_modules)
+    _step(timings, 'timezone_finder', timezone_service.warm)
+    _step(timings, 'gazetteer', geocoding.get_gazetteer)
+    _step(timings, 'interpretations', get_interpretation.store.refresh)
+    if horoscope_store is not None:
+        _step(timings, 'horoscopes', horoscope_store.snapshot)
+    _step(timings, 'ephemeris_table', _load_ephemeris_table)
+    _step(timings, 'chart_index', _load_chart_index)
+    _step(timings, 'daily_sky', _load_daily_sky)
+
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    logging.info("Preloaded shared data in %.1f ms (%s)", sum(timings.values()) * 1000,
+                 ', '.join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in timings.items()))
+    return timings
+
+
+def rss_kb(pid='self'):
+    """Resident set size of a process in KiB (Linux), or None."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def pss_kb(pid='self'):
+    """Proportional set size in KiB: shared pages split between the processes sharing them."""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
@@ -0,0 +1,188 @@
+# -- timezone_service.py --
+"""
+Process-wide timezone resolution.
+
+A single TimezoneFinder is created per process (lazily, or up front via
+warm() in the gunicorn master so forked workers inherit it). Its polygon
+data is memory-mapped read-only, so the pages are shared by all workers.
+On top of it sit three caches:
+
+* (lat, lon) -> zone, with coordinates quantized to TZ_CACHE_DECIMALS;
+* country string -> override zone (Syria, Jordan, Saudi Arabia);
+* (zone, naive local datetime, DST preference) -> localized times, UTC
+  offset and DST hours, which is everything the dst_notice logic needs.
+
+Run ``python timezone_service.py`` to print cold and warm lookup latency.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
+
+import pytz
+
+# 3 decimals ~ 110 m; enough to keep cities apart without fragmenting the cache.
+TZ_CACHE_DECIMALS = int(os.environ.get('FALAKY_TZ_CACHE_DECIMALS', 3))
+TZ_CACHE_SIZE = int(os.environ.get('FALAKY_TZ_CACHE_SIZE', 65536))
+TZ_IN_MEMORY = os.environ.get('FALAKY_TZ_IN_MEMORY', '') == '1'
+
+# Country spellings (lower-case, matched as substrings like the old scans)
+# whose TimezoneFinder answer we do not trust, in priority order.
+COUNTRY_TIMEZONE_OVERRIDES = (
+    # TimezoneFinder returns "Europe/Moscow" for Syrian cities; Syria is on
+    # Asia/Damascus (UTC+3 permanent, no DST since Oct 2022).
+    ('Asia/Damascus', 'Syria', ('syria', 'سوريا', 'syrian', 'syrian arab republic', 'سورية')),
+    ('Asia/Amman', 'Jordan', ('jordan', 'الأردن', 'jordanian')),
+    ('Asia/Riyadh', 'Saudi Arabia', ('saudi arabia', 'السعودية', 'المملكة العربية السعودية', 'saudi', 'ksa')),
+)
+_OVERRIDE_PATTERNS = tuple(
+    (zone, label, re.compile('|'.join(re.escape(name) for name in sorted(names, key=len, reverse=True))))
+    for zone, label, names in COUNTRY_TIMEZONE_OVERRIDES
+)
+
+_finder = None
+_finder_lock = threading.Lock()
+load_seconds = None
+
+
+class LocalTime(NamedTuple):
+    local_dt: datetime
+    utc_dt: datetime
+    utc_offset: str      # e.g. "UTC+03:00"
+    dst_hours: float     # 0 when standard time is in effect
+    ambiguous: bool      # True when the wall time occurs twice (DST fall-back)
+
+
+def get_finder():
+    """Return the shared TimezoneFinder, loading the polygon data once per process."""
+    global _finder, load_seconds
+    if _finder is None:
+        with _finder_lock:
+            if _finder is None:
+                from timezonefinder import TimezoneFinder
+                start = time.perf_counter()
+                _finder = TimezoneFinder(in_memory=TZ_IN_MEMORY)
+                load_seconds = time.perf_counter() - start
+                logging.info("TimezoneFinder loaded in %.1f ms", load_seconds * 1000)
+    return _finder
+
+
+def warm():
+    """Load the finder ahead of the first request (e.g. in the gunicorn master)."""
+    get_finder()
+    return load_seconds
+
+
+@lru_cache(maxsize=TZ_CACHE_SIZE)
+def _zone_at(qlat, qlon):
+    return get_finder().timezone_at(lng=qlon, lat=qlat)
+
+
+def timezone_at(lat, lon):
+    """Timezone name for a coordinate, or None over unclaimed areas."""
+    return _zone_at(round(lat, TZ_CACHE_DECIMALS), round(lon, TZ_CACHE_DECIMALS))
+
+
+@lru_cache(maxsize=4096)
+def override_for_country(country):
+    """Return (zone, label) when the country needs a fixed zone, else None."""
+    country_lower = country.lower().strip()
+    for zone, label, pattern in _OVERRIDE_PATTERNS:
+        if pattern.search(country_lower):
+            return zone, label
+    return None
+
+
+def apply_country_override(timezone_str, country):
+    """Replace a detected zone with the country's known zone where we override it."""
+    override = override_for_country(country)
+    if override and timezone_str != override[0]:
+        logging.info("Overriding timezone from %s to %s for %s", timezone_str, override[0], override[1])
+        return override[0]
+    return timezone_str
+
+
+def resolve_timezone(lat, lon, country=''):
+    """Zone for a location with the country overrides applied, or None if unknown."""
+    timezone_str = timezone_at(lat, lon)
+    if not timezone_str:
+        return None
+    return apply_country_override(timezone_str, country)
+
+
+@lru_cache(maxsize=16384)
+def localize(timezone_str, naive_dt, prefer_dst=True):
+    """
+    Localize a wall-clock time in a zone.
+    Ambiguous times use prefer_dst; non-existent times raise
+    pytz.exceptions.NonExistentTimeError (and are not cached).
+    """
+    local_tz = pytz.timezone(timezone_str)
+    ambiguous = False
+    try:
+        local_dt = local_tz.localize(naive_dt, is_dst=None)
+    except pytz.exceptions.AmbiguousTimeError:
+        local_dt = local_tz.localize(naive_dt, is_dst=prefer_dst)
+        ambiguous = True
+    return _local_time(local_dt, ambiguous)
+
+
+def from_utc(timezone_str, utc_dt, ambiguous=False):
+    """LocalTime of a naive UTC datetime in a zone (the inverse of localize())."""
+    return _local_time(pytz.utc.localize(utc_dt).astimezone(pytz.timezone(timezone_str)), ambiguous)
+
+
+def _local_time(local_dt, ambiguous):
+    utc_offset = local_dt.strftime('%z')
+    dst_offset = local_dt.dst()
+    return LocalTime(
+        local_dt=local_dt,
+        utc_dt=local_dt.astimezone(pytz.utc),
+        utc_offset=f"UTC{utc_offset[:3]}:{utc_offset[3:]}",
+        dst_hours=dst_offset.total_seconds() / 3600 if dst_offset else 0,
+        ambiguous=ambiguous,
+    )
+
+
+def cache_stats():
+    """Hit/miss counters of the three caches, plus the finder load time."""
+    result = {'finder_load_seconds': load_seconds}
+    for name, func in (('zone', _zone_at), ('override', override_for_country), ('localize', localize)):
+        info = func.cache_info()
+        result[name] = {'hits': info.hits, 'misses': info.misses, 'size': info.currsize}
+    return result
+
+
+def measure_latency(points=None, repeat=1000):
+    """Time the finder load, a cold (uncached) lookup and a warm (cached) lookup."""
+    points = points or [(33.5138, 36.2765), (31.9539, 35.9106), (24.7136, 46.6753),
+                        (30.0444, 31.2357), (51.5074, -0.1278), (40.7128, -74.0060)]
+    get_finder()
+
+    cold = []
+    for lat, lon in points:
+        _zone_at.cache_clear()
+        start = time.perf_counter()
+        timezone_at(lat, lon)
+        cold.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for lat, lon in points:
+            timezone_at(lat, lon)
+    warm_total = time.perf_counter() - start
+
+    return {
+        'finder_load_ms': load_seconds * 1000,
+        'cold_lookup_us': sum(cold) / len(cold) * 1e6,
+        'warm_lookup_us': warm_total / (repeat * len(points)) * 1e6,
+    }
+
+
+if __name__ == '__main__':
+    for key, value in measure_latency().items():
+        print(f"{key}: {value:.2f}")
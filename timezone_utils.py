@@ -1,21 +1,17 @@
-from geopy.geocoders import Nominatim
-from timezonefinder import TimezoneFinder
+import geocoding
+import timezone_service
 from datetime import datetime
 import pytz
 
 def get_timezone_info(city_name, date=None):
     # تحديد الإحداثيات من اسم المدينة
-    geolocator = Nominatim(user_agent="falaky_app")
-    location = geolocator.geocode(city_name)
+    lat, lon = geocoding.geocode_query(city_name)
 
-    if not location:
+    if lat is None or lon is None:
         raise ValueError(f"لا يمكن إيجاد الموقع الجغرافي لـ: {city_name}")
 
-    lat, lon = location.latitude, location.longitude
-
     # تحديد اسم المنطقة الزمنية
-    tf = TimezoneFinder()
-    timezone_str = tf.timezone_at(lng=lon, lat=lat)
+    timezone_str = timezone_service.timezone_at(lat, lon)
 
     if not timezone_str:
         raise ValueError("لم يتم التعرف على المنطقة الزمنية.")